@@ -32,8 +32,14 @@ index file like this::
     zipimporter("mylib.zip").write_index()
 
 This will create the file "mylib.zip.idx" containing the pre-parsed zipfile
-directory information.  Specifically, it will contain a marshalled dictionary
-object with the same structure as those in zipimport._zip_directory_cache.
+directory information.  Specifically, it will contain a marshalled tuple
+(files,info) where "files" is a dictionary with the same structure as those
+in zipimport._zip_directory_cache, and "info" is a dictionary of extra details
+such as a fingerprint of the zipfile; if there are no extra details, it holds
+just the dictionary.  Indexes written by earlier versions can still be loaded,
+but versions before 0.4.0 fail with an error on indexes in the new format
+rather than ignoring them, so delete or rebuild your index files if you need
+to downgrade.
 
 In my tests, use of these indexes speeds up the initial loading of a zipfile by 
 about a factor of 3 on Linux, and a factor of 5 on Windows.
@@ -52,6 +58,143 @@ that match any of these patterns will be preloaded when the zipfile is first
 accessed for import.  You may want to remove them from the actual zipfile in
 order to save space.
 
+If the set of modules to preload isn't known until runtime (e.g. for plugins
+selected by a config file) you can get a similar effect by prefetching them
+once the zipfile has been opened::
+
+    zipimporter("mylib.zip").prefetch(["myplugin*"])
+
+This reads the data for all matching files in order of their position in the
+zipfile, using a few large sequential reads instead of one read per file.
+
+Rather than writing preload patterns by hand, you can record exactly which
+files are used during a representative run of your application and preload
+just those::
+
+    zipimporter.start_trace()
+    import myapp
+    trace = zipimporter.stop_trace()
+    zipimporter("mylib.zip").write_index(trace=trace)
+
+You can also have all the modules in the zipfile validated and compiled when
+the index is written, so that loading a module does nothing but unmarshal its
+code and execute it::
+
+    zipimporter("mylib.zip").write_index(precompiled=True)
+
+The precompiled code is only used by an interpreter with the same bytecode
+magic number and optimisation level as the one that wrote the index.  For large
+zipfiles, pass e.g. "jobs=4" to compile the modules in a pool of worker
+processes.
+
+If your application has many entries on sys.path, pass "lookup=True" when
+writing the index to include a table of all the modules in the zipfile.  The
+importer can then find a module, or determine that it's not present, with a
+single dictionary lookup.
+
+For zipfiles with very many entries, pass "lazy=True" to write the index in a
+binary format that is memory-mapped and decoded one entry at a time, rather
+than being unmarshalled all at once when the zipfile is first opened.  If you
+also give a trace, the preloaded data for the traced files is stored in the
+order they were first used, so that startup reads the index front to back.
+
+If memory is tight, set "zipimporter.compact_directory = True" before opening
+any zipfiles.  The directory information will then be kept in compact arrays
+rather than as a tuple of python objects per entry, using about a third of the
+memory at the cost of slightly slower lookups.
+
+If your application reads the same data files repeatedly via get_data(), you
+can avoid decompressing them each time by installing a cache::
+
+    from zipimportx import zipimporter, DataCache
+    zipimporter.data_cache = DataCache(max_bytes=10*1024*1024)
+
+For large data files, use open_resource() instead of get_data() to get a file
+object that decompresses the data incrementally as it is read.
+For files stored without compression, get_buffer() returns a buffer that
+refers directly to the memory-mapped zipfile without copying any data.
+
+If you know which modules your application will import at startup, you can
+have their code prepared by background threads while the main thread gets on
+with executing them::
+
+    zipimporter("mylib.zip").warmup(["myapp","myapp.core","myapp.utils"])
+
+For pre-forking servers, you can instead prepare the code for a whole set of
+modules in the master process before forking, so that all the workers share
+a single copy of it::
+
+    (nmodules,nbytes) = zipimporter("mylib.zip").warm(["myapp*"])
+
+If some modules in the zipfile have missing or out-of-date bytecode (e.g. after
+upgrading the interpreter) they must be compiled from source on every import.
+To cache the compiled code between runs, give zipimportx a writable directory::
+
+    zipimporter.code_cache_dir = "/var/cache/myapp"
+
+If your application has several zipfiles on sys.path, you can write a single
+merged index for all of them and load it with one read at startup.  This also
+records which zipfile provides each top-level module, so that imports can go
+straight to the right zipfile rather than searching each one in turn::
+
+    zipimporter.write_merged_index("lib/merged.idx",["lib/a.zip","lib/b.zip"])
+    ...
+    zipimporter.load_merged_index("lib/merged.idx")
+
+To make startup imports read the zipfile in a single forward scan, you can
+rewrite it so that files appear in the order they're used.  This keeps it a
+standard zipfile, and writes a fresh index for it::
+
+    zipimporter.start_trace()
+    import myapp
+    trace = zipimporter.stop_trace()
+    zipimporter("mylib.zip").relayout(trace,uncompressed=True)
+
+Zipfiles without an index are parsed by the builtin zipimport module, which
+is the fastest option when the data is already cached in memory.  If it can't
+handle the zipfile, zipimportx parses the central directory itself with a
+single read, which allows importing from zip64 archives and from zipfiles
+that have a comment.  Set "zipimporter.python_directory = True" to always
+parse unindexed zipfiles this way, e.g. when reading from slow storage where
+many small reads are expensive.
+
+If your build process appends a few changed files to a large zipfile, pass
+"incremental=True" when re-writing its index.  Preloaded data and precompiled
+code for the unchanged files is then taken from the existing index, rather
+than being read from the zipfile all over again.
+
+The iter_modules() and listdir() methods list the modules and files in a
+directory of the zipfile, using a tree of directories that is built once for
+each zipfile (or loaded from the index, if it was written with a lookup table)
+rather than scanning all the files each time.  If the pkgutil module has been
+imported, install() also registers iter_modules() for use by functions such as
+pkgutil.iter_modules() and pkgutil.walk_packages().
+
+To find out where the time goes during startup, you can have zipimportx record
+statistics for each zipfile and each module: the number of files read from
+disk or served from preloaded data, bytes read and decompressed, bytecode that
+was rejected in favour of source, and the time spent reading, decompressing,
+unmarshalling, compiling and executing::
+
+    zipimporter.start_stats()
+    import myapp
+    stats = zipimporter.stop_stats()
+
+Or set ZIPIMPORTX_STATS=1 in the environment to print the statistics to stderr
+at exit, or set it to the name of a file to write them to.
+
+To see which of your imports is responsible for which costs, you can record a
+profile of the nested module loads.  The tree of loads can be formatted as text
+showing the cumulative and self time for each module, split between zipimportx
+overhead and executing the module body, or as collapsed stacks for use with
+flamegraph tools::
+
+    zipimporter.start_profile()
+    import myapp
+    profile = zipimporter.stop_profile()
+    print profile.format_tree()
+    open("imports.folded","w").write(profile.format_collapsed())
+
 
 Finally, it's possible to convert a zipfile into inline python code and include
 that code directly in your frozen application.  This can simulate the effect
@@ -61,11 +204,59 @@ process.  To get the necessary sourcecode, do the following::
     from zipimportx import zipimporter
     code = zipimporter("mylib.zip").get_inline_code()
 
+For zipfiles with many entries, pass "compact=True" to embed the data as a
+few compressed strings rather than a dict literal.  The generated code then
+compiles much faster, takes less memory once it has run, and the data for each
+file is only decompressed when it's first used.  Note that by default the code
+also includes the full source of zipimportx itself, which is about 140KB and
+must be compiled along with it.  If zipimportx is already available in your
+frozen application, pass "bootstrap_zipimportx=False" to leave it out.
+
+
+Most of the above can also be done from the command line, which is handy in
+a build process.  The "build", "inline", "stats" and "verify" commands each
+take any number of zipfiles and process them in parallel::
+
+    python -m zipimportx build --preload "*.txt" --trace trace.txt lib*.zip
+    python -m zipimportx inline --compact -o mylib.py mylib.zip
+    python -m zipimportx stats lib*.zip
+    python -m zipimportx verify lib*.zip
+
+A trace file for the "build" command lists one file per line, either as a
+path within the zipfile or as a tab-separated (archive,path) pair from the
+stop_trace() method; pairs are matched to zipfiles by their filename.  The
+"verify" command exits with a non-zero status if any index doesn't match its
+zipfile.
+
+
+To measure the effect of these options, the "zipimportx.bench" module runs a
+benchmark suite over synthetic zipfiles of varying size, compression and
+package depth.  It times opening the zipfile, finding, loading and reading
+files, and building the index, for the builtin zipimport module and for each
+way of using zipimportx, with both a warm and (where permitted) a dropped page
+cache.  Results are written as JSON and can be compared against a baseline::
+
+    python -m zipimportx.bench run --output baseline.json
+    python -m zipimportx.bench compare baseline.json current.json
+
+The "archives" command takes the same measurements on your own zipfiles, e.g.
+the memory used per entry by the directory information, and the time taken to
+parse the directory with the builtin zipimport module and in pure python::
+
+    python -m zipimportx.bench archives lib*.zip
+
 
 Finally, it's worth re-iterating the big assumption made by this module: the
-zipfile must never change or go missing.  If the data in the index does not
-reflect the actual contents of the zipfile, imports will break in unspecified
-and probably disasterous ways.
+zipfile must not change or go missing while it's in use.  Each index records
+a fingerprint of the zipfile (its size, end-of-central-directory record and a
+CRC of its central directory) and is ignored if the zipfile no longer matches,
+at the cost of one small read when the zipfile is opened; set the attribute
+"zipimporter.verify_index = False" to skip this check.  This quick check only
+compares the size and end records, so it won't notice a file being rewritten
+in place with data of exactly the same size; "python -m zipimportx verify"
+also checks the CRC of the central directory, which covers the CRC and
+modification time of every file.  And if the zipfile is changed after it has
+been opened, imports will break in unspecified and probably disasterous ways.
 
 Note also that this package uses nothing but builtin modules.  To bootstrap
 zipfile imports for a frozen application, you can inline this module's code
@@ -88,8 +279,8 @@ this in your build process::
 """
 
 __ver_major__ = 0
-__ver_minor__ = 3
-__ver_patch__ = 1
+__ver_minor__ = 4
+__ver_patch__ = 0
 __ver_sub__ = ""
 __ver_tuple__ = (__ver_major__,__ver_minor__,__ver_patch__,__ver_sub__)
 __version__ = "%d.%d.%d%s" % __ver_tuple__
@@ -112,6 +303,19 @@ if "zlib" in sys.builtin_module_names:
 else:
     zlib = None
 
+if "mmap" in sys.builtin_module_names:
+    import mmap
+else:
+    mmap = None
+
+if "struct" in sys.builtin_module_names:
+    import struct
+else:
+    struct = None
+
+#  Not a builtin, so it's only imported as needed.
+os = None
+
 
 archive_index = ".idx"
 if sys.platform == "win32":
@@ -124,6 +328,1587 @@ else:
 ZipImportError = zipimport.ZipImportError
 _zip_directory_cache = zipimport._zip_directory_cache
 _zip_directory_preload = {}
+_zip_directory_info = {}
+_zip_archive_maps = {}
+_zip_module_owners = {}
+_zip_trace = None
+
+#  Import statistics, recorded only while enabled by start_stats().  This
+#  holds a dict of counters for each archive and each module, and a thread
+#  local holding the stack of modules currently being loaded by each thread,
+#  to which any counters are attributed.
+_zip_stats = None
+_zip_stats_local = None
+
+#  The root of the tree of module loads recorded by start_profile(), and a
+#  thread local holding the stack of nodes for the modules currently being
+#  loaded by each thread.
+_zip_profile = None
+_zip_profile_local = None
+
+#  Bit flags for each of the possible module suffixes, as used in the lookup
+#  table stored in index files.  These don't depend on the search order, so
+#  an index can be used with or without optimisation.
+_zip_suffix_flags = {SEP+"__init__.pyc": 1,
+                     SEP+"__init__.pyo": 2,
+                     SEP+"__init__.py": 4,
+                     ".pyc": 8,
+                     ".pyo": 16,
+                     ".py": 32,}
+
+#  Module code prepared in advance, keyed by (archive,pathhead).  While a
+#  warmup is running, _zip_warmup maps the key of each module to True if
+#  it's waiting to be prepared, or to a lock held while it's in progress.
+_zip_code_cache = {}
+_zip_warmup = {}
+_zip_warmup_lock = None
+
+
+def _record_stat(archive,name,value=1):
+    """Add to a counter in the import statistics.
+
+    The value is added to the named counter for the given archive, and for
+    the module currently being loaded if there is one.  This must only be
+    called while statistics are enabled.
+    """
+    counters = _zip_stats["archives"].setdefault(archive,{})
+    counters[name] = counters.get(name,0) + value
+    stack = _get_stats_stack()
+    if stack:
+        counters = _zip_stats["modules"][stack[-1]]
+        counters[name] = counters.get(name,0) + value
+    if _zip_profile is not None:
+        stack = _get_profile_stack()
+        if stack:
+            counters = stack[-1].counters
+            counters[name] = counters.get(name,0) + value
+
+
+def _new_thread_local():
+    """Create a new thread-local object, for a per-thread stack."""
+    try:
+        from thread import _local
+    except ImportError:
+        from _threading_local import local as _local
+    return _local()
+
+
+def _get_stats_stack():
+    """Get the stack of modules being loaded by the current thread.
+
+    This must only be called while statistics are enabled.
+    """
+    try:
+        return _zip_stats_local.stack
+    except AttributeError:
+        stack = _zip_stats_local.stack = []
+        return stack
+
+
+def _get_profile_stack():
+    """Get the stack of profile nodes being loaded by the current thread.
+
+    This must only be called while profiling is enabled.
+    """
+    try:
+        return _zip_profile_local.stack
+    except AttributeError:
+        stack = _zip_profile_local.stack = []
+        return stack
+
+
+def _format_stats(stats):
+    """Format import statistics as returned by stats() into readable text."""
+    lines = []
+    for (kind,names) in (("archive",stats["archives"]),
+                         ("module",stats["modules"]),):
+        for name in sorted(names):
+            counters = names[name]
+            lines.append("%s %s" % (kind,name,))
+            for counter in sorted(counters):
+                value = counters[counter]
+                if isinstance(value,float):
+                    value = "%.6f" % (value,)
+                lines.append("    %s: %s" % (counter,value,))
+    return "\n".join(lines) + "\n"
+
+
+def _getenv(name):
+    """Get the value of an environment variable, using only builtins."""
+    for modnm in ("posix","nt",):
+        if modnm in sys.builtin_module_names:
+            return __import__(modnm).environ.get(name)
+    return None
+
+
+def _dump_stats(dest):
+    """Write the import statistics to stderr or to the named file."""
+    if _zip_stats is None:
+        return
+    text = _format_stats(zipimporter.stats())
+    if dest in ("1","-",):
+        sys.stderr.write(text)
+    else:
+        with open(dest,"w") as f:
+            f.write(text)
+
+
+def _platform_path(path,platform):
+    """Convert a path from host separators to those of the given platform."""
+    if platform is not None:
+        if sys.platform == "win32" and platform != "win32":
+            path = path.replace("\\","/")
+        elif sys.platform != "win32" and platform == "win32":
+            path = path.replace("/","\\")
+    return path
+
+
+def _check_index_info(info):
+    """Check the extra information loaded from an index file.
+
+    The index may contain precompiled module code, which is only usable if
+    the index was written by an interpreter with the same bytecode magic and
+    optimisation level as the running one.  Any unusable parts of the info
+    are discarded, and the remainder returned.
+    """
+    if info is None:
+        return {}
+    if info.get("magic") != imp.get_magic() or info.get("debug") != __debug__:
+        info.pop("modules",None)
+    return info
+
+
+def _build_tree(paths,sep=SEP):
+    """Build the tree of directories for the given file paths.
+
+    This returns a dict mapping the path of each directory ("" for the top
+    level) to a dict mapping the name of each of its entries to True if it's
+    a subdirectory, or False if it's a file.  Directories that don't have an
+    entry of their own in the zipfile are included.
+    """
+    tree = {"": {}}
+    for path in paths:
+        parts = path.split(sep)
+        dirpath = ""
+        for name in parts[:-1]:
+            tree[dirpath][name] = True
+            if dirpath:
+                dirpath = dirpath + sep + name
+            else:
+                dirpath = name
+            if dirpath not in tree:
+                tree[dirpath] = {}
+        #  Explicit directory entries have an empty final component.
+        if parts[-1]:
+            tree[dirpath].setdefault(parts[-1],False)
+    return tree
+
+
+def _compile_patterns(patterns):
+    """Compile a list of filename patterns into a single matching function.
+
+    The glob-style patterns are translated into one regular expression, so
+    that each filename is matched with a single call rather than once for
+    every pattern.  Matching follows fnmatch.fnmatch(), including its case
+    normalisation.
+    """
+    import os  # not a builtin, import only as needed
+    import re  # not a builtin, import only as needed
+    import fnmatch  # not a builtin, import only as needed
+    if isinstance(patterns,basestring):
+        patterns = [patterns]
+    if not patterns:
+        return lambda name: False
+    normcase = os.path.normcase
+    regex = "|".join("(?:%s)" % (fnmatch.translate(normcase(pattern)),)
+                     for pattern in patterns)
+    match = re.compile(regex).match
+    return lambda name: match(normcase(name)) is not None
+
+
+def _load_index(indexpath):
+    """Load pre-processed directory information from an index file.
+
+    This function returns a tuple (files,info) giving the directory info
+    for the archive and any extra info stored in the index, or None if the
+    index is not usable on this platform.  If the index file can't be read,
+    EnvironmentError is raised.
+    """
+    with open(indexpath,"rb") as f:
+        if f.read(4) == _LazyDirectory.magic:
+            return _LazyDirectory.load(f)
+        f.seek(0)
+        files = marshal.load(f)
+    #  Indexes with extra info are stored as a (files,info) pair.
+    info = None
+    if isinstance(files,tuple):
+        (files,info) = files
+    for path in files.keys():
+        if SEP in path:
+            break
+        if BADSEP in path:
+            return None
+    return (files,_check_index_info(info))
+
+
+def _write_index_file(indexpath,write):
+    """Write an index file by writing a temporary file and renaming it.
+
+    The given function is called with the open temporary file to write the
+    contents.  Other processes never see a partially-written index file,
+    and the temporary file is removed if anything goes wrong.
+    """
+    import os  # not a builtin, import only as needed
+    tmppath = "%s.%d.tmp" % (indexpath,os.getpid(),)
+    renamed = False
+    try:
+        with open(tmppath,"wb") as f:
+            write(f)
+        #  On win32 we can't rename over an existing file.
+        if sys.platform == "win32" and os.path.exists(indexpath):
+            os.unlink(indexpath)
+        os.rename(tmppath,indexpath)
+        renamed = True
+    finally:
+        if not renamed and os.path.exists(tmppath):
+            os.unlink(tmppath)
+
+
+class _DirectoryMapping(object):
+    """Base class for alternative directory information mappings.
+
+    The directory information for an archive is usually a dict mapping paths
+    to TOC tuples.  Subclasses of this class can provide the same interface
+    using a different representation, and will work anywhere that the dicts
+    in _zip_directory_cache would.  They need only provide __getitem__,
+    __setitem__, __contains__, __len__ and iterkeys.
+    """
+
+    def has_key(self,key):
+        return key in self
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def itervalues(self):
+        for key in self.iterkeys():
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield (key,self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+
+class _LazyDirectory(_DirectoryMapping):
+    """Directory information that is decoded lazily from an index file.
+
+    This is a mapping object with the same interface as the dicts stored in
+    _zip_directory_cache, but backed by a binary index file containing a
+    sorted table of keys.  The index file is memory-mapped if possible, keys
+    are found by binary search of the table, and each entry is unmarshalled
+    only when first accessed.  This makes loading the index essentially free
+    regardless of the number of entries in the zipfile.
+
+    The index file format is a fixed-size header, followed by a table with
+    (keyoffset,keysize,entryoffset,entrysize) for each key in sorted order,
+    followed by the key strings, the marshalled entries and finally the
+    marshalled extra info for the index.  The keys and entries needn't be
+    in the same order as the table; entries given in the "order" argument
+    to write() come first, so that e.g. the files used at startup can be
+    read from the index in a single forward scan.
+    """
+
+    magic = "ZXIX"
+    _header = "<4sc3xIII"
+    _header_size = 20
+    _entry = "<IIII"
+    _entry_size = 16
+
+    def __init__(self,buf,count):
+        self._buf = buf
+        self._count = count
+        self._entries = {}
+        self._added = {}
+
+    @classmethod
+    def load(cls,f):
+        """Load directory info from the given binary index file.
+
+        This returns a tuple (files,info) as for _load_index(), or None if
+        the index was written for a different platform or is truncated.
+        """
+        global struct, mmap
+        if struct is None:
+            try:
+                import struct
+            except ImportError:
+                return None
+        f.seek(0)
+        try:
+            if mmap is None:
+                import mmap
+            buf = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except (ImportError,EnvironmentError,ValueError,OverflowError):
+            buf = f.read()
+        if len(buf) < cls._header_size:
+            return None
+        header = struct.unpack_from(cls._header,buf,0)
+        (magic,sep,count,infooffset,infosize) = header
+        if sep != SEP:
+            return None
+        #  The table, keys and entries all lie between the header and the
+        #  info, so if those fit then so does the file we wrote.
+        if cls._header_size + cls._entry_size * count > infooffset:
+            return None
+        if infooffset + infosize > len(buf):
+            return None
+        try:
+            info = marshal.loads(buf[infooffset:infooffset+infosize])
+        except (ValueError,EOFError,TypeError):
+            return None
+        return (cls(buf,count),_check_index_info(info))
+
+    @classmethod
+    def write(cls,f,files,info,sep=SEP,order=()):
+        """Write directory info to the given file in binary index format.
+
+        The entries for any keys in "order" are written first, in the order
+        given, followed by all the others in sorted order.
+        """
+        global struct
+        if struct is None:
+            import struct
+        keys = sorted(files)
+        seen = set()
+        ordered = []
+        for key in order:
+            if key in files and key not in seen:
+                seen.add(key)
+                ordered.append(key)
+        ordered.extend(key for key in keys if key not in seen)
+        entries = {}
+        data = []
+        offset = cls._header_size + cls._entry_size * len(keys)
+        for key in ordered:
+            entry = marshal.dumps(files[key])
+            entries[key] = (offset,len(key),offset+len(key),len(entry))
+            data.append(key)
+            data.append(entry)
+            offset += len(key) + len(entry)
+        info = marshal.dumps(info)
+        f.write(struct.pack(cls._header,cls.magic,sep,len(keys),
+                            offset,len(info)))
+        for key in keys:
+            f.write(struct.pack(cls._entry,*entries[key]))
+        for item in data:
+            f.write(item)
+        f.write(info)
+
+    def _get_entry(self,i):
+        offset = self._header_size + self._entry_size * i
+        return struct.unpack_from(self._entry,self._buf,offset)
+
+    def _get_key(self,i):
+        (keyoffset,keysize,_,_) = self._get_entry(i)
+        return self._buf[keyoffset:keyoffset+keysize]
+
+    def _find(self,key):
+        """Find the position of a key in the table, or -1 if not present."""
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._get_key(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self,key):
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        (_,_,entryoffset,entrysize) = self._get_entry(i)
+        value = marshal.loads(self._buf[entryoffset:entryoffset+entrysize])
+        self._entries[key] = value
+        return value
+
+    def __setitem__(self,key,value):
+        if key not in self._entries and self._find(key) < 0:
+            self._added[key] = True
+        self._entries[key] = value
+
+    def __contains__(self,key):
+        return key in self._entries or self._find(key) >= 0
+
+    def __len__(self):
+        return self._count + len(self._added)
+
+    def iterkeys(self):
+        for i in xrange(self._count):
+            yield self._get_key(i)
+        for key in self._added:
+            yield key
+
+
+class _CompactDirectory(_DirectoryMapping):
+    """Directory information stored in compact array-backed columns.
+
+    This is a mapping object with the same interface as the dicts stored in
+    _zip_directory_cache, but using much less memory per entry.  Rather than
+    a tuple of python ints for each entry, the numeric fields are stored in
+    arrays of machine integers.  Rather than a full path for each key, the
+    keys are stored as an interned directory name plus a basename.  Entries
+    are sorted by directory and then basename, and found by binary search.
+
+    If the array module is not available, or if the entries contain values
+    that don't fit in a machine integer, ValueError is raised.
+    """
+
+    def __init__(self,files):
+        try:
+            import array  # not a builtin, import only as needed
+        except ImportError:
+            raise ValueError("array module not available")
+        entries = []
+        for (key,toc) in files.iteritems():
+            parts = key.rsplit(SEP,1)
+            if len(parts) == 1:
+                entries.append(("",key,toc))
+            else:
+                entries.append((parts[0] + SEP,parts[1],toc))
+        entries.sort()
+        self._dirs = {}
+        self._names = []
+        self._columns = [array.array("l") for _ in xrange(7)]
+        self._data = {}
+        self._added = {}
+        for (i,(dirnm,name,toc)) in enumerate(entries):
+            if isinstance(name,str):
+                name = intern(name)
+            self._names.append(name)
+            try:
+                for (column,value) in zip(self._columns,toc[1:8]):
+                    column.append(value)
+            except (OverflowError,TypeError):
+                raise ValueError("entry can't be stored compactly")
+            if len(toc) > 8:
+                self._data[i] = toc[8]
+            if dirnm in self._dirs:
+                self._dirs[dirnm][1] = i + 1
+            else:
+                if isinstance(dirnm,str):
+                    dirnm = intern(dirnm)
+                self._dirs[dirnm] = [i,i + 1]
+
+    def _find(self,key):
+        """Find the position of a key in the table, or -1 if not present."""
+        parts = key.rsplit(SEP,1)
+        if len(parts) == 1:
+            dirnm = ""
+            name = key
+        else:
+            dirnm = parts[0] + SEP
+            name = parts[1]
+        try:
+            (lo,hi) = self._dirs[dirnm]
+        except KeyError:
+            return -1
+        names = self._names
+        end = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names[mid] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and names[lo] == name:
+            return lo
+        return -1
+
+    def __getitem__(self,key):
+        i = self._find(key)
+        if i < 0:
+            return self._added[key]
+        toc = ("",) + tuple(column[i] for column in self._columns)
+        if i in self._data:
+            toc += (self._data[i],)
+        return toc
+
+    def __setitem__(self,key,value):
+        i = self._find(key)
+        if i < 0:
+            self._added[key] = value
+        else:
+            for (column,v) in zip(self._columns,value[1:8]):
+                column[i] = v
+            if len(value) > 8:
+                self._data[i] = value[8]
+            else:
+                self._data.pop(i,None)
+
+    def __contains__(self,key):
+        return self._find(key) >= 0 or key in self._added
+
+    def __len__(self):
+        return len(self._names) + len(self._added)
+
+    def iterkeys(self):
+        for (dirnm,(lo,hi)) in self._dirs.iteritems():
+            for i in xrange(lo,hi):
+                yield dirnm + self._names[i]
+        for key in self._added:
+            yield key
+
+
+def _compact_directory(files):
+    """Convert directory information to compact form, if possible.
+
+    Directory information that is already in a special-purpose form, or that
+    can't be stored compactly, is returned unchanged.
+    """
+    if isinstance(files,dict):
+        try:
+            files = _CompactDirectory(files)
+        except ValueError:
+            pass
+    return files
+
+
+class _InlineDirectory(_DirectoryMapping):
+    """Directory information for a zipfile inlined by get_inline_code().
+
+    This is a mapping object with the same interface as the dicts stored in
+    _zip_directory_cache, constructed from strings embedded in the generated
+    code.  The first is the zlib-compressed, marshalled dict of entries,
+    which is decoded up front.  The rest are zlib-compressed chunks holding
+    the uncompressed data for the files, concatenated together; each entry
+    gives the chunk holding its data in place of the archive path, and the
+    offset within that chunk.
+
+    The data for a file is only extracted when it's first accessed, and is
+    then kept as an ordinary in-memory TOC entry.  The most recently used
+    chunk is kept decompressed, since neighbouring files are often used
+    together, and each chunk is discarded once all of its files have been
+    extracted.  Extraction is done under a lock, since zlib releases the
+    GIL and several threads may be reading files at once.
+    """
+
+    #  Uncompressed size of the data chunks written by encode().
+    chunk_size = 64 * 1024
+
+    def __init__(self,directory,chunks):
+        global zlib
+        if zlib is None:
+            import zlib
+        self._entries = marshal.loads(zlib.decompress(directory))
+        self._files = {}
+        self._chunks = list(chunks)
+        self._remaining = [0] * len(self._chunks)
+        for toc in self._entries.itervalues():
+            self._remaining[toc[0]] += 1
+        self._last_chunk = (None,None)
+        try:
+            import thread
+        except ImportError:
+            import dummy_thread as thread
+        self._lock = thread.allocate_lock()
+
+    @classmethod
+    def encode(cls,files):
+        """Encode directory info including data as (directory,chunks) pair.
+
+        The data for each file is decompressed and the entries are marked as
+        uncompressed, so that each file is inflated at most once.
+        """
+        global zlib
+        if zlib is None:
+            import zlib
+        entries = {}
+        chunks = []
+        chunk = []
+        offset = 0
+        for key in sorted(files):
+            toc = files[key]
+            data = toc[8]
+            if toc[1]:
+                data = zlib.decompress(data,-15)
+            if offset and offset + len(data) > cls.chunk_size:
+                chunks.append(zlib.compress("".join(chunk),9))
+                chunk = []
+                offset = 0
+            entries[key] = (len(chunks),0,len(data),len(data),offset)+toc[5:8]
+            chunk.append(data)
+            offset += len(data)
+        chunks.append(zlib.compress("".join(chunk),9))
+        directory = zlib.compress(marshal.dumps(entries),9)
+        return (directory,tuple(chunks))
+
+    def _get_chunk(self,i):
+        (last,data) = self._last_chunk
+        if last != i:
+            data = zlib.decompress(self._chunks[i])
+            self._last_chunk = (i,data)
+        return data
+
+    def __getitem__(self,key):
+        try:
+            return self._files[key]
+        except KeyError:
+            pass
+        with self._lock:
+            #  Another thread may have extracted it while we waited.
+            try:
+                return self._files[key]
+            except KeyError:
+                pass
+            toc = self._entries[key]
+            i = toc[0]
+            offset = toc[4]
+            data = self._get_chunk(i)[offset:offset+toc[2]]
+            toc = ("",) + toc[1:] + (data,)
+            #  Store the file before removing its entry, so that lookups
+            #  without the lock always find it in one or the other.
+            self._files[key] = toc
+            self._forget_entry(key)
+        return toc
+
+    def _forget_entry(self,key):
+        """Remove an entry, discarding its chunk if no longer needed."""
+        toc = self._entries.pop(key,None)
+        if toc is not None:
+            i = toc[0]
+            self._remaining[i] -= 1
+            if not self._remaining[i]:
+                self._chunks[i] = None
+                if self._last_chunk[0] == i:
+                    self._last_chunk = (None,None)
+
+    def __setitem__(self,key,value):
+        with self._lock:
+            self._files[key] = value
+            self._forget_entry(key)
+
+    def __contains__(self,key):
+        return key in self._entries or key in self._files
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files) + len(self._entries)
+
+    def iterkeys(self):
+        with self._lock:
+            keys = self._files.keys() + self._entries.keys()
+        return iter(keys)
+
+
+def _hexlify(data):
+    """Encode a string as hex, without importing the "hex" codec."""
+    return "".join(["%02x" % (ord(c),) for c in data])
+
+
+def _get_archive_map(archive):
+    """Get the shared read-only memory map for the given archive file.
+
+    Each archive is opened and mapped at most once, and the mapping is shared
+    by every zipimporter for that archive, including those created for its
+    subdirectories.  If the archive can't be mapped then None is returned,
+    and the caller should fall back to reading the file directly.
+    """
+    try:
+        return _zip_archive_maps[archive]
+    except KeyError:
+        pass
+    global mmap
+    zmap = None
+    try:
+        if mmap is None:
+            import mmap
+        zf = open(archive,"rb")
+        try:
+            zmap = mmap.mmap(zf.fileno(),0,access=mmap.ACCESS_READ)
+        finally:
+            zf.close()
+    except (ImportError,EnvironmentError,ValueError,OverflowError):
+        #  The mapping is only an optimisation, so e.g. an empty file or
+        #  a platform without mmap just means reading it the slow way.
+        zmap = None
+    return _zip_archive_maps.setdefault(archive,zmap)
+
+
+def _forget_archive(archive):
+    """Forget everything that's been cached about the given archive."""
+    _zip_directory_cache.pop(archive,None)
+    _zip_archive_maps.pop(archive,None)
+    _zip_directory_info.pop(archive,None)
+    for (name,owner) in _zip_module_owners.items():
+        if owner == archive:
+            del _zip_module_owners[name]
+
+
+def _parse_local_header(header,offset=0):
+    """Parse a zipfile local file header found at the given offset.
+
+    Returns a tuple (signature,namelen,extralen), which is all we need to
+    know in order to locate the file data following the header.
+    """
+    global struct
+    if struct is None:
+        try:
+            import struct
+        except ImportError:
+            h = header[offset:offset+30]
+            if len(h) < 30:
+                return (None,0,0)
+            namelen = ord(h[26]) + (ord(h[27]) << 8)
+            extralen = ord(h[28]) + (ord(h[29]) << 8)
+            return (h[:4],namelen,extralen)
+    try:
+        return struct.unpack_from("<4s22xHH",header,offset)
+    except struct.error:
+        return (None,0,0)
+
+
+def _get_member_start(archive,zmap,offset):
+    """Get the offset of the data for the member with the given header offset.
+
+    This parses the local file header found in the archive's memory map, and
+    returns the offset at which the member's data begins.
+    """
+    sig,namelen,extralen = _parse_local_header(zmap,offset)
+    if sig != "PK\x03\x04":
+        err = "bad local file header in %s" % (archive,)
+        raise zipimport.ZipImportError(err)
+    return offset + 30 + namelen + extralen
+
+
+def _read_member(archive,offset,dsize):
+    """Read the raw data for the archive member at the given offset.
+
+    The returned data is exactly as stored in the archive, i.e. it may still
+    need to be decompressed.  If the archive is memory-mapped this is just a
+    single header parse and a slice; otherwise it's one seek and two reads.
+    """
+    zmap = _get_archive_map(archive)
+    if zmap is not None:
+        start = _get_member_start(archive,zmap,offset)
+        raw_data = zmap[start:start+dsize]
+    else:
+        zf = open(archive,"rb")
+        try:
+            zf.seek(offset)
+            sig,namelen,extralen = _parse_local_header(zf.read(30))
+            if sig != "PK\x03\x04":
+                err = "bad local file header in %s" % (archive,)
+                raise zipimport.ZipImportError(err)
+            zf.seek(offset + 30 + namelen + extralen)
+            raw_data = zf.read(dsize)
+        finally:
+            zf.close()
+    if len(raw_data) != dsize:
+        err = "zipimport: can't read data"
+        raise zipimport.ZipImportError(err)
+    return raw_data
+
+
+#  Members whose data is separated by less than this many bytes are read
+#  together in a single chunk, as are members up to this total chunk size.
+_prefetch_gap = 64 * 1024
+_prefetch_chunk = 8 * 1024 * 1024
+
+
+def _read_members(archive,members):
+    """Read the raw data for many archive members at once.
+
+    The members are given as a list of (key,toc) pairs.  They are read in
+    order of their offset in the archive, with nearby members coalesced into
+    a few large sequential reads.  A dict mapping each key to its raw data
+    is returned.
+    """
+    members = sorted(members,key=lambda m: m[1][4])
+    data = {}
+    if _get_archive_map(archive) is not None:
+        #  Slicing the mapping in offset order is already a forward scan.
+        for (key,toc) in members:
+            data[key] = _read_member(archive,toc[4],toc[2])
+        return data
+    #  Group members into chunks, estimating where each one ends.  The local
+    #  header may have a different extra field than the central directory,
+    #  so we allow some slack and re-read anything that overflows.
+    chunks = []
+    for (key,toc) in members:
+        start = toc[4]
+        end = start + 30 + len(key) + toc[2] + 256
+        if chunks:
+            (cstart,cend,cmembers) = chunks[-1]
+            if start - cend < _prefetch_gap and \
+               end - cstart < _prefetch_chunk:
+                chunks[-1] = (cstart,max(cend,end),cmembers)
+                cmembers.append((key,toc))
+                continue
+        chunks.append((start,end,[(key,toc)]))
+    zf = open(archive,"rb")
+    try:
+        for (cstart,cend,cmembers) in chunks:
+            zf.seek(cstart)
+            buf = zf.read(cend - cstart)
+            for (key,toc) in cmembers:
+                offset = toc[4] - cstart
+                dsize = toc[2]
+                sig,namelen,extralen = _parse_local_header(buf,offset)
+                if sig != "PK\x03\x04":
+                    err = "bad local file header in %s" % (archive,)
+                    raise zipimport.ZipImportError(err)
+                offset += 30 + namelen + extralen
+                raw_data = buf[offset:offset+dsize]
+                if len(raw_data) != dsize:
+                    raw_data = _read_member(archive,toc[4],dsize)
+                data[key] = raw_data
+    finally:
+        zf.close()
+    return data
+
+
+#  The end-of-central-directory record may be followed by a comment of up to
+#  64k, and preceded by a 20-byte zip64 locator and 56-byte zip64 record.
+_eocd_search = 22 + 65535 + 20 + 56
+
+
+def _find_end_records(zf):
+    """Find the end-of-central-directory records of an open zipfile.
+
+    Returns a tuple (count,cdsize,cdend,arc_offset) giving the number of
+    entries and size of the central directory, the position at which it
+    ends (i.e. where the end records begin) and the size of any data that
+    has been prepended to the zipfile.  Returns None if they're not found.
+    """
+    zf.seek(0,2)
+    tailsize = min(zf.tell(),_eocd_search)
+    zf.seek(-tailsize,2)
+    tailstart = zf.tell()
+    tail = zf.read(tailsize)
+    #  Find the record, making sure it's not a stray match in a comment.
+    pos = tail.rfind("PK\x05\x06")
+    while pos >= 0:
+        if len(tail) - pos >= 22:
+            (commentlen,) = struct.unpack_from("<H",tail,pos+20)
+            if pos + 22 + commentlen == len(tail):
+                break
+        pos = tail.rfind("PK\x05\x06",0,pos)
+    if pos < 0:
+        return None
+    (count,cdsize,cdoffset) = struct.unpack_from("<10xHII",tail,pos)
+    if pos >= 20 and tail[pos-20:pos-16] == "PK\x06\x07":
+        #  The zip64 record must directly precede its locator, which
+        #  directly precedes the end-of-central-directory record.
+        pos -= 20 + 56
+        if pos < 0 or tail[pos:pos+4] != "PK\x06\x06":
+            return None
+        (count,cdsize,cdoffset) = struct.unpack_from("<32xQQQ",tail,pos)
+    cdend = tailstart + pos
+    arc_offset = cdend - cdsize - cdoffset
+    if arc_offset < 0:
+        return None
+    return (count,cdsize,cdend,arc_offset)
+
+
+def _get_fingerprint(archive):
+    """Get a fingerprint of the current state of the given zipfile.
+
+    The fingerprint is a tuple (size,cdend,tail,cdcrc) giving the size of the
+    file, the position of its end-of-central-directory records, the exact
+    bytes of those records, and the CRC of its central directory.  Returns
+    None if the zipfile can't be parsed.
+    """
+    global struct, zlib
+    if struct is None:
+        try:
+            import struct
+        except ImportError:
+            return None
+    if zlib is None:
+        import zlib
+    zf = open(archive,"rb")
+    try:
+        end = _find_end_records(zf)
+        if end is None:
+            return None
+        (count,cdsize,cdend,arc_offset) = end
+        zf.seek(cdend - cdsize)
+        cdcrc = zlib.crc32(zf.read(cdsize)) & 0xFFFFFFFF
+        tail = zf.read()
+    finally:
+        zf.close()
+    return (cdend + len(tail),cdend,tail,cdcrc)
+
+
+def _check_fingerprint(archive,fingerprint,thorough=False):
+    """Check whether a zipfile still matches a fingerprint taken earlier.
+
+    By default this checks only the size of the file and its end records,
+    which costs a single small read.  Adding, removing or resizing files
+    moves the central directory and so changes these, but rewriting a file
+    in place with data of exactly the same size does not, and won't be
+    detected.  If "thorough" is true then the central directory is also
+    read and its CRC checked, which covers the CRC and modification time
+    of every file.  A fingerprint of None always matches, so that indexes
+    written by older versions are still used.
+    """
+    if fingerprint is None:
+        return True
+    (size,cdend,tail,cdcrc) = fingerprint
+    if thorough:
+        try:
+            return _get_fingerprint(archive) == fingerprint
+        except EnvironmentError:
+            return False
+    try:
+        zf = open(archive,"rb")
+        try:
+            zf.seek(0,2)
+            if zf.tell() != size:
+                return False
+            zf.seek(cdend)
+            return zf.read(len(tail)) == tail
+        finally:
+            zf.close()
+    except EnvironmentError:
+        return False
+
+
+def _read_directory(archive):
+    """Read the directory of a zipfile, without using the zipimport module.
+
+    This locates the end-of-central-directory record, reads the entire
+    central directory in a single read, and unpacks each entry directly
+    from that buffer.  Unlike the builtin implementation, it handles zip64
+    archives as well as archive comments.  Data prepended to the zipfile
+    (e.g. a self-extracting stub) is accounted for in the offsets.
+
+    Returns a dict in the same format as the values of _zip_directory_cache,
+    or None if the file can't be parsed this way and the caller should fall
+    back to the builtin implementation.
+    """
+    global struct
+    if struct is None:
+        try:
+            import struct
+        except ImportError:
+            return None
+    zf = open(archive,"rb")
+    try:
+        end = _find_end_records(zf)
+        if end is None:
+            return None
+        (count,cdsize,cdend,arc_offset) = end
+        zf.seek(cdend - cdsize)
+        cd = zf.read(cdsize)
+    finally:
+        zf.close()
+    if len(cd) != cdsize:
+        return None
+    unpack = struct.Struct("<4s6xHHHIIIHHH8xI").unpack_from
+    files = {}
+    prefix = archive + SEP
+    fixsep = (SEP != "/")
+    offset = 0
+    try:
+        for _ in xrange(count):
+            (sig,compress,mtime,mdate,crc,dsize,fsize,
+             namelen,extralen,commentlen,hoffset) = unpack(cd,offset)
+            if sig != "PK\x01\x02":
+                return None
+            offset += 46
+            name = cd[offset:offset+namelen]
+            offset += namelen
+            if 0xFFFFFFFF in (dsize,fsize,hoffset):
+                extra = cd[offset:offset+extralen]
+                (fsize,dsize,hoffset) = _parse_zip64_extra(extra,fsize,
+                                                           dsize,hoffset)
+            offset += extralen + commentlen
+            if fixsep:
+                name = name.replace("/",SEP)
+            files[name] = (prefix+name,compress,dsize,fsize,
+                           hoffset+arc_offset,mtime,mdate,crc)
+    except struct.error:
+        return None
+    return files
+
+
+def _parse_zip64_extra(extra,fsize,dsize,hoffset):
+    """Get the true sizes and offset of a zip64 member from its extra field.
+
+    Each of the given values that's saturated at 0xFFFFFFFF is replaced by
+    the next 64-bit value from the zip64 extended information field.
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        (tag,size) = struct.unpack_from("<HH",extra,pos)
+        pos += 4
+        if tag == 1:
+            values = list(struct.unpack_from("<%dQ" % (size // 8,),extra,pos))
+            values.reverse()
+            if fsize == 0xFFFFFFFF:
+                fsize = values.pop()
+            if dsize == 0xFFFFFFFF:
+                dsize = values.pop()
+            if hoffset == 0xFFFFFFFF:
+                hoffset = values.pop()
+            break
+        pos += size
+    return (fsize,dsize,hoffset)
+
+
+def _strip_zip64_extra(extra):
+    """Remove any zip64 extended information field from an extra field.
+
+    This is needed when copying a member into a new zipfile, since the
+    zipfile module adds its own zip64 field to the header as required.
+    """
+    pos = 0
+    fields = []
+    while pos + 4 <= len(extra):
+        (tag,size) = struct.unpack_from("<HH",extra,pos)
+        if tag != 1:
+            fields.append(extra[pos:pos+4+size])
+        pos += 4 + size
+    return "".join(fields)
+
+
+def _copy_raw_member(zf,zinfo,out,newinfo):
+    """Copy the data of a zipfile member without decompressing it.
+
+    The raw data for "zinfo" in ZipFile "zf" is appended to ZipFile "out"
+    as the member "newinfo", which must already have its fields filled in.
+    This mirrors what ZipFile.writestr() does after compressing the data.
+    """
+    zf.fp.seek(zinfo.header_offset)
+    (sig,namelen,extralen) = _parse_local_header(zf.fp.read(30))
+    if sig != "PK\x03\x04":
+        err = "bad local file header for %s" % (zinfo.filename,)
+        raise zipimport.ZipImportError(err)
+    zf.fp.seek(zinfo.header_offset + 30 + namelen + extralen)
+    raw_data = zf.fp.read(zinfo.compress_size)
+    newinfo.header_offset = out.fp.tell()
+    out._writecheck(newinfo)
+    out._didModify = True
+    zip64 = newinfo.file_size > 0x7FFFFFFF or \
+            newinfo.compress_size > 0x7FFFFFFF
+    out.fp.write(newinfo.FileHeader(zip64))
+    out.fp.write(raw_data)
+    if newinfo.flag_bits & 0x08:
+        #  Keep the data descriptor, since the flags say it's there.
+        fmt = zip64 and "<LLQQ" or "<LLLL"
+        out.fp.write(struct.pack(fmt,0x08074b50,newinfo.CRC,
+                                 newinfo.compress_size,newinfo.file_size))
+    out.filelist.append(newinfo)
+    out.NameToInfo[newinfo.filename] = newinfo
+
+
+def _precompile_modules(task):
+    """Precompile some of the modules in a zipfile, in a worker process.
+
+    The task is a tuple (archive,pathheads,platform).  This is a function
+    rather than a method so that it can be passed to a multiprocessing pool.
+    """
+    (archive,pathheads,platform) = task
+    return zipimporter(archive)._precompile_modules(pathheads,platform)
+
+
+def _get_ready_code(key):
+    """Take the code prepared in advance for the module with the given key.
+
+    If a warmup thread is currently preparing the code, this waits for it
+    to finish.  If the module is queued for warmup but not yet started, it
+    is removed from the queue so that the caller can prepare it directly.
+    Returns a tuple (code,filepath,ispkg), or None if there's no such code.
+
+    The caller may be holding the import lock while it waits, which is why
+    the warmup threads must never import anything.
+    """
+    if _zip_warmup:
+        with _zip_warmup_lock:
+            lock = _zip_warmup.get(key)
+            if lock is True:
+                del _zip_warmup[key]
+        if lock is not None and lock is not True:
+            lock.acquire()
+            lock.release()
+    return _zip_code_cache.pop(key,None)
+
+
+class _WarmupTask(object):
+    """Background preparation of module code by a pool of threads.
+
+    This is the object returned by zipimporter.warmup().  Each thread takes
+    module names from a shared queue, prepares the code for that module and
+    stores it in _zip_code_cache, where it will be found by load_module().
+    """
+
+    def __init__(self,importer,names,threads):
+        global _zip_warmup_lock
+        try:
+            import threading  # not a builtin, import only as needed
+        except ImportError:
+            import dummy_threading as threading
+        self._threading = threading
+        if _zip_warmup_lock is None:
+            _zip_warmup_lock = threading.Lock()
+        self.importer = importer
+        self._queue = []
+        with _zip_warmup_lock:
+            for name in names:
+                #  Key each module by its full path, as load_module() will
+                #  on the importer for its package.  If this importer is
+                #  for that package already, the path is within its prefix.
+                parts = name.split(".")
+                pkgpath = SEP.join(parts[:-1])
+                if pkgpath and importer.prefix.endswith(pkgpath + SEP):
+                    pathhead = importer.prefix + parts[-1]
+                else:
+                    pathhead = importer.prefix + SEP.join(parts)
+                key = (importer.archive,pathhead)
+                if key not in _zip_warmup and key not in _zip_code_cache:
+                    _zip_warmup[key] = True
+                    self._queue.append(key)
+        #  Threads pop from the end, so reverse to process in given order.
+        self._queue.reverse()
+        self._threads = []
+        if self._queue:
+            for _ in xrange(max(1,min(threads,len(self._queue)))):
+                t = threading.Thread(target=self._run,name="zipimportx-warmup")
+                #  Don't hold up interpreter exit for code nobody will use.
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _run(self):
+        while True:
+            try:
+                key = self._queue.pop()
+            except IndexError:
+                break
+            self._prepare(key)
+
+    def _prepare(self,key):
+        with _zip_warmup_lock:
+            if _zip_warmup.get(key) is not True:
+                #  Already claimed by an import, nothing to do.
+                return
+            lock = self._threading.Lock()
+            lock.acquire()
+            _zip_warmup[key] = lock
+        code = None
+        try:
+            try:
+                code = self.importer._get_path_code(key[1],warmup=True)
+            except Exception:
+                #  Leave it for load_module() to report the error.
+                code = None
+        finally:
+            with _zip_warmup_lock:
+                _zip_warmup.pop(key,None)
+                if code is not None:
+                    _zip_code_cache[key] = code
+            lock.release()
+
+    def wait(self):
+        """Wait for all queued modules to be prepared."""
+        for t in self._threads:
+            t.join()
+
+
+class DataCache(object):
+    """A size-bounded LRU cache of decompressed file data.
+
+    An instance of this class can be assigned to zipimporter.data_cache in
+    order to cache the results of get_data(), so that files that are read
+    repeatedly (e.g. templates or certificates loaded via pkgutil.get_data)
+    are not decompressed every time.  The cache holds at most "max_bytes"
+    bytes of data, discarding the least-recently-used files to make room.
+
+    The attributes "hits", "misses" and "evictions" count the number of
+    times each of these events has occurred, and "size" gives the number of
+    bytes currently in the cache.
+    """
+
+    def __init__(self,max_bytes=16*1024*1024):
+        try:
+            import thread
+        except ImportError:
+            import dummy_thread as thread
+        self.max_bytes = max_bytes
+        self._lock = thread.allocate_lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all data from the cache and reset the counters."""
+        with self._lock:
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            #  Entries are [prev,next,key,data] links in a circular list,
+            #  with the most recently used entry just after the root.
+            self._root = root = [None,None,None,None]
+            root[0] = root[1] = root
+            self._links = {}
+
+    def get(self,key):
+        """Get the data cached under the given key, or None if not present."""
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._unlink(link)
+            self._link(link)
+            return link[3]
+
+    def put(self,key,data):
+        """Store data in the cache under the given key.
+
+        If the data is larger than the whole cache, it is not stored.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            link = self._links.pop(key,None)
+            if link is not None:
+                self._unlink(link)
+                self.size -= len(link[3])
+            while self._links and self.size + len(data) > self.max_bytes:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+                self.size -= len(oldest[3])
+                self.evictions += 1
+            link = [None,None,key,data]
+            self._link(link)
+            self._links[key] = link
+            self.size += len(data)
+
+    def _link(self,link):
+        root = self._root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def _unlink(self,link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self,key):
+        return key in self._links
+
+
+class ProfileNode(object):
+    """A node in the tree of module loads recorded by start_profile().
+
+    Each node records the name of the module and the archive it was loaded
+    from, the nodes for any modules loaded while executing it, the total time
+    taken to load it including those modules, and the statistics counters
+    for the work done on its behalf as described in start_stats().
+
+    The time spent by zipimportx to get the module's code (reading the data,
+    decompressing, unmarshalling or compiling) is given by the "overhead"
+    property, and the remaining time spent executing the module body itself
+    by the "exec_time" property.  The root node of the tree has no name, and
+    covers the whole time that the profile was running.
+    """
+
+    #  Counters giving the breakdown of the overhead, and labels for them.
+    phases = (("read_time","read"),
+              ("inflate_time","inflate"),
+              ("unmarshal_time","unmarshal"),
+              ("compile_time","compile"),)
+
+    def __init__(self,name=None,archive=None):
+        self.name = name
+        self.archive = archive
+        self.children = []
+        self.counters = {}
+        self.total_time = 0.0
+
+    @property
+    def self_time(self):
+        """Time taken by this module, excluding its child modules."""
+        return self.total_time - sum(c.total_time for c in self.children)
+
+    @property
+    def overhead(self):
+        """Time spent by zipimportx getting the code for this module."""
+        return self.counters.get("code_time",0.0)
+
+    @property
+    def exec_time(self):
+        """Time spent executing this module, excluding child modules."""
+        return self.self_time - self.overhead
+
+    def walk(self,depth=0):
+        """Iterate over (depth,node) pairs for this node and its children."""
+        yield (depth,self)
+        for child in self.children:
+            for item in child.walk(depth + 1):
+                yield item
+
+    def format_tree(self):
+        """Format the tree of module loads as text, with times in ms.
+
+        Each line gives the cumulative time for the module and its children,
+        its self time, how much of that was zipimportx overhead and how much
+        was spent executing the module body, then the breakdown of overhead.
+        """
+        lines = ["%10s %10s %10s %10s  %s" % ("total","self","zipimportx",
+                                               "exec","module",)]
+        for (depth,node) in self.walk():
+            if node.name is None:
+                name = "<all>"
+            else:
+                name = "  " * (depth - 1) + node.name
+            phases = []
+            for (counter,label) in self.phases:
+                value = node.counters.get(counter)
+                if value:
+                    phases.append("%s=%.3f" % (label,value * 1000,))
+            if phases:
+                name += "  (%s)" % (" ".join(phases),)
+            lines.append("%10.3f %10.3f %10.3f %10.3f  %s" % (
+                         node.total_time * 1000,node.self_time * 1000,
+                         node.overhead * 1000,node.exec_time * 1000,name,))
+        return "\n".join(lines) + "\n"
+
+    def format_collapsed(self):
+        """Format the tree of module loads as collapsed stacks.
+
+        This is the format understood by flamegraph tools: one line for each
+        stack of module names, separated by semicolons, followed by its self
+        time in microseconds.  The zipimportx overhead for each module is
+        shown as a separate "[zipimportx]" frame on top of it.
+        """
+        lines = []
+        self._format_collapsed([],lines)
+        return "\n".join(lines) + "\n"
+
+    def _format_collapsed(self,stack,lines):
+        if self.name is not None:
+            stack = stack + [self.name]
+            exec_time = int(self.exec_time * 1000000)
+            overhead = int(self.overhead * 1000000)
+            if exec_time > 0:
+                lines.append("%s %d" % (";".join(stack),exec_time,))
+            if overhead > 0:
+                frames = ";".join(stack + ["[zipimportx]"])
+                lines.append("%s %d" % (frames,overhead,))
+        for child in self.children:
+            child._format_collapsed(stack,lines)
+
+
+class _ResourceFile(object):
+    """A read-only file-like object streaming the data of an archive member.
+
+    Data is read from the archive in chunks and decompressed incrementally,
+    so that large members can be processed without holding the whole of
+    their data in memory.  Seeking is cheap for stored members, but must be
+    emulated by decompressing from the start for compressed members.
+    """
+
+    mode = "rb"
+    chunk_size = 64 * 1024
+
+    def __init__(self,archive,name,toc):
+        self.name = name
+        self.closed = False
+        (self._compress,self._dsize,self._fsize) = toc[1:4]
+        self._file = None
+        if len(toc) > 8:
+            self._raw = toc[8]
+            self._start = 0
+        else:
+            self._raw = _get_archive_map(archive)
+            if self._raw is not None:
+                self._start = _get_member_start(archive,self._raw,toc[4])
+            else:
+                self._file = open(archive,"rb")
+                self._file.seek(toc[4])
+                header = self._file.read(30)
+                sig,namelen,extralen = _parse_local_header(header)
+                if sig != "PK\x03\x04":
+                    self.close()
+                    err = "bad local file header in %s" % (archive,)
+                    raise zipimport.ZipImportError(err)
+                self._start = toc[4] + 30 + namelen + extralen
+        self._rewind()
+
+    def _rewind(self):
+        global zlib
+        self._pos = 0
+        self._rawpos = 0
+        self._buffer = ""
+        self._tail = ""
+        if self._compress:
+            if zlib is None:
+                import zlib
+            self._inflater = zlib.decompressobj(-15)
+
+    def _read_raw(self,size):
+        """Read up to size bytes of raw data from the member."""
+        size = min(size,self._dsize - self._rawpos)
+        start = self._start + self._rawpos
+        if self._file is not None:
+            self._file.seek(start)
+            raw = self._file.read(size)
+        else:
+            raw = self._raw[start:start+size]
+        self._rawpos += len(raw)
+        return raw
+
+    def _at_eof(self):
+        """Check whether all the raw data has been read and decompressed."""
+        return self._rawpos >= self._dsize and not self._tail
+
+    def _fill(self,size):
+        """Fill the buffer with at least size bytes, unless at EOF.
+
+        Compressed data is only inflated as far as needed, with any input
+        left over kept for the next call, so that a short read doesn't
+        inflate a whole chunk into memory.
+        """
+        while size < 0 or len(self._buffer) < size:
+            if self._at_eof():
+                break
+            if self._tail:
+                raw = self._tail
+            else:
+                raw = self._read_raw(self.chunk_size)
+                if not raw:
+                    break
+            if self._compress:
+                if size < 0:
+                    data = self._inflater.decompress(raw)
+                else:
+                    needed = size - len(self._buffer)
+                    data = self._inflater.decompress(raw,needed)
+                self._tail = self._inflater.unconsumed_tail
+                self._buffer += data
+                if self._at_eof():
+                    self._buffer += self._inflater.flush()
+            else:
+                self._buffer += raw
+
+    def read(self,size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data = self._buffer
+            self._buffer = ""
+        else:
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+        self._pos += len(data)
+        return data
+
+    def readinto(self,b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self,size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        while "\n" not in self._buffer:
+            if self._at_eof():
+                break
+            if 0 <= size <= len(self._buffer):
+                break
+            self._fill(len(self._buffer) + 1)
+        end = self._buffer.find("\n") + 1
+        if end == 0:
+            end = len(self._buffer)
+        if 0 <= size < end:
+            end = size
+        return self.read(end)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self._pos
+
+    def seek(self,offset,whence=0):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._fsize
+        if offset < 0:
+            raise IOError("negative seek position")
+        offset = min(offset,self._fsize)
+        if not self._compress:
+            self._pos = self._rawpos = offset
+            self._buffer = ""
+        else:
+            if offset < self._pos:
+                self._rewind()
+            while self._pos < offset:
+                if not self.read(min(offset - self._pos,self.chunk_size)):
+                    break
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._raw = None
+        self._buffer = ""
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
 
 
 class zipimporter(zipimport.zipimporter):
@@ -143,6 +1928,27 @@ class zipimporter(zipimport.zipimporter):
     directory information isused instead of parsing it out of the zipfile.
     """
 
+    #  Set this to True to keep directory information for newly-opened
+    #  archives in compact array-backed form, trading a little lookup speed
+    #  for much lower memory use per entry.
+    compact_directory = False
+
+    #  Set this to a DataCache instance to cache the results of get_data().
+    data_cache = None
+
+    #  Set this to False to trust index files without checking that the
+    #  zipfile still matches the fingerprint they were written with.
+    verify_index = True
+
+    #  Set this to the path of a writable directory to cache code compiled
+    #  from source, for modules with missing or stale bytecode.
+    code_cache_dir = None
+
+    #  Set this to True to parse the central directory of unindexed archives
+    #  in pure python rather than with the builtin zipimport module.  It's
+    #  always used for archives that zipimport can't handle.
+    python_directory = False
+
     def __init__(self,archivepath):
         cached_files = None
         #  Check if we're given a path in an already-loaded zipfile, and
@@ -164,22 +1970,46 @@ class zipimporter(zipimport.zipimporter):
         #  from an index file.  In the unlikely event that we're given a path
         #  pointing inside an uncached zipfile, the check will raise EnvError
         #  and fall back to the default zipimport machinery.
+        timed = (_zip_stats is not None)
+        if timed:
+            start = time.time()
         if cached_files is None:
             prefix = ""
+            #  Any existing mapping of the archive is from an earlier load
+            #  that has since been purged from the directory cache.
+            _zip_archive_maps.pop(archivepath,None)
+            _zip_directory_info.pop(archivepath,None)
             try:
-                with open(archivepath + archive_index,"rb") as f:
-                    cached_files = marshal.load(f)
+                index = _load_index(archivepath + archive_index)
             except EnvironmentError:
-                pass
-            else:
-                for path in cached_files.keys():
-                    if SEP in path:
-                        break
-                    if BADSEP in path:
-                        cached_files = None
-                        break
-                if cached_files is not None:
-                    _zip_directory_cache[archivepath] = cached_files
+                index = None
+            #  Ignore the index if the zipfile has changed since it was
+            #  written, rather than trusting information that's now wrong.
+            if index is not None and self.verify_index:
+                fingerprint = index[1].get("fingerprint")
+                if not _check_fingerprint(archivepath,fingerprint):
+                    index = None
+            if timed and index is not None:
+                _record_stat(archivepath,"index_loads")
+            #  Without an index, parse the zipfile ourselves if asked to.
+            #  Otherwise the builtin implementation is faster.
+            if index is None and self.python_directory:
+                try:
+                    files = _read_directory(archivepath)
+                except EnvironmentError:
+                    pass
+                else:
+                    if files is not None:
+                        index = (files,{})
+            if index is not None:
+                (cached_files,info) = index
+                if self.compact_directory:
+                    cached_files = _compact_directory(cached_files)
+                _zip_directory_cache[archivepath] = cached_files
+                _zip_directory_info[archivepath] = info
+                if timed:
+                    _record_stat(archivepath,"directory_time",
+                                 time.time() - start)
         #  If the archive is in the cache, we bypass the default implementation
         #  since it wants to keep checking the filesystem for things we know
         #  (well, OK, *assume*) are still there.
@@ -187,12 +2017,59 @@ class zipimporter(zipimport.zipimporter):
         #  down inside the c-level zipimporter, so we have to re-implement a
         #  host of its functionality.
         if cached_files is None:
-            zipimport.zipimporter.__init__(self,archivepath)
+            #  The builtin implementation can't handle zipfiles with a
+            #  comment, and may misread zip64 archives as being empty.
+            #  We might be able to do better in those cases.
+            files = None
+            try:
+                zipimport.zipimporter.__init__(self,archivepath)
+            except zipimport.ZipImportError:
+                err = sys.exc_info()
+                files = self._read_unsupported_directory(archivepath)
+                if files is None:
+                    raise err[0],err[1],err[2]
+            else:
+                if not zipimport.zipimporter._files.__get__(self):
+                    files = self._read_unsupported_directory(archivepath)
+                    if not files:
+                        files = None
+            if files is not None:
+                if self.compact_directory:
+                    files = _compact_directory(files)
+                _zip_directory_cache[archivepath] = files
+                _zip_directory_info[archivepath] = {}
+                self.__dict__["archive"] = archivepath
+                self.__dict__["prefix"] = ""
+                self.__dict__["_files"] = files
+            else:
+                _zip_archive_maps.pop(self.archive,None)
+                _zip_directory_info.pop(self.archive,None)
+                if self.compact_directory:
+                    files = _zip_directory_cache[self.archive]
+                    files = _compact_directory(files)
+                    _zip_directory_cache[self.archive] = files
+                    #  Don't let this importer keep using the full dict.
+                    self.__dict__["_files"] = files
+            if timed:
+                _record_stat(self.archive,"directory_time",time.time() - start)
         else:
             self.__dict__["archive"] = archivepath
             self.__dict__["prefix"] = prefix
             self.__dict__["_files"] = cached_files
 
+    def _read_unsupported_directory(self,archivepath):
+        """Helper method to read a directory the builtin zipimport can't.
+
+        This returns the directory parsed by _read_directory(), or None if
+        the file can't be parsed or has already been parsed that way.
+        """
+        if self.python_directory:
+            return None
+        try:
+            return _read_directory(archivepath)
+        except EnvironmentError:
+            return None
+
     @property
     def archive(self):
         try:
@@ -248,13 +2125,37 @@ class zipimporter(zipimport.zipimporter):
 
         """
         pathhead = self.prefix + fullname.rsplit(".",1)[-1] 
+        found = self._find_module_path(pathhead)
+        if found is None:
+            return None
+        if found[1]:
+            return self.MI_PACKAGE
+        else:
+            return self.MI_MODULE
+
+    def _find_module_path(self,pathhead):
+        """Helper method to find the file for a module given its path.
+
+        Given the path of a module relative to the archive root but without
+        any suffix, this method returns a tuple (path,ispkg,isbytecode) for
+        the first file found in search order, or None if there is no such
+        module.  If the index has a lookup table, it's used in place of
+        probing self._files for each possible suffix.
+        """
+        info = _zip_directory_info.get(self.archive)
+        if info is not None:
+            lookup = info.get("lookup")
+            if lookup is not None:
+                flags = lookup.get(pathhead)
+                if flags is not None:
+                    for suffix,ispkg,iscode in self._zip_searchorder:
+                        if flags & _zip_suffix_flags[suffix]:
+                            return (pathhead + suffix,ispkg,iscode)
+                return None
         for suffix,ispkg,iscode in self._zip_searchorder:
             path = pathhead + suffix
             if path in self._files:
-                if ispkg:
-                    return self.MI_PACKAGE
-                else:
-                    return self.MI_MODULE
+                return (path,ispkg,iscode)
         return None
 
     def _get_module_code(self,fullname):
@@ -267,41 +2168,138 @@ class zipimporter(zipimport.zipimporter):
         If the named module is not found, ZipImportError is raised.
         """
         pathhead = self.prefix + fullname.rsplit(".",1)[-1] 
-        for suffix,ispkg,isbytecode in self._zip_searchorder:
-            path = pathhead + suffix
+        #  Use any code that was prepared in advance by warmup().
+        if _zip_warmup or _zip_code_cache:
+            code = _get_ready_code((self.archive,pathhead))
+            if code is not None:
+                return code
+        code = self._get_path_code(pathhead)
+        if code is None:
+            err = "can't find module '%s'" % (fullname,)
+            raise zipimport.ZipImportError(err)
+        return code
+
+    def _get_path_code(self,pathhead,warmup=False):
+        """Helper method to get the code for a module given its path.
+
+        This does the real work of _get_module_code(), searching for files
+        at the given path relative to the archive root, validating bytecode
+        and falling back to source as necessary.  It returns a tuple
+        (code,filepath,ispkg) or None if the module isn't found.
+
+        If "warmup" is true, this is being called from a warmup thread and
+        raises ZipImportError rather than do anything that might import.
+        """
+        #  If the index has pre-validated code for the module, that's all
+        #  we need; otherwise go looking for it in the zipfile.
+        try:
+            modules = _zip_directory_info[self.archive]["modules"]
+            (path,ispkg,payload) = modules[pathhead]
+        except KeyError:
+            pass
+        else:
+            if _zip_stats is not None:
+                _record_stat(self.archive,"precompiled_hits")
+            return (marshal.loads(payload),self.archive + SEP + path,ispkg)
+        found = self._find_module_path(pathhead)
+        if found is None:
+            return None
+        (path,ispkg,isbytecode) = found
+        toc = self._files[path]
+        #  Validate the bytecode, fall back to source if necessary
+        if isbytecode:
+            data = self._get_buffer(path,toc)
+            srcpath = path[:-1] 
             try:
-                toc = self._files[path]
+                srctoc = self._files[srcpath]
             except KeyError:
-                pass
+                srctoc = None
+            if len(data) < 9:
+                isbytecode,path,toc = False,srcpath,srctoc
+            elif data[:4] != imp.get_magic():
+                isbytecode,path,toc = False,srcpath,srctoc
             else:
-                #  Validate the bytecode, fall back to source if necessary
-                if isbytecode:
-                    data = self._get_data(path,toc)
-                    srcpath = path[:-1] 
-                    try:
-                        srctoc = self._files[srcpath]
-                    except KeyError:
-                        srctoc = None
-                    if len(data) < 9:
-                        isbytecode,path,toc = False,srcpath,srctoc
-                    elif data[:4] != imp.get_magic():
-                        isbytecode,path,toc = False,srcpath,srctoc
-                    else:
-                        if not self._check_mtime(data[4:8],srctoc):
-                            isbytecode,path,toc = False,srcpath,srctoc
-                        else:
-                            code = marshal.loads(data[8:])
-                #  Compile the source down to bytecode if necessary
-                filepath = self.archive + SEP + path
-                if toc is None:
-                    break
-                if not isbytecode:
-                    data = self._get_data(path,toc)
-                    data = data.replace("\r\n","\n")
-                    code = compile(data,filepath,"exec")
-                return code,filepath,ispkg
-        err = "can't find module '%s'" % (fullname,)
-        raise zipimport.ZipImportError(err)
+                if not self._check_mtime(data[4:8],srctoc):
+                    isbytecode,path,toc = False,srcpath,srctoc
+                elif _zip_stats is None:
+                    code = marshal.loads(buffer(data,8))
+                else:
+                    start = time.time()
+                    code = marshal.loads(buffer(data,8))
+                    _record_stat(self.archive,"unmarshals")
+                    _record_stat(self.archive,"unmarshal_time",
+                                 time.time() - start)
+            if not isbytecode and _zip_stats is not None:
+                _record_stat(self.archive,"source_fallbacks")
+        #  Compile the source down to bytecode if necessary
+        filepath = self.archive + SEP + path
+        if toc is None:
+            return None
+        if not isbytecode:
+            timed = (_zip_stats is not None)
+            if timed:
+                start = time.time()
+            code = self._compile_source(path,toc,filepath,warmup)
+            if timed:
+                _record_stat(self.archive,"compiles")
+                _record_stat(self.archive,"compile_time",time.time() - start)
+        return code,filepath,ispkg
+
+    def _compile_source(self,path,toc,filepath,warmup=False):
+        """Helper method to compile the source code for a module.
+
+        If self.code_cache_dir is set, the compiled code is cached in that
+        directory and re-used by later calls, even in other processes.  The
+        cache is keyed by the full path of the file, the CRC of its data and
+        the bytecode magic number and optimisation level of the running
+        interpreter.
+        """
+        cachedir = self.code_cache_dir
+        if cachedir is not None:
+            global zlib
+            if zlib is None:
+                import zlib
+            #  Code compiled with -O has no asserts, so keep it separate.
+            if __debug__:
+                suffix = ".pyc"
+            else:
+                suffix = ".pyo"
+            cachefile = "%08x-%08x-%s%s" % (zlib.crc32(filepath)&0xFFFFFFFF,
+                                            toc[7] & 0xFFFFFFFF,
+                                            _hexlify(imp.get_magic()),
+                                            suffix,)
+            cachefile = cachedir + SEP + cachefile
+            try:
+                with open(cachefile,"rb") as f:
+                    return marshal.load(f)
+            except (EnvironmentError,EOFError,ValueError,TypeError):
+                pass
+        data = self._get_data(path,toc)
+        #  Compiling source with an encoding declaration imports its codec.
+        if warmup and "coding" in "\n".join(data.split("\n",2)[:2]):
+            err = "can't compile '%s' during warmup" % (filepath,)
+            raise zipimport.ZipImportError(err)
+        data = data.replace("\r\n","\n")
+        code = compile(data,filepath,"exec")
+        if cachedir is not None:
+            #  Write to a temp file and rename it into place, so that other
+            #  processes never see a partially-written cache file.
+            global os
+            if os is None:
+                import os
+            tempfile = "%s.%d.tmp" % (cachefile,os.getpid())
+            try:
+                with open(tempfile,"wb") as f:
+                    marshal.dump(code,f)
+                try:
+                    os.rename(tempfile,cachefile)
+                except EnvironmentError:
+                    #  On win32 we can't rename over an existing file, but
+                    #  if it exists then another process has just cached it.
+                    os.unlink(tempfile)
+            except EnvironmentError:
+                pass
+        return code
 
     def _check_mtime(self,mtbytes,srctoc):
         """Helper method to check the mtime of a bytecode file.
@@ -346,32 +2344,24 @@ class zipimporter(zipimport.zipimporter):
             toc = self._files.get(path)
             if toc is None:
                 return None
+        if _zip_trace is not None:
+            _zip_trace.setdefault((self.archive,path),len(_zip_trace))
         filenm,compress,dsize,fsize,offset,mtime,mdate,crc = toc[:8]
+        timed = (_zip_stats is not None)
         #  In-memory data may appear as an extra field on the toc tuple.
         #  If not, we have to read it from the zipfile.
         if len(toc) > 8:
             raw_data = toc[8]
+            if timed:
+                _record_stat(self.archive,"preload_hits")
+        elif not timed:
+            raw_data = _read_member(self.archive,offset,dsize)
         else:
-            zf = open(self.archive,"rb")
-            try:
-                zf.seek(offset)
-                # validate local file header
-                if zf.read(4) != "PK\x03\x04":
-                    err = "bad local file header in %s" % (self.archive,)
-                    raise zipimport.ZipImportError(err)
-                # skip TOC stuff that we already know
-                zf.read(22)
-                # read file name length and extras length, then skip over them
-                namelen = ord(zf.read(1)) + (ord(zf.read(1)) << 8) 
-                extralen = ord(zf.read(1)) + (ord(zf.read(1)) << 8) 
-                zf.read(namelen+extralen)
-                # now we can read the data
-                raw_data = zf.read(dsize)
-                if len(raw_data) != dsize:
-                    err = "zipimport: can't read data"
-                    raise zipimport.ZipImportError(err)
-            finally:
-                zf.close()
+            start = time.time()
+            raw_data = _read_member(self.archive,offset,dsize)
+            _record_stat(self.archive,"reads")
+            _record_stat(self.archive,"read_bytes",dsize)
+            _record_stat(self.archive,"read_time",time.time() - start)
         #  Decompress if necessary, and return the data.
         if raw:
             return raw_data
@@ -379,9 +2369,102 @@ class zipimporter(zipimport.zipimporter):
             global zlib
             if zlib is None:
                 import zlib
-            return zlib.decompress(raw_data,-15)
+            if not timed:
+                return zlib.decompress(raw_data,-15)
+            start = time.time()
+            data = zlib.decompress(raw_data,-15)
+            _record_stat(self.archive,"inflates")
+            _record_stat(self.archive,"inflated_bytes",len(data))
+            _record_stat(self.archive,"inflate_time",time.time() - start)
+            return data
         return raw_data
 
+    def _find_matching(self,patterns):
+        """Helper method to find the files matching some filename patterns.
+
+        Each entry in the list of patterns may be either the exact name of a
+        file as found in the keys of self._files, or a glob-style pattern to
+        be matched against those keys.  The matching keys are returned as a
+        list.
+        """
+        if isinstance(patterns,basestring):
+            patterns = [patterns]
+        files = self._files
+        matches = []
+        globs = []
+        for pattern in patterns:
+            if pattern in files:
+                matches.append(pattern)
+            else:
+                globs.append(pattern)
+        if globs:
+            matchglobs = _compile_patterns(globs)
+            found = set(matches)
+            for key in files.keys():
+                if key not in found and matchglobs(key):
+                    matches.append(key)
+        return matches
+
+    def prefetch(self,names):
+        """Load the data for many files into memory in a single pass.
+
+        This method takes a list of filenames or filename patterns, in the
+        same format as the "preload" argument to write_index(), and reads
+        the data for all matching files from the zipfile.  The reads are done
+        in order of position in the zipfile and adjacent files are coalesced
+        into large sequential reads.  The data is then kept in memory exactly
+        as if it had been preloaded from an index file.
+
+        Returns the number of files that were prefetched.
+        """
+        files = self._files
+        members = []
+        for key in self._find_matching(names):
+            toc = files[key]
+            if len(toc) <= 8:
+                members.append((key,toc))
+        if not members:
+            return 0
+        for (key,raw_data) in _read_members(self.archive,members).iteritems():
+            files[key] = tuple(files[key][:8]) + (raw_data,)
+        return len(members)
+
+    def _get_buffer(self,path,toc=None):
+        """Helper method to get a buffer over the data for a given path.
+
+        This is like _get_data(), but returns a read-only buffer object.
+        For files stored without compression in a memory-mapped archive,
+        the buffer refers directly to the mapped data and nothing is copied.
+        If there is no such file, None is returned.
+        """
+        if toc is None:
+            toc = self._files.get(path)
+            if toc is None:
+                return None
+        if _zip_trace is not None:
+            _zip_trace.setdefault((self.archive,path),len(_zip_trace))
+        if not toc[1]:
+            if len(toc) > 8:
+                if _zip_stats is not None:
+                    _record_stat(self.archive,"preload_hits")
+                return buffer(toc[8])
+            timed = (_zip_stats is not None)
+            if timed:
+                start = time.time()
+            zmap = _get_archive_map(self.archive)
+            if zmap is not None:
+                offset = _get_member_start(self.archive,zmap,toc[4])
+                if offset + toc[2] > len(zmap):
+                    err = "zipimport: can't read data"
+                    raise zipimport.ZipImportError(err)
+                data = buffer(zmap,offset,toc[2])
+                if timed:
+                    _record_stat(self.archive,"reads")
+                    _record_stat(self.archive,"read_bytes",toc[2])
+                    _record_stat(self.archive,"read_time",time.time() - start)
+                return data
+        return buffer(self._get_data(path,toc))
+
     def find_module(self,fullname,path=None):
         """find_module(fullname, path=None) -> self or None.
 
@@ -394,6 +2477,14 @@ class zipimporter(zipimport.zipimporter):
         and it will behave appropriately).
         """
         if path is None:
+            #  If this archive was loaded from a merged index, and that says
+            #  the module lives in some other archive or in no archive at
+            #  all, we can skip the search.
+            if _zip_module_owners and not self.prefix:
+                info = _zip_directory_info.get(self.archive)
+                if info is not None and info.get("merged"):
+                    if _zip_module_owners.get(fullname) != self.archive:
+                        return None
             mi = self._get_module_type(fullname)
             if mi is not None:
                 return self
@@ -414,8 +2505,48 @@ class zipimporter(zipimport.zipimporter):
         fully qualified (dotted) module name. It returns the imported
         module, or raises ZipImportError if it wasn't found.
         """
+        if _zip_stats is None and _zip_profile is None:
+            return self._load_module(fullname)
+        #  Attribute all the work done while loading to this module.  The
+        #  statistics may have been stopped while a profile is running.
+        stack = None
+        if _zip_stats is not None:
+            counters = _zip_stats["modules"].setdefault(fullname,{})
+            counters["archive"] = self.archive
+            stack = _get_stats_stack()
+            stack.append(fullname)
+        node = None
+        if _zip_profile is not None:
+            node = ProfileNode(fullname,self.archive)
+            pstack = _get_profile_stack()
+            if pstack:
+                pstack[-1].children.append(node)
+            else:
+                _zip_profile.children.append(node)
+            pstack.append(node)
+            start = time.time()
+        try:
+            return self._load_module(fullname)
+        finally:
+            if stack:
+                stack.pop()
+            if node is not None:
+                node.total_time = time.time() - start
+                if pstack:
+                    pstack.pop()
+
+    def _load_module(self,fullname):
+        """Helper method that does the real work of load_module()."""
         modnm = fullname.rsplit(".")[-1]
+        timed = (_zip_stats is not None)
+        if timed:
+            start = time.time()
         code,filepath,ispkg = self._get_module_code(fullname)
+        if timed:
+            _record_stat(self.archive,"code_time",time.time() - start)
+        if _zip_trace is not None:
+            path = filepath[len(self.archive)+len(SEP):]
+            _zip_trace.setdefault((self.archive,path),len(_zip_trace))
         created = False
         try:
             mod = sys.modules.get(fullname)
@@ -432,11 +2563,17 @@ class zipimporter(zipimport.zipimporter):
             mod.__loader__ = self
             if ispkg:
                 mod.__path__ = [filepath.rsplit(SEP,1)[0]]
+            if timed:
+                start = time.time()
             exec code in mod.__dict__
         except Exception:
             if created:
                 sys.modules.pop(fullname)
             raise
+        #  The module may have stopped the statistics while executing.
+        if timed and _zip_stats is not None:
+            _record_stat(self.archive,"loads")
+            _record_stat(self.archive,"exec_time",time.time() - start)
         return mod
 
     def get_data(self,pathname):
@@ -447,11 +2584,247 @@ class zipimporter(zipimport.zipimporter):
         """
         if pathname.startswith(self.archive+SEP):
             pathname = pathname[len(self.archive)+1:]
+        cache = self.data_cache
+        if cache is not None:
+            data = cache.get((self.archive,pathname))
+            if data is not None:
+                return data
         data = self._get_data(pathname)
+        if data is None:
+            raise IOError("not found: %s" % (pathname,))
+        if cache is not None:
+            cache.put((self.archive,pathname),data)
+        return data
+
+    def get_buffer(self,pathname):
+        """get_buffer(pathname) -> read-only buffer with file data.
+
+        Return a buffer over the data associated with 'pathname'.  For files
+        stored without compression, this refers directly to the memory-mapped
+        zipfile and avoids copying the data.  Raise IOError if the file
+        wasn't found.
+        """
+        if pathname.startswith(self.archive+SEP):
+            pathname = pathname[len(self.archive)+1:]
+        data = self._get_buffer(pathname)
         if data is None:
             raise IOError("not found: %s" % (pathname,))
         return data
 
+    def open_resource(self,pathname):
+        """open_resource(pathname) -> read-only file-like object.
+
+        Return a file-like object that streams the data associated with
+        'pathname', decompressing it incrementally as it is read.  Raise
+        IOError if the file wasn't found.
+        """
+        if pathname.startswith(self.archive+SEP):
+            pathname = pathname[len(self.archive)+1:]
+        toc = self._files.get(pathname)
+        if toc is None:
+            raise IOError("not found: %s" % (pathname,))
+        return _ResourceFile(self.archive,pathname,toc)
+
+    def warmup(self,names,threads=2):
+        """Prepare the code for some modules in background threads.
+
+        This method starts a pool of threads that read, decompress and
+        unmarshal (or compile) the code for each of the named modules, so
+        that it's ready and waiting by the time the module is imported.  The
+        names are full dotted module names as would be imported from this
+        importer's path entry, e.g. the list of modules recorded during a
+        previous startup; if this importer is for a package's directory,
+        they can also be the full names of the modules in that package.
+        Since zlib releases the GIL while decompressing, this can overlap
+        much of the import work with module execution.
+
+        It's safe to import the named modules while the warmup is running;
+        an import will either wait for a module that's being prepared, or
+        take it out of the queue and prepare it directly.  The returned task
+        object has a wait() method to wait for the warmup to finish.
+        """
+        if isinstance(names,basestring):
+            names = [names]
+        #  The warmup threads mustn't import anything, since the importing
+        #  thread may be holding the import lock while it waits for them.
+        #  Mapping the archive here also settles whether mmap is available.
+        global struct, zlib, os
+        _get_archive_map(self.archive)
+        try:
+            if struct is None:
+                import struct
+            if zlib is None:
+                import zlib
+            if os is None:
+                import os
+        except ImportError:
+            pass
+        return _WarmupTask(self,names,threads)
+
+    def warm(self,patterns):
+        """Prepare the code for many modules in memory, ahead of import.
+
+        This method takes a list of filename patterns, in the same format as
+        the "preload" argument to write_index(), and prepares the code for
+        every module with a matching file.  The code objects are held in a
+        single process-wide store until the modules are imported.
+
+        This is intended for pre-forking servers: warming the application's
+        modules in the master process means that each worker process shares
+        the resulting code objects copy-on-write, rather than decompressing
+        and unmarshalling its own copy of every module.
+
+        Returns a tuple (modules,bytes) giving the number of modules that
+        were prepared and the total uncompressed size of their files.
+        """
+        global zlib
+        if zlib is None:
+            import zlib
+        nmodules = 0
+        nbytes = 0
+        files = self._files
+        for pathhead in self._get_pathheads(self._find_matching(patterns)):
+            key = (self.archive,pathhead)
+            if key in _zip_code_cache:
+                continue
+            try:
+                code = self._get_path_code(pathhead)
+            except (SyntaxError,ZipImportError,zlib.error):
+                #  Leave it for load_module() to report the error.
+                code = None
+            if code is not None:
+                _zip_code_cache[key] = code
+                path = code[1][len(self.archive)+len(SEP):]
+                nmodules += 1
+                nbytes += files[path][3]
+        return (nmodules,nbytes)
+
+    def relayout(self,order,uncompressed=False,**kwds):
+        """Rewrite the zipfile so that its files appear in the given order.
+
+        This method takes a list of filenames or filename patterns, in the
+        same format as the "preload" argument to write_index(), or a list of
+        (archive,path) pairs as returned by stop_trace().  The zipfile is
+        rewritten with the matching files first, in the order given, followed
+        by all other files in their existing order.  The files matching each
+        pattern are placed in sorted order, at the position of the first
+        entry in the list that they match.  If the order matches the
+        imports done at startup, they are then served by a single forward
+        scan through the zipfile rather than seeking all over it.
+
+        If "uncompressed" is true then the ordered files are stored without
+        compression, so they can be used without inflating them.  All other
+        files are copied exactly as they are, without recompressing them.
+
+        The new zipfile is written to a temporary file and renamed over the
+        original, and remains a standard zipfile that the builtin zipimport
+        module can use.  An index is then written for it, with any additional
+        keyword arguments passed on to write_index().  Don't do this while
+        other processes might be importing from the zipfile.
+
+        Returns the number of files that were moved to the front.
+        """
+        import os
+        import zipfile  # not a builtin, import only as needed
+        global struct
+        if struct is None:
+            import struct
+        names = []
+        for item in order:
+            if isinstance(item,tuple):
+                if item[0] == self.archive:
+                    names.append(item[1])
+            else:
+                names.append(item)
+        hot = []
+        seen = set()
+        keys = None
+        for name in names:
+            if name in self._files:
+                matches = [name]
+            else:
+                if keys is None:
+                    keys = sorted(self._files.keys())
+                match = _compile_patterns(name)
+                matches = [key for key in keys if match(key)]
+            for key in matches:
+                if key not in seen:
+                    seen.add(key)
+                    hot.append(key)
+        zf = zipfile.ZipFile(self.archive)
+        try:
+            infos = {}
+            for zinfo in zf.infolist():
+                infos[zinfo.filename.replace("/",SEP)] = zinfo
+            ordered = []
+            for key in hot:
+                zinfo = infos.pop(key,None)
+                if zinfo is not None:
+                    ordered.append(zinfo)
+            nhot = len(ordered)
+            rest = sorted(infos.itervalues(),key=lambda zi: zi.header_offset)
+            ordered.extend(rest)
+            tmppath = "%s.%d.tmp" % (self.archive,os.getpid(),)
+            out = zipfile.ZipFile(tmppath,"w",allowZip64=True)
+            try:
+                for (i,zinfo) in enumerate(ordered):
+                    newinfo = zipfile.ZipInfo(zinfo.filename,zinfo.date_time)
+                    for attr in ("comment","create_system","create_version",
+                                 "extract_version","flag_bits","volume",
+                                 "internal_attr","external_attr",
+                                 "compress_type","CRC","compress_size",
+                                 "file_size",):
+                        setattr(newinfo,attr,getattr(zinfo,attr))
+                    newinfo.extra = _strip_zip64_extra(zinfo.extra)
+                    #  Only inflate the files we're storing uncompressed,
+                    #  and copy the compressed data of all the others.
+                    if uncompressed and i < nhot and zinfo.compress_type \
+                       and not zinfo.flag_bits & 0x01:
+                        newinfo.compress_type = zipfile.ZIP_STORED
+                        newinfo.flag_bits &= ~0x08
+                        out.writestr(newinfo,zf.read(zinfo))
+                    else:
+                        _copy_raw_member(zf,zinfo,out,newinfo)
+            finally:
+                out.close()
+        finally:
+            zf.close()
+        #  Replace the old zipfile and discard everything we know about it.
+        #  The old memory map remains valid until the last buffer using it
+        #  is released, so we don't try to close it explicitly.
+        if os.path.exists(self.archive + archive_index):
+            os.unlink(self.archive + archive_index)
+        if sys.platform == "win32":
+            os.unlink(self.archive)
+        os.rename(tmppath,self.archive)
+        old_files = _zip_directory_cache.pop(self.archive,None)
+        _zip_directory_info.pop(self.archive,None)
+        _zip_archive_maps.pop(self.archive,None)
+        for key in _zip_code_cache.keys():
+            if key[0] == self.archive:
+                del _zip_code_cache[key]
+        importer = self.__class__(self.archive)
+        importer.write_index(**kwds)
+        files = importer._files
+        #  Other importers for this archive, e.g. for its packages, share
+        #  the old directory.  Update it in place so they see the new
+        #  offsets.  If it's not a plain dict we can't, so drop any cached
+        #  importers and let them be created afresh.
+        if type(old_files) is dict and type(files) is dict:
+            old_files.clear()
+            old_files.update(files)
+            files = old_files
+            _zip_directory_cache[self.archive] = files
+        else:
+            for path in sys.path_importer_cache.keys():
+                if path == self.archive or path.startswith(self.archive+SEP):
+                    del sys.path_importer_cache[path]
+        prefix = self.prefix
+        self.__dict__["archive"] = importer.archive
+        self.__dict__["prefix"] = prefix
+        self.__dict__["_files"] = files
+        return nhot
+
     def get_code(self,fullname):
         """get_code(fullname) -> code object.
     
@@ -488,10 +2861,9 @@ class zipimporter(zipimport.zipimporter):
         #  return the .pyc but the actual module will be given the .py.
         #  We put up with this to avoid reading from disk to get the filename.
         pathhead = self.prefix + fullname.rsplit(".",1)[-1] 
-        for suffix,ispkg,iscode in self._zip_searchorder:
-            path = pathhead + suffix
-            if path in self._files:
-                return self.archive + SEP + path
+        found = self._find_module_path(pathhead)
+        if found is not None:
+            return self.archive + SEP + found[0]
         raise ZipImportError("module not found: '%s'" % fullname,)
     get_filename = _get_filename
 
@@ -507,7 +2879,81 @@ class zipimporter(zipimport.zipimporter):
             raise zipimport.ZipImportError(err)
         return (mi == self.MI_PACKAGE)
 
-    def write_index(self,platform=None,preload=[]):
+    def iter_modules(self,prefix=""):
+        """Iterate over the modules found directly within this importer.
+
+        This yields a (name,ispkg) pair for each module or package in the
+        importer's directory, with the given prefix added to each name, as
+        used by pkgutil.iter_modules().  Rather than scanning every file in
+        the zipfile, it uses a tree of directories that is built once per
+        zipfile or loaded from the index, so each call takes time in
+        proportion to the number of entries in the directory.
+        """
+        tree = self._get_tree()
+        dirpath = self.prefix.rstrip(SEP)
+        suffixes = [s for (s,ispkg,iscode) in self._zip_searchorder
+                      if not ispkg]
+        children = tree.get(dirpath,{})
+        yielded = set()
+        for name in sorted(children):
+            if children[name]:
+                if dirpath:
+                    subdir = tree[dirpath + SEP + name]
+                else:
+                    subdir = tree[name]
+                for suffix in suffixes:
+                    if "__init__" + suffix in subdir:
+                        if name not in yielded:
+                            yielded.add(name)
+                            yield (prefix + name,True)
+                        break
+            else:
+                for suffix in suffixes:
+                    if name.endswith(suffix):
+                        modname = name[:-len(suffix)]
+                        if modname == "__init__" or "." in modname:
+                            break
+                        if modname not in yielded:
+                            yielded.add(modname)
+                            yield (prefix + modname,False)
+                        break
+
+    def listdir(self,path=""):
+        """List the entries in a directory within the zipfile.
+
+        The path may be given relative to the root of the zipfile, or as a
+        full path including the archive as for get_data().  The entries are
+        returned as a sorted list of names.  Raise OSError if there's no such
+        directory in the zipfile.
+        """
+        if path.startswith(self.archive+SEP):
+            path = path[len(self.archive)+1:]
+        elif path == self.archive:
+            path = ""
+        children = self._get_tree().get(path.rstrip(SEP))
+        if children is None:
+            raise OSError("not a directory: %s" % (path,))
+        return sorted(children)
+
+    def _get_tree(self):
+        """Helper method to get the tree of directories in the zipfile.
+
+        The tree is loaded from the index if it was written with a lookup
+        table, and otherwise built on first use.  Either way it's stored with
+        the other extra info for the zipfile, and shared by all importers.
+        """
+        info = _zip_directory_info.get(self.archive)
+        if info is None:
+            info = _zip_directory_info.setdefault(self.archive,{})
+        tree = info.get("tree")
+        if tree is None:
+            tree = _build_tree(self._files.iterkeys())
+            info["tree"] = tree
+        return tree
+
+    def write_index(self,platform=None,preload=[],trace=None,
+                    precompiled=False,lookup=False,lazy=False,
+                    incremental=False,jobs=1):
         """Create pre-processed index files for this zipimport archive.
 
         This method creates file <self.archive>.idx containing a pre-processed
@@ -517,6 +2963,70 @@ class zipimporter(zipimport.zipimporter):
         By default the index is formatted for the path conventions of the
         current platform; pass platform="win32" or platform="posix" to make
         an index for a specific platform.
+
+        Files matching any of the filename patterns in the "preload" list
+        will have their data included directly in the index.  The "trace"
+        argument gives a list of (archive,path) pairs as returned by the
+        stop_trace() method; files from this archive that appear in the
+        trace are also included in the index.
+
+        If "precompiled" is true, the code for every module in the zipfile
+        is validated, compiled if necessary, and stored in the index in
+        marshalled form.  Loading these modules then skips all bytecode
+        checks and file reads.  The precompiled code is ignored if the index
+        is used by an interpreter with a different bytecode magic number or
+        optimisation level.
+
+        If "lookup" is true, the index will contain a table of all modules
+        in the zipfile, which lets find_module() answer with a single dict
+        lookup rather than probing for each possible suffix, and the tree of
+        directories used by iter_modules() and listdir().  This roughly
+        doubles the size of the index, so it's only done by default for
+        precompiled indexes.
+
+        If "lazy" is true, the index is written in a binary format that can
+        be memory-mapped and decoded one entry at a time as needed, rather
+        than being unmarshalled in its entirety when the zipfile is opened.
+        This is much faster to load for zipfiles with very many entries.
+        The entries for any files in the trace are written first, in the
+        order they were first used.
+
+        If "incremental" is true, the existing index file is loaded and
+        compared against the current contents of the zipfile by name, CRC
+        and offset.  Any preloaded data or precompiled code for files that
+        haven't changed is taken from the existing index, so only the files
+        that have changed are read from the zipfile.
+
+        If "jobs" is greater than one, modules are precompiled in parallel
+        by a pool of that many worker processes.
+
+        The index is written to a temporary file and renamed into place, so
+        other processes never see a partially-written index file.
+        """
+        (index,info) = self._build_index(platform,preload,trace,precompiled,
+                                         lookup,incremental,jobs)
+        #  Write out to the appropriately-named index file.
+        def write(f):
+            if lazy:
+                sep = _platform_path(SEP,platform)
+                order = [_platform_path(path,platform)
+                         for (archive,path) in trace or ()
+                         if archive == self.archive]
+                _LazyDirectory.write(f,index,info,sep,order)
+            elif info:
+                marshal.dump((index,info),f)
+            else:
+                marshal.dump(index,f)
+        _write_index_file(self.archive + archive_index,write)
+
+    def _build_index(self,platform=None,preload=[],trace=None,
+                     precompiled=False,lookup=False,incremental=False,
+                     jobs=1):
+        """Helper method to build the contents of an index file.
+
+        This method takes the same arguments as write_index(), and returns
+        a tuple (files,info) giving the directory information and any extra
+        info to be stored in the index.
         """
         index = _zip_directory_cache[self.archive].copy()
         #  Don't store the __file__ field, it won't be correct.
@@ -535,22 +3045,207 @@ class zipimporter(zipimport.zipimporter):
                 index = {}
                 for (key,info) in posix_index.iteritems():
                     index[key.replace("/","\\")] = info
-        #  Add any preload data to the index
+        #  Find the files that are unchanged since the existing index.
+        unchanged = {}
+        previous = None
+        if incremental:
+            try:
+                previous = _load_index(self.archive + archive_index)
+            except (EnvironmentError,EOFError,ValueError,TypeError):
+                previous = None
+        if previous is not None:
+            for (key,info) in previous[0].iteritems():
+                current = index.get(key)
+                if current is not None and current[1:8] == info[1:8]:
+                    unchanged[key] = info
+        #  Find the files to be preloaded, either by matching the preload
+        #  patterns or from the trace.  Data for unchanged files is taken
+        #  from the existing index, and the rest is read in a single pass.
+        members = {}
+        def add_member(key,info):
+            old_info = unchanged.get(key)
+            if old_info is not None and len(old_info) > 8:
+                index[key] = tuple(list(info) + [old_info[8]])
+            else:
+                members[key] = info
         if preload:
-            import fnmatch  # not a builtin, import only as needed
-            if isinstance(preload,basestring):
-                preload = [preload]
+            matches = _compile_patterns(preload)
             for (key,info) in index.iteritems():
-                for pattern in preload:
-                    if fnmatch.fnmatch(key,pattern):
-                        data = self._get_data(key,info,raw=True)
-                        index[key] = tuple(list(info) + [data])
-                        break
-        #  Write out to the appropriately-named index file.
-        with open(self.archive + archive_index,"wb") as f:
-            marshal.dump(index,f)
+                if len(info) <= 8 and matches(key):
+                    add_member(key,info)
+        if trace:
+            for (archive,path) in trace:
+                if archive != self.archive:
+                    continue
+                path = _platform_path(path,platform)
+                info = index.get(path)
+                if info is not None and len(info) <= 8:
+                    add_member(path,info)
+        if members:
+            raw_data = _read_members(self.archive,members.items())
+            for (key,info) in members.iteritems():
+                index[key] = tuple(list(info) + [raw_data[key]])
+        #  Add any extra info to the index
+        info = {}
+        try:
+            fingerprint = _get_fingerprint(self.archive)
+        except EnvironmentError:
+            fingerprint = None
+        if fingerprint is not None:
+            info["fingerprint"] = fingerprint
+        if lookup or precompiled:
+            info["lookup"] = self._get_lookup_table(index,platform)
+            info["tree"] = _build_tree(index,_platform_path(SEP,platform))
+        if precompiled:
+            reuse = {}
+            if previous is not None:
+                reuse = self._get_unchanged_modules(previous[1],info,
+                                                    unchanged,platform)
+            info["magic"] = imp.get_magic()
+            info["debug"] = __debug__
+            info["modules"] = self._get_precompiled_modules(platform,reuse,
+                                                            jobs)
+        return (index,info)
+
+    def _get_unchanged_modules(self,old_info,info,unchanged,platform=None):
+        """Helper method to find precompiled modules that can be reused.
+
+        Given the info from an existing index, the lookup table for the new
+        index and the files that are unchanged since the existing index, this
+        returns the entries from the existing precompiled modules for which
+        the same files exist and none of them have changed.
+        """
+        old_lookup = old_info.get("lookup",{})
+        lookup = info["lookup"]
+        suffixes = []
+        for (suffix,flag) in _zip_suffix_flags.iteritems():
+            suffixes.append((_platform_path(suffix,platform),flag))
+        reuse = {}
+        for (pathhead,module) in old_info.get("modules",{}).iteritems():
+            flags = lookup.get(pathhead)
+            if flags is None or flags != old_lookup.get(pathhead):
+                continue
+            for (suffix,flag) in suffixes:
+                if flags & flag and pathhead + suffix not in unchanged:
+                    break
+            else:
+                reuse[pathhead] = module
+        return reuse
 
-    def get_inline_code(self,platform=None,bootstrap_zipimportx=True):
+    def _get_lookup_table(self,index,platform=None):
+        """Helper method to build the module lookup table for an index.
+
+        This returns a dict mapping the path of each module (without suffix)
+        to the bitwise-or of the _zip_suffix_flags for each of the suffixes
+        that it is available under.
+        """
+        suffixes = []
+        for (suffix,flag) in _zip_suffix_flags.iteritems():
+            suffixes.append((_platform_path(suffix,platform),flag))
+        #  Check the longer package suffixes first, so that we don't take
+        #  e.g. "mypkg/__init__.py" for a module named "__init__".
+        suffixes.sort(key=lambda s: -len(s[0]))
+        lookup = {}
+        for key in index.iterkeys():
+            for (suffix,flag) in suffixes:
+                if key.endswith(suffix):
+                    pathhead = key[:-len(suffix)]
+                    lookup[pathhead] = lookup.get(pathhead,0) | flag
+                    break
+        return lookup
+
+    def _get_pathheads(self,paths):
+        """Helper method to get the set of modules for some file paths.
+
+        Given a list of file paths, this returns the set of module paths
+        (i.e. file paths without suffix) for each one that is a module.
+        """
+        pathheads = set()
+        for path in paths:
+            for suffix,ispkg,iscode in self._zip_searchorder:
+                if path.endswith(suffix):
+                    pathheads.add(path[:-len(suffix)])
+                    break
+        return pathheads
+
+    def _get_precompiled_modules(self,platform=None,reuse={},jobs=1):
+        """Helper method to precompile all modules in the zipfile.
+
+        This returns a dict mapping the path of each module (without suffix)
+        to a tuple (path,ispkg,payload) giving the file that the module will
+        be loaded from, whether it is a package, and its marshalled code.
+        Modules found in the optional "reuse" dict are taken from there
+        rather than being compiled again.
+
+        If "jobs" is greater than one, the modules are split into contiguous
+        runs by name (and hence, usually, by position in the zipfile) and
+        compiled by a pool of that many worker processes.  If the worker
+        function can't be passed to the pool, they're compiled in this
+        process instead.
+        """
+        pathheads = self._get_pathheads(_zip_directory_cache[self.archive])
+        modules = {}
+        todo = []
+        for pathhead in pathheads:
+            module = reuse.get(_platform_path(pathhead,platform))
+            if module is not None:
+                modules[_platform_path(pathhead,platform)] = module
+            else:
+                todo.append(pathhead)
+        if jobs > 1 and len(todo) > 1:
+            #  The worker function is pickled by name, which fails if the
+            #  zipimportx module in sys.modules isn't this one (e.g. if this
+            #  copy was loaded from a zipfile or inline code).
+            import pickle  # not a builtin, import only as needed
+            try:
+                pickle.dumps(_precompile_modules)
+            except pickle.PicklingError:
+                jobs = 1
+        if jobs <= 1 or len(todo) <= 1:
+            modules.update(self._precompile_modules(todo,platform))
+            return modules
+        import multiprocessing  # not a builtin, import only as needed
+        todo.sort()
+        nchunks = min(jobs * 4,len(todo))
+        tasks = []
+        for i in xrange(nchunks):
+            chunk = todo[i*len(todo)//nchunks:(i+1)*len(todo)//nchunks]
+            tasks.append((self.archive,chunk,platform))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for result in pool.imap_unordered(_precompile_modules,tasks):
+                modules.update(result)
+        finally:
+            pool.terminate()
+            pool.join()
+        return modules
+
+    def _precompile_modules(self,pathheads,platform=None):
+        """Helper method to precompile the given modules.
+
+        This returns a dict in the same format as _get_precompiled_modules(),
+        for just the given list of module paths.  Modules that can't be
+        read or compiled are skipped, and will be loaded as normal.
+        """
+        global zlib
+        if zlib is None:
+            import zlib
+        modules = {}
+        for pathhead in pathheads:
+            try:
+                code = self._get_path_code(pathhead)
+            except (SyntaxError,ZipImportError,zlib.error):
+                code = None
+            if code is not None:
+                (code,filepath,ispkg) = code
+                path = filepath[len(self.archive)+1:]
+                path = _platform_path(path,platform)
+                pathhead = _platform_path(pathhead,platform)
+                modules[pathhead] = (path,ispkg,marshal.dumps(code))
+        return modules
+
+    def get_inline_code(self,platform=None,bootstrap_zipimportx=True,
+                        compact=False):
         """Get python code for inline loading of the zipfile
 
         This method returns python sourcecode that, when executed, provides
@@ -560,7 +3255,14 @@ class zipimporter(zipimport.zipimporter):
 
         If the keyword argument "bootstrap_zipimportx" is False, the returned
         code will not include the necessary definitions to bootstrap the 
-        zipimportx module.
+        zipimportx module.  Those definitions are the full source of this
+        module, so leave them out if zipimportx is available some other way.
+
+        If the keyword argument "compact" is True, the directory information
+        is embedded as a single compressed string, and the data for all the
+        files as a few compressed chunks, rather than as a large dict literal.
+        The generated code is then much faster to compile, and the data for
+        each file is only decompressed when it's first used.
         """
         import os
         import inspect
@@ -568,12 +3270,24 @@ class zipimporter(zipimport.zipimporter):
         ilid = os.urandom(8).encode("hex")
         name = "<zipimportx-%s>" % (ilid,)
         index = _zip_directory_cache[self.archive].copy()
+        #  Read the data for every file in a single pass over the zipfile,
+        #  except for any that are already in memory.
+        members = [(key,info) for (key,info) in index.iteritems()
+                   if len(info) <= 8]
+        raw_data = _read_members(self.archive,members)
         #  The only field we need to keep is the "compressed" field
         #  Don't store the __file__ field, it won't be correct.
         #  Besides, we can re-create it as needed.
         for (key,info) in index.iteritems():
-            compressed = info[1]
-            index[key] = ("",compressed,None,None,None,None,None,None)
+            data = raw_data.get(key)
+            if data is None:
+                data = info[8]
+            if compact:
+                index[key] = ("",) + tuple(info[1:8]) + (data,)
+            else:
+                compressed = info[1]
+                index[key] = ("",compressed,None,None,None,None,None,None,
+                              data)
         #  Correct for path separators on the requested platform.
         if platform is not None:
             if sys.platform == "win32" and platform != "win32":
@@ -586,10 +3300,6 @@ class zipimporter(zipimport.zipimporter):
                 index = {}
                 for (key,info) in posix_index.iteritems():
                     index[key.replace("/","\\")] = info
-        #  Add the actual data for each file into the index
-        for (key,info) in index.iteritems():
-            data = self._get_data(key,None,raw=True)
-            index[key] = tuple(list(info) + [data])
         #  Construct the necessary code:
         #      * get the zipimporter class
         #      * create sublcass to do path munging
@@ -599,6 +3309,9 @@ class zipimporter(zipimport.zipimporter):
         code.append("if %r not in zipimport._zip_directory_cache:" % (name,))
         if bootstrap_zipimportx:
             code.append(inspect.getsource(zipimportx).replace("\n","\n  "))
+        elif compact:
+            code.append("  from zipimportx import zipimporter, SEP")
+            code.append("  from zipimportx import _InlineDirectory")
         else:
             code.append("  from zipimportx import zipimporter, SEP")
         #  Unfortunately py2exe (at least) expects to be able to find dylib
@@ -636,10 +3349,212 @@ class zipimporter(zipimport.zipimporter):
         code.append("          import sys")
         code.append("          path = sys.prefix + SEP + path[idx:]")
         code.append("      return path")
-        code.append("  zipimport._zip_directory_cache[%r] = %s"%(name,index,))
+        if compact:
+            (directory,chunks) = _InlineDirectory.encode(index)
+            code.append("  zipimport._zip_directory_cache[%r] = "\
+                        "_InlineDirectory(%r,%r)" % (name,directory,chunks,))
+        else:
+            code.append("  zipimport._zip_directory_cache[%r] = %s"%(name,index,))
         code.append("  sys.meta_path.append(zipimporter_%s(%r))"%(ilid,name,))
         return "\n".join(code)
 
+    @classmethod
+    def write_merged_index(cls,indexpath,archives,platform=None,**kwds):
+        """Create a single index file covering several zipimport archives.
+
+        This class method writes the file at "indexpath" with pre-processed
+        index information for each of the given archives.  Loading it with
+        load_merged_index() is equivalent to opening each archive with its
+        own index file, but needs only a single read.  Any additional
+        keyword arguments are passed on as for write_index().
+
+        The merged index also records which archive provides each top-level
+        module.  Since this is used to answer imports that would otherwise
+        search every archive in turn, the archives should be given in the
+        same order as they appear on sys.path.
+
+        Archives in the same directory as the index file (or below it) are
+        recorded by relative path, and located relative to the index file
+        when it's loaded.  As with write_index(), the file is written to a
+        temporary file and renamed into place.
+        """
+        import os  # not a builtin, import only as needed
+        basedir = os.path.dirname(os.path.abspath(indexpath)) + os.sep
+        entries = []
+        owners = {}
+        for archive in archives:
+            importer = cls(archive)
+            (files,info) = importer._build_index(platform,**kwds)
+            path = os.path.abspath(importer.archive)
+            relative = path.startswith(basedir)
+            if relative:
+                path = path[len(basedir):]
+            path = _platform_path(path,platform)
+            entries.append((path,relative,files,info))
+            pathheads = importer._get_pathheads(importer._files.keys())
+            for pathhead in pathheads:
+                if SEP not in pathhead:
+                    owners.setdefault(pathhead,len(entries) - 1)
+        merged = {"sep": _platform_path(SEP,platform),
+                  "archives": entries,
+                  "owners": owners}
+        _write_index_file(indexpath,lambda f: marshal.dump(merged,f))
+
+    @classmethod
+    def load_merged_index(cls,indexpath):
+        """Load a merged index file written by write_merged_index().
+
+        This class method loads the directory information for every archive
+        in the merged index, so that they can be imported from without any
+        further file IO until their data is needed.  Archives that have
+        already been loaded are left untouched.  The list of archive paths
+        is returned; relative paths are resolved against the directory of
+        "indexpath", so give it in the same form as your sys.path entries.
+        """
+        with open(indexpath,"rb") as f:
+            merged = marshal.load(f)
+        if merged.get("sep") != SEP:
+            return []
+        basedir = ""
+        if SEP in indexpath:
+            basedir = indexpath.rsplit(SEP,1)[0] + SEP
+        archives = []
+        loaded = set()
+        for (path,relative,files,info) in merged["archives"]:
+            if relative:
+                path = basedir + path
+            archives.append(path)
+            if path in _zip_directory_cache:
+                continue
+            _zip_archive_maps.pop(path,None)
+            if cls.compact_directory:
+                files = _compact_directory(files)
+            info = _check_index_info(info)
+            if cls.verify_index:
+                if not _check_fingerprint(path,info.get("fingerprint")):
+                    continue
+            info["merged"] = True
+            _zip_directory_cache[path] = files
+            _zip_directory_info[path] = info
+            loaded.add(path)
+        #  Only trust the module listings of archives that we loaded, since
+        #  any others may have changed since the index was written.
+        for (name,i) in merged["owners"].iteritems():
+            if archives[i] in loaded:
+                _zip_module_owners.setdefault(name,archives[i])
+        return archives
+
+    @classmethod
+    def start_stats(cls):
+        """Start recording import statistics.
+
+        While enabled, zipimportx counts the work done for each archive and
+        each module: index and directory loads, members read from disk and
+        how many bytes, members served from preloaded data, decompression,
+        unmarshalling, fallbacks from bytecode to source and compiling, and
+        the time spent in each.  The "exec_time" for a module includes the
+        time taken by any imports done by its body, but the work needed to
+        load those modules is counted against them rather than against it.
+        Any previous statistics are discarded.
+
+        Setting ZIPIMPORTX_STATS in the environment enables this as soon as
+        the module is loaded, and dumps the statistics at exit: to stderr if
+        its value is "1" or "-", and to the named file otherwise.
+        """
+        global _zip_stats, _zip_stats_local, time
+        if time is None:
+            import time
+        _zip_stats_local = _new_thread_local()
+        _zip_stats = {"archives": {}, "modules": {}}
+
+    @classmethod
+    def stats(cls):
+        """Get the import statistics recorded since start_stats().
+
+        This class method returns a dict with keys "archives" and "modules",
+        each mapping a name to a dict of counters.  The counters for each
+        module include the archive it was loaded from.  Times are in seconds.
+        """
+        if _zip_stats is None:
+            return {"archives": {}, "modules": {}}
+        stats = {}
+        for (kind,names) in _zip_stats.iteritems():
+            stats[kind] = dict((k,v.copy()) for (k,v) in names.iteritems())
+        return stats
+
+    @classmethod
+    def stop_stats(cls):
+        """Stop recording import statistics, and return them."""
+        global _zip_stats
+        stats = cls.stats()
+        _zip_stats = None
+        return stats
+
+    @classmethod
+    def start_profile(cls):
+        """Start profiling the modules loaded by zipimportx.
+
+        While profiling, each call to load_module() is recorded as a node in
+        a tree, nested under the module that was being loaded at the time.
+        Statistics are also recorded as for start_stats(), if they're not
+        already, so that each node can tell how much of its time was spent
+        by zipimportx and how much executing the module body.  Modules that
+        are loaded by other importers aren't shown, and their time counts as
+        executing the module that imported them.
+        """
+        global _zip_profile, _zip_profile_local
+        profile = ProfileNode()
+        profile.owns_stats = (_zip_stats is None)
+        if profile.owns_stats:
+            cls.start_stats()
+        profile.start = time.time()
+        _zip_profile_local = _new_thread_local()
+        _zip_profile = profile
+
+    @classmethod
+    def stop_profile(cls):
+        """Stop profiling, and return the root ProfileNode of the tree.
+
+        Use the format_tree() or format_collapsed() method of the returned
+        node to produce a readable report or input for a flamegraph tool.
+        """
+        global _zip_profile
+        profile = _zip_profile
+        _zip_profile = None
+        if profile is None:
+            return ProfileNode()
+        profile.total_time = time.time() - profile.start
+        if profile.owns_stats:
+            cls.stop_stats()
+        return profile
+
+    @classmethod
+    def start_trace(cls):
+        """Start recording the files used for imports.
+
+        While tracing is active, every file whose data is read by any
+        zipimporter instance is recorded, along with the file for every
+        module that is loaded.  Use this during a representative startup
+        of your application, then call stop_trace() to get the results.
+        """
+        global _zip_trace
+        _zip_trace = {}
+
+    @classmethod
+    def stop_trace(cls):
+        """Stop recording the files used for imports.
+
+        This class method returns the list of (archive,path) pairs recorded
+        since start_trace() was called, in order of first use.  It can be
+        passed directly as the "trace" argument to write_index().
+        """
+        global _zip_trace
+        trace = _zip_trace
+        _zip_trace = None
+        if trace is None:
+            return []
+        return sorted(trace,key=trace.get)
+
     @classmethod
     def install(cls):
         """Install this class into the import machinery.
@@ -659,6 +3574,26 @@ class zipimporter(zipimport.zipimporter):
         if not installed:
             sys.path_hooks.append(cls)
         sys.path_importer_cache.clear()
+        #  If pkgutil is in use, have it list modules using our package tree
+        #  rather than scanning all the files in the zipfile.  We don't want
+        #  to import it just for this, since it's not a builtin module.
+        pkgutil = sys.modules.get("pkgutil")
+        if pkgutil is not None:
+            try:
+                register = pkgutil.iter_importer_modules.register
+            except AttributeError:
+                pass
+            else:
+                register(cls,cls.iter_modules)
+
+
+#  Record statistics from startup if requested by the environment.  The atexit
+#  module isn't a builtin, so it's only imported if we need it.
+_zip_stats_dest = _getenv("ZIPIMPORTX_STATS")
+if _zip_stats_dest:
+    zipimporter.start_stats()
+    import atexit
+    atexit.register(_dump_stats,_zip_stats_dest)
 
 
 if __name__ == "__main__":
@@ -670,6 +3605,8 @@ if __name__ == "__main__":
             #  not as a module.  Create a fake one.
             thismodule = imp.new_module("zipimportx")
             thismodule.zipimporter = zipimporter
+            thismodule.DataCache = DataCache
+            thismodule.ProfileNode = ProfileNode
             thismodule.SEP = SEP
             thismodule.BADSEP = BADSEP
             thismodule._zip_directory_cache = _zip_directory_cache
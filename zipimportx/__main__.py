@@ -0,0 +1,346 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+zipimportx.__main__:  command-line tool for zipimportx
+=====================================================
+
+
+This module provides the "python -m zipimportx" command, for building and
+checking zipimportx index files as part of a build process.  It has the
+following subcommands, each of which takes any number of zipfiles and
+processes them in parallel across a pool of worker processes:
+
+    * build:    write the index file for each zipfile
+    * inline:   write inline python code for each zipfile
+    * stats:    show the size and contents of each index file
+    * verify:   check that each index file matches its zipfile
+
+Run "python -m zipimportx <command> --help" for the options of each command.
+
+"""
+
+import os
+import sys
+import optparse
+import zipimport
+
+import zipimportx
+from zipimportx import zipimporter, SEP, archive_index
+
+
+COMMANDS = ("build","inline","stats","verify",)
+
+
+def _open_archive(archive):
+    """Open a zipfile for processing, ignoring any existing index.
+
+    An existing index may be out of date, or have been written with
+    different options, so the directory is always read from the zipfile.
+    """
+    zipimportx._forget_archive(archive)
+    files = zipimportx._read_directory(archive)
+    if files is None:
+        zipimport.zipimporter(archive)
+    else:
+        zipimportx._zip_directory_cache[archive] = files
+    return zipimporter(archive)
+
+
+def load_trace(path,archive):
+    """Load the entries for the given archive from a trace file.
+
+    The trace file is a text file with one entry per line, either the path
+    of a file within the zipfile or an "<archive><TAB><path>" pair as
+    returned by zipimporter.stop_trace().  Pairs are only used if the name
+    of their archive matches that of the given archive, since the trace
+    may have been recorded with the zipfile in a different location.
+    """
+    trace = []
+    f = open(path,"r")
+    try:
+        for ln in f:
+            ln = ln.rstrip("\r\n")
+            if not ln:
+                continue
+            if "\t" in ln:
+                (tarchive,ln) = ln.split("\t",1)
+                tarchive = tarchive.replace("\\","/")
+                if tarchive.rsplit("/",1)[-1] != os.path.basename(archive):
+                    continue
+            trace.append((archive,ln.replace("/",SEP)))
+    finally:
+        f.close()
+    return trace
+
+
+def build(archive,preload=[],trace=None,build_jobs=1,**kwds):
+    """Write the index file for a single zipfile.
+
+    Any trace file is loaded with load_trace(), and "build_jobs" gives the
+    number of worker processes used to precompile modules.  All other
+    keyword arguments are passed on to zipimporter.write_index().
+    """
+    importer = _open_archive(archive)
+    try:
+        if trace is not None:
+            trace = load_trace(trace,archive)
+        importer.write_index(preload=preload,trace=trace,jobs=build_jobs,
+                             **kwds)
+        (files,info) = zipimportx._load_index(archive + archive_index)
+        npreload = len([1 for toc in files.itervalues() if len(toc) > 8])
+        size = os.stat(archive + archive_index).st_size
+    finally:
+        zipimportx._forget_archive(archive)
+    return "wrote index: %d entries, %d preloaded, %d bytes" \
+           % (len(files),npreload,size,)
+
+
+def inline(archive,output=None,**kwds):
+    """Write inline python code for a single zipfile.
+
+    The code is written to the given output file, which defaults to the
+    archive path with ".py" appended.  If the output is "-", the code is
+    returned rather than written.  All other keyword arguments are passed
+    on to zipimporter.get_inline_code().
+    """
+    importer = _open_archive(archive)
+    try:
+        code = importer.get_inline_code(**kwds)
+    finally:
+        zipimportx._forget_archive(archive)
+    if output == "-":
+        return code
+    if output is None:
+        output = archive + ".py"
+    f = open(output,"w")
+    try:
+        f.write(code)
+        f.write("\n")
+    finally:
+        f.close()
+    return "wrote %s: %d bytes" % (output,len(code) + 1,)
+
+
+def stats(archive):
+    """Get statistics about the index file for a single zipfile.
+
+    This returns a dict giving the number of entries in the index, the
+    number and total size of preloaded files, the number of precompiled
+    modules, the size of the index and the zipfile, whether the index is
+    in the lazy binary format and whether it's stale.
+    """
+    indexpath = archive + archive_index
+    index = zipimportx._load_index(indexpath)
+    if index is None:
+        raise ValueError("index is not for this platform")
+    (files,info) = index
+    result = {"entries": 0, "preloaded": 0, "preloaded_bytes": 0}
+    for toc in files.itervalues():
+        result["entries"] += 1
+        if len(toc) > 8:
+            result["preloaded"] += 1
+            result["preloaded_bytes"] += len(toc[8])
+    result["precompiled"] = len(info.get("modules",()))
+    result["lazy"] = isinstance(files,zipimportx._LazyDirectory)
+    result["index_size"] = os.stat(indexpath).st_size
+    result["archive_size"] = os.stat(archive).st_size
+    fingerprint = info.get("fingerprint")
+    result["stale"] = not zipimportx._check_fingerprint(archive,fingerprint)
+    return result
+
+
+def format_stats(result):
+    """Format the statistics from stats() as a single line of text."""
+    if result["archive_size"]:
+        ratio = 100.0 * result["index_size"] / result["archive_size"]
+    else:
+        ratio = 0.0
+    s = "%(entries)d entries, %(preloaded)d preloaded " \
+        "(%(preloaded_bytes)d bytes), %(precompiled)d precompiled; " \
+        "index %(index_size)d bytes, archive %(archive_size)d bytes" % result
+    s += " (%.1f%%)" % (ratio,)
+    if result["lazy"]:
+        s += " [lazy]"
+    if result["stale"]:
+        s += " [stale]"
+    return s
+
+
+def verify(archive):
+    """Check that the index file for a single zipfile matches the zipfile.
+
+    This checks the fingerprint stored in the index (including the CRC of
+    the central directory), compares every entry in the index against the
+    directory read from the zipfile, and compares the data for each
+    preloaded file against the data in the zipfile.  It returns a list of
+    problems found, which is empty if the index is valid.
+    """
+    index = zipimportx._load_index(archive + archive_index)
+    if index is None:
+        return ["index is not for this platform"]
+    (files,info) = index
+    problems = []
+    fingerprint = info.get("fingerprint")
+    if fingerprint is None:
+        problems.append("index has no fingerprint")
+    elif not zipimportx._check_fingerprint(archive,fingerprint,True):
+        problems.append("fingerprint does not match zipfile")
+    directory = zipimportx._read_directory(archive)
+    if directory is None:
+        directory = zipimport.zipimporter(archive)._files
+    missing = [key for key in directory if key not in files]
+    if missing:
+        problems.append("%d files missing from index" % (len(missing),))
+    changed = []
+    preloaded = []
+    for key in files:
+        toc = files[key]
+        dirtoc = directory.get(key)
+        if dirtoc is None or tuple(dirtoc[1:8]) != tuple(toc[1:8]):
+            changed.append(key)
+        elif len(toc) > 8:
+            preloaded.append((key,dirtoc))
+    if changed:
+        err = "%d index entries differ from zipfile" % (len(changed),)
+        problems.append(err)
+    zipimportx._forget_archive(archive)
+    try:
+        data = zipimportx._read_members(archive,preloaded)
+    finally:
+        zipimportx._forget_archive(archive)
+    bad = [key for (key,_) in preloaded if data[key] != files[key][8]]
+    if bad:
+        problems.append("%d preloaded files differ from zipfile" % (len(bad),))
+    return problems
+
+
+def _default_jobs():
+    """Get the default number of worker processes, one per CPU."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+        return 1
+
+
+def _run_task(task):
+    """Run a single command on a single archive, in a worker process.
+
+    Returns a tuple (archive,ok,message).  Errors are reported in the
+    message, so that one bad archive doesn't stop the others.
+    """
+    (command,archive,kwds) = task
+    try:
+        if command == "build":
+            return (archive,True,build(archive,**kwds))
+        if command == "inline":
+            return (archive,True,inline(archive,**kwds))
+        if command == "stats":
+            return (archive,True,format_stats(stats(archive)))
+        problems = verify(archive)
+        if problems:
+            return (archive,False,"FAILED: " + "; ".join(problems))
+        return (archive,True,"OK")
+    except (EnvironmentError,EOFError,ValueError,TypeError,
+            zipimport.ZipImportError), e:
+        return (archive,False,"ERROR: %s" % (e,))
+
+
+def run(command,archives,jobs=None,**kwds):
+    """Run a command over many archives, yielding results as they finish.
+
+    The archives are processed by a pool of "jobs" worker processes, which
+    defaults to the number of CPUs.  Results are yielded as tuples
+    (archive,ok,message) in the order the archives were given.
+    """
+    tasks = [(command,os.path.abspath(a),kwds) for a in archives]
+    if jobs is None:
+        jobs = _default_jobs()
+    jobs = min(jobs,len(tasks))
+    if jobs <= 1:
+        for task in tasks:
+            yield _run_task(task)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(_run_task,tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _make_parser(command):
+    usage = "usage: %%prog %s [options] ARCHIVE..." % (command,)
+    parser = optparse.OptionParser(usage=usage,prog="python -m zipimportx")
+    parser.add_option("-j","--jobs",type="int",default=None,
+                      help="number of worker processes (default: #cpus)")
+    if command in ("build","inline"):
+        parser.add_option("--platform",default=None,
+                          help="build for this platform (win32 or posix)")
+    if command == "build":
+        parser.add_option("-p","--preload",action="append",default=[],
+                          metavar="PATTERN",
+                          help="include data for files matching PATTERN")
+        parser.add_option("-t","--trace",default=None,metavar="FILE",
+                          help="include data for files listed in FILE")
+        parser.add_option("--precompiled",action="store_true",default=False,
+                          help="store precompiled code for all modules")
+        parser.add_option("--lookup",action="store_true",default=False,
+                          help="store a module lookup table")
+        parser.add_option("--lazy",action="store_true",default=False,
+                          help="write a lazily-decoded binary index")
+        parser.add_option("--incremental",action="store_true",default=False,
+                          help="reuse data for unchanged files")
+    if command == "inline":
+        parser.add_option("-o","--output",default=None,metavar="FILE",
+                          help="write to FILE, or '-' for stdout "
+                               "(default: ARCHIVE.py)")
+        parser.add_option("--compact",action="store_true",default=False,
+                          help="embed the data as compact strings")
+        parser.add_option("--no-bootstrap",action="store_false",
+                          dest="bootstrap_zipimportx",default=True,
+                          help="don't include the zipimportx module itself")
+    return parser
+
+
+def main(argv=None):
+    """Command-line entry point; returns the exit status."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS:
+        sys.stderr.write("usage: python -m zipimportx COMMAND [options] "
+                         "ARCHIVE...\n")
+        sys.stderr.write("commands: %s\n" % (", ".join(COMMANDS),))
+        return 2
+    command = argv[0]
+    parser = _make_parser(command)
+    (opts,archives) = parser.parse_args(argv[1:])
+    if not archives:
+        parser.error("no archives given")
+    kwds = dict(opts.__dict__)
+    jobs = kwds.pop("jobs")
+    if command == "inline" and len(archives) > 1 and opts.output:
+        parser.error("--output can only be used with a single archive")
+    #  Workers can't start pools of their own, so a single archive is
+    #  built in this process with its modules precompiled in parallel.
+    if command == "build" and len(archives) == 1:
+        if jobs is None:
+            jobs = _default_jobs()
+        kwds["build_jobs"] = jobs
+        jobs = 1
+    status = 0
+    for (archive,ok,message) in run(command,archives,jobs,**kwds):
+        if command == "inline" and opts.output == "-" and ok:
+            sys.stdout.write(message + "\n")
+        else:
+            sys.stdout.write("%s: %s\n" % (archive,message,))
+        if not ok:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,704 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+zipimportx.bench:  benchmark suite for zipimportx
+================================================
+
+
+This module builds synthetic zipfiles and times the common import operations
+on them, for the builtin zipimport module and for each of the ways zipimportx
+can be used.  Run it like so::
+
+    python -m zipimportx.bench run --output results.json
+
+The zipfiles are generated from a grid of parameters: the number of entries,
+the size of each entry, whether entries are compressed, and how deeply they
+are nested in packages.  For each zipfile and each mode, the following
+operations are timed:
+
+    * init:         open the zipfile, i.e. create the importer
+    * find_hit:     find_module() for a module that's present
+    * find_miss:    find_module() for a module that's not present
+    * load:         load_module() for a module
+    * get_data:     get_data() for a file
+    * build:        build the index or inline code, where applicable
+
+The modes are "zipimport" (the builtin module), "noindex" (zipimportx without
+an index file), "python_directory" (zipimportx without an index file, parsing
+the directory in pure python), "index" (with an index file), "index_unchecked"
+(with an index file, but without checking it against the zipfile), "preload"
+(with all data preloaded into the index) and "inline" (compact inline code).
+When the "inline" mode is run, the time to compile the inline code is also
+measured for both the dict literal and compact forms.
+
+The memory used per entry by the directory information is also measured,
+both as a plain dict and as a compact directory.  When the "inline" mode is
+run on linux, the growth in resident memory from running the inline code in
+a fresh interpreter is measured for both the dict literal and compact forms.
+
+Each operation is timed with a warm page cache.  Pass "--cold" to also time
+each one with a cold cache; this drops the page cache for the whole system
+before each sample, so it's off by default and needs linux and root.  Before
+each cold sample, everything cached about the zipfile is forgotten and its
+memory map released, so that the data really is read from disk.  The results
+are written as JSON, and two sets of results can be compared to
+flag any regressions::
+
+    python -m zipimportx.bench compare baseline.json results.json
+
+To take the same measurements on your own zipfiles rather than synthetic ones,
+use the "archives" command.  For each zipfile given, this reports the memory
+used per entry by its directory information as a plain dict and as a compact
+directory, and times the parsing of its central directory by the builtin
+zipimport module ("zipimport") and by zipimportx in pure python
+("python_directory"), with a warm and (given "--cold") a cold page cache::
+
+    python -m zipimportx.bench archives --cold --output results.json lib*.zip
+
+"""
+
+import os
+import re
+import sys
+import gc
+import imp
+import json
+import time
+import timeit
+import marshal
+import shutil
+import zipfile
+import zipimport
+import tempfile
+import optparse
+import subprocess
+
+import zipimportx
+
+
+MODES = ("zipimport","noindex","python_directory","index","index_unchecked",
+         "preload","inline",)
+OPERATIONS = ("init","find_hit","find_miss","load","get_data","build",)
+
+
+def build_archive(path,entries,size,compress,depth):
+    """Build a synthetic zipfile of bytecode modules.
+
+    The zipfile will contain the given number of entries, each being a
+    bytecode file of roughly the given size.  They're spread over a chain of
+    nested packages of the given depth, with one package at each level.
+    Returns a tuple (package,module,datafile) giving the dotted name of the
+    innermost package, the name of a module within it, and the path of a
+    file to be used with get_data().
+    """
+    if compress:
+        compression = zipfile.ZIP_DEFLATED
+    else:
+        compression = zipfile.ZIP_STORED
+    pkgs = ["zxbench%d" % (i,) for i in xrange(depth)]
+    dirs = ["/".join(pkgs[:i+1]) for i in xrange(depth)]
+    header = imp.get_magic() + "\0\0\0\0"
+    zf = zipfile.ZipFile(path,"w",compression)
+    try:
+        for dirnm in dirs:
+            code = compile("","<zxbench>","exec")
+            zf.writestr(dirnm + "/__init__.pyc",header + marshal.dumps(code))
+        nmodules = max(entries - depth,1)
+        for i in xrange(nmodules):
+            #  Vary the content so that compression has something to do.
+            value = ("%d " % (i,)) * (size // 8 + 1)
+            code = compile("x = %r" % (value[:size // 2],),"<zxbench>","exec")
+            dirnm = dirs[i % depth] if dirs else ""
+            if dirnm:
+                name = "%s/mod%d.pyc" % (dirnm,i,)
+            else:
+                name = "mod%d.pyc" % (i,)
+            zf.writestr(name,header + marshal.dumps(code))
+    finally:
+        zf.close()
+    #  Pick a module that lives in the innermost package.
+    i = depth - 1 if depth else 0
+    modnm = "mod%d" % (i,)
+    if dirs:
+        datafile = dirs[-1] + "/" + modnm + ".pyc"
+    else:
+        datafile = modnm + ".pyc"
+    return (".".join(pkgs),modnm,datafile.replace("/",os.sep))
+
+
+def drop_page_cache():
+    """Try to drop the OS page cache.
+
+    This drops the cache for the whole system, not just for one file, since
+    python has no portable way to evict a single file.  Returns True if
+    successful, False if not possible on this platform or with the current
+    privileges.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        os.system("sync")
+        with open("/proc/sys/vm/drop_caches","w") as f:
+            f.write("1\n")
+    except EnvironmentError:
+        return False
+    return True
+
+
+def sizeof_directory(files):
+    """Estimate the memory used by some directory information, in bytes."""
+    size = sys.getsizeof(files)
+    if isinstance(files,dict):
+        for (k,v) in files.iteritems():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+            #  Small ints are shared, so don't count them.
+            for x in v:
+                if not isinstance(x,int) or x > 256:
+                    size += sys.getsizeof(x)
+    else:
+        size += sys.getsizeof(files._names)
+        size += sum(sys.getsizeof(nm) for nm in files._names)
+        size += sum(sys.getsizeof(c) for c in files._columns)
+        size += sys.getsizeof(files._dirs)
+        size += sum(sys.getsizeof(d) for d in files._dirs)
+    return size
+
+
+def measure_directory(archive):
+    """Measure the memory used per entry by the directory of a zipfile.
+
+    Returns a dict mapping "dict" and "compact" to the bytes per entry used
+    by the plain and compact forms of the directory information.
+    """
+    zipimportx._forget_archive(archive)
+    files = zipimport.zipimporter(archive)._files
+    zipimportx._forget_archive(archive)
+    cfiles = zipimportx._compact_directory(files)
+    return {"dict": sizeof_directory(files) / float(len(files)),
+            "compact": sizeof_directory(cfiles) / float(len(files))}
+
+
+#  Script run in a fresh interpreter to measure the memory used by inline code.
+_RSS_SCRIPT = """
+import os, sys, gc
+sys.path.insert(0,%(libdir)r)
+import zipimportx
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+gc.collect()
+base = rss()
+with open(%(codefile)r) as f:
+    code = compile(f.read(),"<inline>","exec")
+exec code in {}
+del code
+gc.collect()
+print rss() - base
+"""
+
+
+def measure_inline_rss(archive,compact,workdir):
+    """Measure the resident memory used by the inline code for a zipfile.
+
+    The inline code is generated and then read, compiled and executed in a
+    fresh interpreter, and the growth in its resident set size is returned
+    in bytes.  Returns None if the RSS can't be measured on this platform.
+    """
+    if not os.path.exists("/proc/self/statm"):
+        return None
+    zipimportx._forget_archive(archive)
+    importer = zipimportx.zipimporter(archive)
+    code = importer.get_inline_code(compact=compact,
+                                    bootstrap_zipimportx=False)
+    zipimportx._forget_archive(archive)
+    codefile = os.path.join(workdir,"inline.py")
+    with open(codefile,"w") as f:
+        f.write(code)
+    libdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = _RSS_SCRIPT % {"libdir": libdir, "codefile": codefile}
+    try:
+        proc = subprocess.Popen([sys.executable,"-c",script],
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            return None
+        return int(output.strip())
+    finally:
+        os.unlink(codefile)
+
+
+def measure_inline_compile(archive,min_time,repeat):
+    """Time the compilation of the inline code for a zipfile.
+
+    Returns a list of (mode,seconds) pairs, giving the time to compile the
+    inline code in its dict literal ("inline_dict") and compact
+    ("inline_compact") forms.
+    """
+    zipimportx._forget_archive(archive)
+    importer = zipimportx.zipimporter(archive)
+    codes = []
+    for compact in (False,True):
+        codes.append(importer.get_inline_code(compact=compact,
+                                              bootstrap_zipimportx=False))
+    zipimportx._forget_archive(archive)
+    times = []
+    for (mode,code) in zip(("inline_dict","inline_compact"),codes):
+        func = lambda: compile(code,"<inline>","exec")
+        times.append((mode,_time_op(func,min_time,repeat,False)))
+    return times
+
+
+class _Mode(object):
+    """Setup and operations for one way of importing from a zipfile."""
+
+    def __init__(self,mode,archive,package,module,datafile):
+        self.mode = mode
+        self.archive = archive
+        self.package = package
+        self.module = module
+        self.datafile = datafile
+        self.inline_code = None
+        self.inline_name = None
+        self.importer = None
+
+    def setup(self):
+        """Prepare the index files etc needed for this mode."""
+        zipimportx.zipimporter.verify_index = True
+        zipimportx.zipimporter.python_directory = False
+        if os.path.exists(self.archive + ".idx"):
+            os.unlink(self.archive + ".idx")
+        zipimportx._forget_archive(self.archive)
+        if self.mode in ("index","index_unchecked","preload","inline"):
+            self.build()
+        if self.mode == "index_unchecked":
+            zipimportx.zipimporter.verify_index = False
+        if self.mode == "python_directory":
+            zipimportx.zipimporter.python_directory = True
+        if self.mode == "inline":
+            self.inline_code = compile(self.inline_code,"<inline>","exec")
+
+    def teardown(self):
+        zipimportx.zipimporter.verify_index = True
+        zipimportx.zipimporter.python_directory = False
+        self.forget()
+
+    def forget(self):
+        """Forget the importer and everything cached about the zipfile.
+
+        This also releases the memory map of the zipfile, since the pages
+        of a mapped file aren't dropped from the page cache.
+        """
+        self.importer = None
+        zipimportx._forget_archive(self.archive)
+        if self.inline_name is not None:
+            zipimportx._forget_archive(self.inline_name)
+        gc.collect()
+
+    def reopen(self):
+        """Forget everything about the zipfile, then open it again."""
+        self.forget()
+        self.get_importer()
+
+    def build(self):
+        """Build the index or inline code for this mode."""
+        zipimportx._forget_archive(self.archive)
+        importer = zipimportx.zipimporter(self.archive)
+        if self.mode in ("index","index_unchecked"):
+            importer.write_index()
+        elif self.mode == "preload":
+            importer.write_index(preload=["*"])
+        elif self.mode == "inline":
+            code = importer.get_inline_code(compact=True,
+                                            bootstrap_zipimportx=False)
+            self.inline_code = code
+            #  The inline code does nothing if its data is already loaded,
+            #  so we need its name in order to forget about it.
+            self.inline_name = re.search("<zipimportx-[0-9a-f]+>",
+                                         self.inline_code).group(0)
+        zipimportx._forget_archive(self.archive)
+
+    def init(self):
+        """Open the zipfile, and return an importer for the inner package."""
+        zipimportx._forget_archive(self.archive)
+        if self.mode == "zipimport":
+            return zipimport.zipimporter(self.archive)
+        if self.mode == "inline":
+            zipimportx._forget_archive(self.inline_name)
+            meta_path = sys.meta_path[:]
+            exec self.inline_code in {}
+            importer = sys.meta_path[-1]
+            sys.meta_path[:] = meta_path
+            return importer
+        return zipimportx.zipimporter(self.archive)
+
+    def get_importer(self):
+        """Get an importer for the innermost package, opening if necessary."""
+        if self.importer is None:
+            importer = self.init()
+            if self.package:
+                path = importer.archive
+                path += os.sep + self.package.replace(".",os.sep)
+                importer = importer.__class__(path)
+            self.importer = importer
+        return self.importer
+
+    def fullname(self,modnm):
+        if self.package:
+            return self.package + "." + modnm
+        return modnm
+
+    def find_hit(self):
+        return self.get_importer().find_module(self.fullname(self.module))
+
+    def find_miss(self):
+        return self.get_importer().find_module(self.fullname("missing"))
+
+    def load(self):
+        fullname = self.fullname(self.module)
+        try:
+            return self.get_importer().load_module(fullname)
+        finally:
+            sys.modules.pop(fullname,None)
+
+    def get_data(self):
+        return self.get_importer().get_data(self.datafile)
+
+
+def _time_op(func,min_time,repeat,cold,prepare=None):
+    """Time a single operation, returning the best time per call.
+
+    With a warm cache, the operation is called enough times to take at least
+    "min_time" seconds, and the best of "repeat" such runs is taken.  With a
+    cold cache, "prepare" is called and then the page cache is dropped before
+    each single call.
+    """
+    if cold:
+        times = []
+        for _ in xrange(repeat):
+            if prepare is not None:
+                prepare()
+            if not drop_page_cache():
+                return None
+            t = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - t)
+        return min(times)
+    timer = timeit.Timer(func)
+    best = None
+    for _ in xrange(repeat):
+        number = 1
+        total = timer.timeit(number)
+        while total < min_time:
+            number = number * 10
+            total = timer.timeit(number)
+        if best is None or total / number < best:
+            best = total / number
+    return best
+
+
+def run_suite(entries=(100,1000,10000),sizes=(1024,16384),
+              compress=(True,False),depths=(1,4),modes=MODES,
+              operations=OPERATIONS,min_time=0.2,repeat=3,cold=False,
+              workdir=None,log=None):
+    """Run the benchmark suite, returning the results as a dict.
+
+    The results dict has keys "meta" giving details of the environment, and
+    "results" giving a list of dicts, one per timing.  Each of these has keys
+    "scenario" (the parameters of the zipfile), "mode", "op", "cache" (either
+    "warm" or "cold") and "seconds".  Cold timings are only taken if "cold"
+    is true, and are skipped if the page cache can't be dropped;
+    meta["caches"] lists the caches actually used.
+
+    The key "memory" gives a list of dicts, one per memory measurement, with
+    keys "scenario", "mode", "metric" and "value".
+    """
+    ownworkdir = (workdir is None)
+    if ownworkdir:
+        workdir = tempfile.mkdtemp(prefix="zxbench")
+    results = []
+    memory = []
+    caches = ["warm"]
+    if cold and drop_page_cache():
+        caches.append("cold")
+    try:
+        for nentries in entries:
+          for size in sizes:
+            for zipped in compress:
+              for depth in depths:
+                scenario = {"entries": nentries, "size": size,
+                            "compress": zipped, "depth": depth}
+                archive = "%d-%d-%s-%d.zip" % (nentries,size,
+                                               "z" if zipped else "s",depth,)
+                archive = os.path.join(workdir,archive)
+                (package,module,datafile) = build_archive(archive,nentries,
+                                                          size,zipped,depth)
+                dirsizes = measure_directory(archive)
+                for mode in sorted(dirsizes):
+                    result = {"scenario": scenario, "mode": mode,
+                              "metric": "directory_bytes_per_entry",
+                              "value": dirsizes[mode]}
+                    memory.append(result)
+                    if log is not None:
+                        log.write(format_result(result) + "\n")
+                if "inline" in modes:
+                    for compact in (False,True):
+                        rss = measure_inline_rss(archive,compact,workdir)
+                        if rss is None:
+                            continue
+                        mode = "inline_compact" if compact else "inline_dict"
+                        result = {"scenario": scenario, "mode": mode,
+                                  "metric": "rss_bytes", "value": rss}
+                        memory.append(result)
+                        if log is not None:
+                            log.write(format_result(result) + "\n")
+                    for (mode,t) in measure_inline_compile(archive,min_time,
+                                                           repeat):
+                        result = {"scenario": scenario, "mode": mode,
+                                  "op": "compile", "cache": "warm",
+                                  "seconds": t}
+                        results.append(result)
+                        if log is not None:
+                            log.write(format_result(result) + "\n")
+                for mode in modes:
+                    m = _Mode(mode,archive,package,module,datafile)
+                    m.setup()
+                    try:
+                        for op in operations:
+                            prepare = m.forget
+                            if op == "build":
+                                if mode in ("zipimport","noindex",
+                                            "python_directory"):
+                                    continue
+                                func = m.build
+                            elif op == "init":
+                                func = m.init
+                            else:
+                                m.reopen()
+                                prepare = m.reopen
+                                func = getattr(m,op)
+                            for cache in caches:
+                                t = _time_op(func,min_time,repeat,
+                                             cache == "cold",prepare)
+                                if t is None:
+                                    continue
+                                result = {"scenario": scenario, "mode": mode,
+                                          "op": op, "cache": cache,
+                                          "seconds": t}
+                                results.append(result)
+                                if log is not None:
+                                    log.write(format_result(result) + "\n")
+                    finally:
+                        m.teardown()
+                os.unlink(archive)
+                if os.path.exists(archive + ".idx"):
+                    os.unlink(archive + ".idx")
+    finally:
+        if ownworkdir:
+            shutil.rmtree(workdir,ignore_errors=True)
+    meta = {"python": sys.version.split()[0],
+            "platform": sys.platform,
+            "zipimportx": zipimportx.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "caches": caches,}
+    return {"meta": meta, "results": results, "memory": memory}
+
+
+def _parse_directory(mode,archive):
+    """Parse the central directory of a zipfile in the given mode."""
+    if mode == "zipimport":
+        zipimport._zip_directory_cache.pop(archive,None)
+        return zipimport.zipimporter(archive)._files
+    return zipimportx._read_directory(archive)
+
+
+def run_archives(archives,min_time=0.2,repeat=3,cold=False,log=None):
+    """Take measurements on some existing zipfiles.
+
+    The results have the same format as those of run_suite(), except that
+    each scenario is a dict with keys "archive" (the filename of the zipfile)
+    and "entries" (the number of entries in it).  The zipfiles and any index
+    files for them are not modified.
+    """
+    results = []
+    memory = []
+    caches = ["warm"]
+    if cold and drop_page_cache():
+        caches.append("cold")
+    for archive in archives:
+        archive = os.path.abspath(archive)
+        zipimportx._forget_archive(archive)
+        nentries = len(zipimport.zipimporter(archive)._files)
+        scenario = {"archive": os.path.basename(archive),
+                    "entries": nentries}
+        dirsizes = measure_directory(archive)
+        for mode in sorted(dirsizes):
+            result = {"scenario": scenario, "mode": mode,
+                      "metric": "directory_bytes_per_entry",
+                      "value": dirsizes[mode]}
+            memory.append(result)
+            if log is not None:
+                log.write(format_result(result) + "\n")
+        for mode in ("zipimport","python_directory"):
+            func = lambda: _parse_directory(mode,archive)
+            prepare = lambda: zipimportx._forget_archive(archive)
+            for cache in caches:
+                t = _time_op(func,min_time,repeat,cache == "cold",prepare)
+                if t is None:
+                    continue
+                result = {"scenario": scenario, "mode": mode,
+                          "op": "parse", "cache": cache, "seconds": t}
+                results.append(result)
+                if log is not None:
+                    log.write(format_result(result) + "\n")
+        zipimportx._forget_archive(archive)
+    meta = {"python": sys.version.split()[0],
+            "platform": sys.platform,
+            "zipimportx": zipimportx.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "caches": caches,}
+    return {"meta": meta, "results": results, "memory": memory}
+
+
+def result_key(result):
+    """Get a string uniquely identifying the measurement in a result."""
+    s = result["scenario"]
+    if "archive" in s:
+        key = "%s/%s/" % (s["archive"],result["mode"],)
+    else:
+        key = "%d/%d/%s/%d/%s/" % (s["entries"],s["size"],
+                                   "z" if s["compress"] else "s",
+                                   s["depth"],result["mode"],)
+    if "metric" in result:
+        return key + result["metric"]
+    return key + "%s/%s" % (result["op"],result["cache"],)
+
+
+def _result_value(result):
+    if "metric" in result:
+        return result["value"]
+    return result["seconds"]
+
+
+def format_value(key,value):
+    """Format a measured value for display, in units chosen by its key."""
+    if key.endswith("/warm") or key.endswith("/cold"):
+        return "%12.3fus" % (value * 1e6,)
+    return "%12.1f  " % (value,)
+
+
+def format_result(result):
+    key = result_key(result)
+    return "%-48s %s" % (key,format_value(key,_result_value(result)),)
+
+
+def _all_results(results):
+    return results["results"] + results.get("memory",[])
+
+
+def compare(baseline,current,threshold=0.1):
+    """Compare two sets of results, finding any regressions.
+
+    Returns a list of (key,old,new,ratio) tuples for every measurement found
+    in both sets, sorted by key, and a list of the keys for measurements that
+    are larger (i.e. slower, or using more memory) than the baseline by more
+    than the given fraction.
+    """
+    old = dict((result_key(r),_result_value(r))
+               for r in _all_results(baseline))
+    new = dict((result_key(r),_result_value(r))
+               for r in _all_results(current))
+    rows = []
+    regressions = []
+    for key in sorted(old):
+        if key not in new:
+            continue
+        if old[key] > 0:
+            ratio = new[key] / old[key]
+        else:
+            ratio = 1.0
+        rows.append((key,old[key],new[key],ratio))
+        if ratio > 1 + threshold:
+            regressions.append(key)
+    return (rows,regressions)
+
+
+def _intlist(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main(argv=None):
+    """Command-line entry point for the benchmark suite."""
+    if argv is None:
+        argv = sys.argv[1:]
+    usage = "usage: %prog run [options]\n" \
+            "       %prog archives [options] ZIPFILE...\n" \
+            "       %prog compare [options] BASELINE CURRENT"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-o","--output",default=None,
+                      help="write JSON results to this file")
+    parser.add_option("--entries",default="100,1000,10000",
+                      help="comma-separated list of entry counts")
+    parser.add_option("--sizes",default="1024,16384",
+                      help="comma-separated list of entry sizes")
+    parser.add_option("--compress",default="both",
+                      choices=("both","on","off"),
+                      help="compress entries: both, on or off")
+    parser.add_option("--depths",default="1,4",
+                      help="comma-separated list of package depths")
+    parser.add_option("--modes",default=",".join(MODES),
+                      help="comma-separated list of modes to run")
+    parser.add_option("--repeat",type="int",default=3,
+                      help="number of repeats for each timing")
+    parser.add_option("--min-time",type="float",default=0.2,
+                      help="minimum time for each warm repeat")
+    parser.add_option("--cold",action="store_true",default=False,
+                      help="also time with a cold cache, by dropping the "
+                           "page cache for the whole system (needs root)")
+    parser.add_option("--threshold",type="float",default=0.1,
+                      help="fractional slowdown counted as a regression")
+    (opts,args) = parser.parse_args(argv)
+    if not args or args[0] not in ("run","archives","compare"):
+        parser.error("expected a command: run, archives or compare")
+    if args[0] in ("run","archives"):
+        if args[0] == "archives":
+            if len(args) < 2:
+                parser.error("archives needs at least one zipfile")
+            results = run_archives(args[1:],min_time=opts.min_time,
+                                   repeat=opts.repeat,cold=opts.cold,
+                                   log=sys.stderr)
+        else:
+            compress = {"both": (True,False), "on": (True,), "off": (False,)}
+            results = run_suite(entries=_intlist(opts.entries),
+                                sizes=_intlist(opts.sizes),
+                                compress=compress[opts.compress],
+                                depths=_intlist(opts.depths),
+                                modes=opts.modes.split(","),
+                                min_time=opts.min_time,repeat=opts.repeat,
+                                cold=opts.cold,log=sys.stderr)
+        if opts.output is None:
+            json.dump(results,sys.stdout,indent=1,sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            with open(opts.output,"w") as f:
+                json.dump(results,f,indent=1,sort_keys=True)
+        return 0
+    if len(args) != 3:
+        parser.error("compare needs two results files")
+    with open(args[1]) as f:
+        baseline = json.load(f)
+    with open(args[2]) as f:
+        current = json.load(f)
+    (rows,regressions) = compare(baseline,current,opts.threshold)
+    for (key,old,new,ratio) in rows:
+        flag = "  REGRESSION" if key in regressions else ""
+        print "%-48s %s %s %6.2fx%s" % (key,format_value(key,old),
+                                        format_value(key,new),ratio,flag,)
+    if regressions:
+        print "%d regression(s) found" % (len(regressions),)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,11 @@
 import os
 import sys
 import unittest
-import timeit
+import imp
+import marshal
 import zipimport
 import zipfile
+from StringIO import StringIO
 
 import zipimportx
 
@@ -27,6 +29,8 @@ class TestZipImportX(unittest.TestCase):
         lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
         if os.path.exists(lib):
             os.unlink(lib)
+        if os.path.exists(lib+".idx"):
+            os.unlink(lib+".idx")
         zf = zipfile.PyZipFile(lib,"w",compression=zipfile.ZIP_DEFLATED)
         zf.writepy(os.path.dirname(zipimportx.__file__))
         zf.writepy(os.path.dirname(distutils.__file__))
@@ -40,6 +44,8 @@ class TestZipImportX(unittest.TestCase):
         lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
         if os.path.exists(lib):
             os.unlink(lib)
+        if os.path.exists(lib+".idx"):
+            os.unlink(lib+".idx")
         zf = zipfile.PyZipFile(lib,"w")
         zf.writepy(os.path.dirname(zipimportx.__file__))
         zf.writepy(LIBHOME)
@@ -49,6 +55,8 @@ class TestZipImportX(unittest.TestCase):
         lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
         if os.path.exists(lib):
             os.unlink(lib)
+        if os.path.exists(lib+".idx"):
+            os.unlink(lib+".idx")
         zf = zipfile.PyZipFile(lib,"w")
         zf.writepy(os.path.dirname(zipimportx.__file__))
         zf.writepy(LIBHOME)
@@ -64,25 +72,46 @@ class TestZipImportX(unittest.TestCase):
                     pass
         zf.close()
 
-    def test_performance_increase(self):
-        ratios = {
-            "libsmall.zip": 2.4,
-            "libmedium.zip": 3,
-            "liblarge.zip": 3.5,
-        }
-        for libnm in ratios:
-            lib = os.path.abspath(os.path.join(os.path.dirname(__file__),libnm))
-            (zt,xt) = self._do_timeit_init(lib)
-            print libnm, zt, xt, zt/xt
-            self.assertTrue(zt/xt > ratios[libnm])
-        for libnm in ratios:
-            lib = os.path.abspath(os.path.join(os.path.dirname(__file__),libnm))
-            (zt,xt) = self._do_timeit_load(lib)
-            print libnm, zt, xt, zt/xt
-            #  A 50% decrease in loading performance?  Yes, but you have
-            #  to remember that the load time is a *very* small number.
-            #  The absolute difference is measured in microseconds.
-            self.assertTrue(zt/xt > 0.50)
+    def test_bench(self):
+        from zipimportx import bench
+        results = bench.run_suite(entries=(20,),sizes=(64,),compress=(True,),
+                                  depths=(2,),min_time=0.001,repeat=1,
+                                  cold=False)
+        self.assertEquals(results["meta"]["zipimportx"],zipimportx.__version__)
+        self.assertEquals(results["meta"]["caches"],["warm"])
+        seen = set()
+        for r in results["results"]:
+            self.assertEquals(r["scenario"],{"entries":20,"size":64,
+                                             "compress":True,"depth":2})
+            self.assertEquals(r["cache"],"warm")
+            self.assertTrue(r["seconds"] > 0)
+            seen.add((r["mode"],r["op"]))
+        for mode in bench.MODES:
+            for op in ("init","find_hit","find_miss","load","get_data"):
+                self.assertTrue((mode,op) in seen)
+            self.assertEquals((mode,"build") in seen,
+                              mode not in ("zipimport","noindex",
+                                           "python_directory"))
+        self.assertTrue(("inline_dict","compile") in seen)
+        self.assertTrue(("inline_compact","compile") in seen)
+        memory = dict((r["mode"],r["value"]) for r in results["memory"])
+        self.assertEquals(sorted(memory),["compact","dict",
+                                          "inline_compact","inline_dict"])
+        self.assertTrue(memory["compact"] < memory["dict"])
+        for mode in ("inline_compact","inline_dict"):
+            self.assertTrue(memory[mode] >= 0)
+        (rows,regressions) = bench.compare(results,results)
+        self.assertEquals(len(rows),
+                          len(results["results"]) + len(results["memory"]))
+        self.assertEquals(regressions,[])
+        slower = {"meta":results["meta"],"results":[]}
+        for r in results["results"]:
+            r = dict(r)
+            if r["mode"] == "index" and r["op"] == "init":
+                r["seconds"] *= 2
+            slower["results"].append(r)
+        (rows,regressions) = bench.compare(results,slower,threshold=0.5)
+        self.assertEquals(regressions,["20/64/z/2/index/init/warm"])
 
     def test_space_overhead(self):
         for lib in ("libsmall.zip","libmedium.zip","liblarge.zip"):
@@ -95,67 +124,1296 @@ class TestZipImportX(unittest.TestCase):
     def test_import_still_works(self):
         lib = "libsmall.zip"
         lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        #  Put back the real modules afterwards, so later tests use them.
+        saved = dict((nm,mod) for (nm,mod) in sys.modules.items()
+                     if nm == "zipimportx" or nm.startswith("zipimportx."))
+        try:
+            i = zipimportx.zipimporter(lib)
+            del sys.modules["zipimportx"]
+            self.assertTrue(i.find_module("zipimportx") is i)
+            self.assertTrue(i.find_module("nonexistent") is None)
+            fn = lib + os.sep + os.path.join("zipimportx","__init__.pyc")
+            self.assertEquals(i._get_filename("zipimportx"),fn)
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            zx2 = i.load_module("zipimportx")
+            self.assertTrue("zipimporter" in zx2.__dict__)
+            self.assertEquals(zx2.__file__,fn)
+            #  Also check that importing from a subdir works correctly.
+            i2 = zipimportx.zipimporter(lib+os.sep+"zipimportx")
+            zxT = i2.load_module("tests")
+            self.assertTrue("TestZipImportX" in zxT.__dict__)
+            fn = lib + os.sep + os.path.join("zipimportx","tests",
+                                             "__init__.pyc")
+            self.assertEquals(zxT.__file__,fn)
+        finally:
+            sys.modules.pop("tests",None)
+            for nm in sys.modules.keys():
+                if nm == "zipimportx" or nm.startswith("zipimportx."):
+                    del sys.modules[nm]
+            sys.modules.update(saved)
+
+    def test_shared_archive_map(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
         i = zipimportx.zipimporter(lib)
-        del sys.modules["zipimportx"]
-        self.assertTrue(i.find_module("zipimportx") is i)
-        self.assertTrue(i.find_module("nonexistent") is None)
-        fn = lib + os.sep + os.path.join("zipimportx","__init__.pyc")
+        i2 = zipimportx.zipimporter(lib+os.sep+"zipimportx")
+        zf = zipfile.ZipFile(lib)
+        for nm in zf.namelist():
+            self.assertEquals(i.get_data(nm.replace("/",os.sep)),zf.read(nm))
+        zf.close()
+        path = os.path.join("zipimportx","tests","__init__.pyc")
+        self.assertEquals(i2.get_data(path),i.get_data(path))
+        zmap = zipimportx._zip_archive_maps[lib]
+        self.assertTrue(zmap is not None)
+        self.assertTrue(zipimportx._get_archive_map(lib) is zmap)
+
+    def test_prefetch(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        for zmap in (True,None):
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            if zmap is None:
+                zipimportx._zip_archive_maps[lib] = None
+            expected = dict((k,i.get_data(k)) for k in i._files.keys())
+            n = i.prefetch(["logging*","email"+os.sep+"*"])
+            self.assertTrue(n > 0)
+            self.assertEquals(i.prefetch("logging*"),0)
+            preloaded = [k for (k,v) in i._files.iteritems() if len(v) > 8]
+            self.assertEquals(len(preloaded),n)
+            for k in i._files.keys():
+                self.assertEquals(i.get_data(k),expected[k])
+
+    def test_trace(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        #  Load into a fresh module, so the real distutils isn't clobbered.
+        saved = sys.modules.pop("distutils",None)
+        zipimportx.zipimporter.start_trace()
+        try:
+            i.load_module("distutils")
+            i.get_data(os.path.join("zipimportx","tests","__init__.pyc"))
+            i.load_module("distutils")
+        finally:
+            sys.modules.pop("distutils",None)
+            if saved is not None:
+                sys.modules["distutils"] = saved
+            trace = zipimportx.zipimporter.stop_trace()
+        self.assertEquals(trace,[
+            (lib,i._get_filename("distutils")[len(lib)+1:]),
+            (lib,os.path.join("zipimportx","tests","__init__.pyc")),
+        ])
+        self.assertEquals(zipimportx.zipimporter.stop_trace(),[])
+        i.write_index(trace=trace)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        preloaded = [k for (k,v) in i._files.iteritems() if len(v) > 8]
+        self.assertEquals(sorted(preloaded),sorted(p for (a,p) in trace))
+        #  A lazy index stores the traced files first, in order of use.
+        trace.reverse()
+        i.write_index(trace=trace,lazy=True)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        files = i._files
+        self.assertTrue(isinstance(files,zipimportx._LazyDirectory))
+        offsets = dict((files._get_key(n),files._get_entry(n)[2])
+                       for n in xrange(len(files)))
+        traced = [offsets[p] for (a,p) in trace]
+        self.assertEquals(traced,sorted(traced))
+        self.assertTrue(max(traced) < min(offsets[k] for k in offsets
+                                          if k not in [p for (a,p) in trace]))
+        self.assertEquals(len(files[trace[0][1]]),9)
+
+    def test_precompiled_index(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        fn = i._get_filename("distutils")
+        i.write_index(precompiled=True)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        modules = zipimportx._zip_directory_info[lib]["modules"]
+        self.assertTrue("distutils" in modules)
+        #  Loading precompiled code shouldn't need to touch the zipfile.
+        saved = sys.modules.pop("distutils")
+        os.rename(lib,lib+".bak")
+        try:
+            zipimportx._zip_archive_maps.pop(lib,None)
+            mod = i.load_module("distutils")
+            self.assertEquals(mod.__file__,fn)
+            self.assertTrue(hasattr(mod,"__version__"))
+        finally:
+            sys.modules["distutils"] = saved
+            os.rename(lib+".bak",lib)
+        #  An index for some other interpreter falls back to the zipfile.
+        with open(lib+".idx","rb") as f:
+            (index,info) = marshal.load(f)
+        info["magic"] = "XXXX"
+        with open(lib+".idx","wb") as f:
+            marshal.dump((index,info),f)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertFalse("modules" in zipimportx._zip_directory_info[lib])
+        self.assertEquals(i._get_module_code("distutils")[1],fn)
+
+    def test_lookup_table(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        names = ("zipimportx","distutils","logging.config","nonexistent")
+        expected = [i._get_module_type(nm) for nm in names]
+        fn = i._get_filename("zipimportx")
+        i.write_index(lookup=True)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertTrue("lookup" in zipimportx._zip_directory_info[lib])
+        self.assertEquals([i._get_module_type(nm) for nm in names],expected)
         self.assertEquals(i._get_filename("zipimportx"),fn)
+        self.assertTrue(i.find_module("nonexistent") is None)
+        i2 = zipimportx.zipimporter(lib+os.sep+"logging")
+        self.assertTrue(i2.find_module("logging.config") is i2)
+        self.assertTrue(i2.find_module("logging.nonexistent") is None)
+
+    def test_lazy_index(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
         zipimport._zip_directory_cache.clear()
         i = zipimportx.zipimporter(lib)
-        zx2 = i.load_module("zipimportx")
-        self.assertTrue("zipimporter" in zx2.__dict__)
-        self.assertEquals(zx2.__file__,fn)
-        #  Also check that importing from a subdir works correctly.
-        i2 = zipimportx.zipimporter(lib+os.sep+"zipimportx")
-        zxT = i2.load_module("tests")
-        self.assertTrue("TestZipImportX" in zxT.__dict__)
-        fn = lib + os.sep + os.path.join("zipimportx","tests","__init__.pyc")
-        self.assertEquals(zxT.__file__,fn)
-        
-    def _do_timeit_init(self,lib):
-        """Return unindexed and indexed initialisation times."""
-        z_setupcode = "import zipimport"
-        z_testcode = "".join(("zipimport._zip_directory_cache.clear(); ",
-                              "i = zipimport.zipimporter(%r); " % (lib,)))
-        z_timer = timeit.Timer(z_testcode,z_setupcode)
-        z_time = min(self._do_timeit3(z_timer))
-        x_setupcode = "import zipimport; import zipimportx; " \
-                      "del sys.modules['zipimportx']; " \
-                      "zipimportx.zipimporter(%r).write_index()" % (lib,)
-        x_testcode = "".join(("zipimport._zip_directory_cache.clear(); ",
-                              "i = zipimportx.zipimporter(%r); " % (lib,)))
-        x_timer = timeit.Timer(x_testcode,x_setupcode)
-        x_time = min(self._do_timeit3(x_timer))
-        return (z_time,x_time)
-
-    def _do_timeit_load(self,lib):
-        """Return unindexed and indexed load times."""
-        z_setupcode = "import zipimport; " \
-                      "zipimport._zip_directory_cache.clear(); " \
-                      "i = zipimport.zipimporter(%r)" % (lib,)
-        z_testcode = "i.load_module('zipimportx'); del sys.modules['zipimportx']"
-        z_timer = timeit.Timer(z_testcode,z_setupcode)
-        z_time = min(self._do_timeit3(z_timer))
-        x_setupcode = "".join(("import zipimport; import zipimportx; ",
-                          "zipimportx.zipimporter(%r).write_index(); " % (lib,),
-                          "zipimport._zip_directory_cache.clear(); ",
-                          "i = zipimportx.zipimporter(%r)" % (lib,)))
-        x_testcode = "i.load_module('zipimportx'); del sys.modules['zipimportx']"
-        x_timer = timeit.Timer(x_testcode,x_setupcode)
-        x_time = min(self._do_timeit3(x_timer))
-        return (z_time,x_time)
-
-    def _do_timeit3(self,t):
-        return [self._do_timeit(t) for _ in xrange(3)]
-
-    def _do_timeit(self,t):
-        number = 10
-        n = t.timeit(number)
-        while n < 0.2:
-            number = number * 10
-            n = t.timeit(number)
-        return n / number
+        files = dict((k,v[1:]) for (k,v) in i._files.iteritems())
+        i.write_index(lazy=True,lookup=True)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertTrue(isinstance(i._files,zipimportx._LazyDirectory))
+        self.assertTrue("lookup" in zipimportx._zip_directory_info[lib])
+        self.assertEquals(len(i._files),len(files))
+        self.assertEquals(sorted(i._files.keys()),sorted(files.keys()))
+        for (k,v) in files.iteritems():
+            self.assertEquals(i._files[k][1:],v)
+        self.assertTrue(i._files.get("nonexistent") is None)
+        self.assertFalse("nonexistent" in i._files)
+        self.assertTrue(i.find_module("zipimportx") is i)
+        self.assertTrue(i.prefetch("zipimportx*") > 0)
+        data = zipfile.ZipFile(lib).read("zipimportx/__init__.pyc")
+        fn = os.path.join("zipimportx","__init__.pyc")
+        self.assertEquals(i.get_data(fn),data)
+        #  An index for the wrong platform is ignored.
+        if os.sep == "/":
+            i.write_index(lazy=True,platform="win32")
+        else:
+            i.write_index(lazy=True,platform="posix")
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertFalse(isinstance(i._files,zipimportx._LazyDirectory))
+        #  So is a truncated index, falling back to the zipfile.
+        i.write_index(lazy=True)
+        with open(lib + ".idx","rb") as f:
+            contents = f.read()
+        for size in (10,100,len(contents) - 10):
+            with open(lib + ".idx","wb") as f:
+                f.write(contents[:size])
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            self.assertFalse(isinstance(i._files,zipimportx._LazyDirectory))
+            self.assertEquals(sorted(i._files.keys()),sorted(files.keys()))
+
+    def test_merged_index(self):
+        libs = []
+        for libnm in ("libsmall.zip","libmedium.zip"):
+            lib = os.path.join(os.path.dirname(__file__),libnm)
+            libs.append(os.path.abspath(lib))
+        idx = os.path.join(os.path.dirname(libs[0]),"merged.idx")
+        zipimport._zip_directory_cache.clear()
+        files = [zipimportx.zipimporter(lib)._files.copy() for lib in libs]
+        zipimportx.zipimporter.write_merged_index(idx,libs,lookup=True)
+        try:
+            zipimport._zip_directory_cache.clear()
+            loaded = zipimportx.zipimporter.load_merged_index(idx)
+            self.assertEquals(loaded,libs)
+            owners = zipimportx._zip_module_owners
+            self.assertEquals(owners["zipimportx"],libs[0])
+            self.assertEquals(owners["distutils"],libs[0])
+            self.assertEquals(owners["unittest"],libs[1])
+            for (lib,lfiles) in zip(libs,files):
+                i = zipimportx.zipimporter(lib)
+                self.assertEquals(sorted(i._files.keys()),sorted(lfiles))
+                self.assertTrue("lookup" in zipimportx._zip_directory_info[lib])
+            #  Modules are only found in the archive that owns them.
+            small = zipimportx.zipimporter(libs[0])
+            medium = zipimportx.zipimporter(libs[1])
+            self.assertTrue(small.find_module("distutils") is small)
+            self.assertTrue(medium.find_module("distutils") is None)
+            self.assertTrue(medium.find_module("unittest") is medium)
+            self.assertTrue(small.find_module("nonexistent") is None)
+            #  Archives not loaded from the merged index search as normal.
+            large = os.path.join(os.path.dirname(libs[0]),"liblarge.zip")
+            large = zipimportx.zipimporter(os.path.abspath(large))
+            self.assertTrue(medium.find_module("zipimportx") is None)
+            self.assertTrue(large.find_module("zipimportx") is large)
+            data = zipfile.ZipFile(libs[1]).read("unittest/main.pyo")
+            fn = os.path.join("unittest","main.pyo")
+            self.assertEquals(medium.get_data(fn),data)
+            #  A failed write leaves the existing merged index in place.
+            with open(idx,"rb") as f:
+                contents = f.read()
+            def write(f):
+                f.write("partial")
+                raise ValueError("write failed")
+            self.assertRaises(ValueError,zipimportx._write_index_file,
+                              idx,write)
+            with open(idx,"rb") as f:
+                self.assertEquals(f.read(),contents)
+            tmpfiles = [fn for fn in os.listdir(os.path.dirname(idx))
+                        if fn.startswith("merged.idx.")]
+            self.assertEquals(tmpfiles,[])
+            #  Modules aren't attributed to an archive that has changed.
+            zf = zipfile.ZipFile(libs[1],"a")
+            zf.writestr("changed.txt","changed")
+            zf.close()
+            zipimportx._zip_module_owners.clear()
+            zipimport._zip_directory_cache.clear()
+            loaded = zipimportx.zipimporter.load_merged_index(idx)
+            self.assertEquals(loaded,libs)
+            self.assertFalse(libs[1] in zipimport._zip_directory_cache)
+            owners = zipimportx._zip_module_owners
+            self.assertEquals(owners["distutils"],libs[0])
+            self.assertFalse("unittest" in owners)
+            #  Forgetting an archive forgets the modules it was given.
+            zipimportx._forget_archive(libs[0])
+            self.assertFalse("distutils" in owners)
+            self.assertFalse(libs[0] in owners.values())
+        finally:
+            zipimportx._zip_module_owners.clear()
+            os.unlink(idx)
+
+    def test_relayout(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        zf = zipfile.ZipFile(lib)
+        contents = dict((nm,zf.read(nm)) for nm in zf.namelist())
+        zf.close()
+        i = zipimportx.zipimporter(lib)
+        sub = zipimportx.zipimporter(lib + os.sep + "logging")
+        fn = os.path.join("zipimportx","__init__.pyc")
+        trace = [(lib,fn),("other.zip","ignored.pyc")]
+        self.assertEquals(i.relayout(trace + ["logging*"],True),
+                          1 + len([nm for nm in contents
+                                   if nm.startswith("logging")]))
+        self.assertTrue(os.path.exists(lib + ".idx"))
+        zf = zipfile.ZipFile(lib)
+        infos = zf.infolist()
+        self.assertEquals(infos[0].filename,"zipimportx/__init__.pyc")
+        self.assertEquals(infos[0].compress_type,zipfile.ZIP_STORED)
+        self.assertTrue(infos[1].filename.startswith("logging"))
+        self.assertEquals(infos[-1].compress_type,zipfile.ZIP_DEFLATED)
+        self.assertEquals(sorted(zf.namelist()),sorted(contents))
+        zf.close()
+        #  The existing importer sees the new layout.
+        self.assertEquals(i.get_data(fn),contents["zipimportx/__init__.pyc"])
+        #  So do importers for its packages that were created beforehand.
+        subnm = [nm for nm in contents if nm.startswith("logging/handlers")][0]
+        subfn = subnm.replace("/",os.sep)
+        self.assertEquals(sub.get_data(subfn),contents[subnm])
+        (code,filepath,ispkg) = sub._get_module_code("logging.handlers")
+        self.assertEquals(filepath,lib + os.sep + subfn)
+        #  The stock zipimport module still accepts the new zipfile.
+        zipimport._zip_directory_cache.clear()
+        zi = zipimport.zipimporter(lib)
+        for nm in contents:
+            fn = nm.replace("/",os.sep)
+            self.assertEquals(zi.get_data(fn),contents[nm])
+        self.assertTrue(zi.find_module("distutils") is zi)
+        #  Names and patterns are expanded in the order given, with the
+        #  files matching each pattern sorted.
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        fn = os.path.join("zipimportx","__init__.pyc")
+        emails = sorted(nm for nm in contents if nm.startswith("email"))
+        loggings = sorted(nm for nm in contents if nm.startswith("logging"))
+        order = ["email*",fn,"logging*",emails[0].replace("/",os.sep)]
+        self.assertEquals(i.relayout(order),len(emails) + 1 + len(loggings))
+        zf = zipfile.ZipFile(lib)
+        expected = emails + ["zipimportx/__init__.pyc"] + loggings
+        self.assertEquals(zf.namelist()[:len(expected)],expected)
+        zf.close()
+        #  Files that aren't being stored uncompressed are copied exactly,
+        #  including their extra field and comment.  Compress them with a
+        #  non-default level so that recompressing would show.
+        import zlib
+        lib = os.path.join(os.path.dirname(lib),"librelayout.zip")
+        compressobj = zlib.compressobj
+        zipfile.zlib.compressobj = lambda *args: compressobj(1,zlib.DEFLATED,
+                                                             -15)
+        data = zipimportx.__doc__
+        try:
+            zf = zipfile.ZipFile(lib,"w",zipfile.ZIP_DEFLATED)
+            for nm in ("hot.py","cold.py"):
+                zinfo = zipfile.ZipInfo(nm,(2010,1,1,0,0,0))
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.comment = "comment for " + nm
+                zinfo.extra = "\xfe\xca\x04\x00" + nm[:4]
+                zf.writestr(zinfo,data)
+            zf.close()
+            zf = zipfile.ZipFile(lib)
+            before = dict((zi.filename,zi) for zi in zf.infolist())
+            raw = {}
+            for zi in zf.infolist():
+                zf.fp.seek(zi.header_offset + 30 + len(zi.filename) +
+                           len(zi.extra))
+                raw[zi.filename] = zf.fp.read(zi.compress_size)
+            zf.close()
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            self.assertEquals(i.relayout(["hot.py"],True),1)
+            zf = zipfile.ZipFile(lib)
+            self.assertEquals(zf.namelist(),["hot.py","cold.py"])
+            for zi in zf.infolist():
+                self.assertEquals(zi.comment,before[zi.filename].comment)
+                self.assertEquals(zi.extra,before[zi.filename].extra)
+                self.assertEquals(zf.read(zi),data)
+            (hot,cold) = zf.infolist()
+            self.assertEquals(hot.compress_type,zipfile.ZIP_STORED)
+            zf.fp.seek(cold.header_offset + 30 + len(cold.filename) +
+                       len(cold.extra))
+            self.assertEquals(zf.fp.read(cold.compress_size),raw["cold.py"])
+            zf.close()
+        finally:
+            zipfile.zlib.compressobj = compressobj
+            for fn in (lib,lib + ".idx"):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+    def test_read_directory(self):
+        for libnm in ("libsmall.zip","libmedium.zip","liblarge.zip"):
+            lib = os.path.join(os.path.dirname(__file__),libnm)
+            lib = os.path.abspath(lib)
+            zipimport._zip_directory_cache.clear()
+            files = zipimport.zipimporter(lib)._files
+            self.assertEquals(zipimportx._read_directory(lib),files)
+            #  The builtin parser is used by default, since it's faster.
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            self.assertEquals(i._files,files)
+            self.assertFalse("_files" in i.__dict__)
+            zipimport._zip_directory_cache.clear()
+            zipimportx.zipimporter.python_directory = True
+            try:
+                i = zipimportx.zipimporter(lib)
+            finally:
+                zipimportx.zipimporter.python_directory = False
+            self.assertEquals(i._files,files)
+            self.assertTrue("_files" in i.__dict__)
+        #  The benchmark compares the two parsers on each archive.
+        from zipimportx import bench
+        libs = [os.path.abspath(os.path.join(os.path.dirname(__file__),libnm))
+                for libnm in ("libsmall.zip","libmedium.zip","liblarge.zip")]
+        results = bench.run_archives(libs,min_time=0.001,repeat=1)
+        times = dict((bench.result_key(r),r["seconds"])
+                     for r in results["results"])
+        for lib in libs:
+            for mode in ("zipimport","python_directory"):
+                key = "%s/%s/parse/warm" % (os.path.basename(lib),mode,)
+                self.assertTrue(times[key] > 0)
+        #  Data prepended to the zipfile is accounted for, as is a comment.
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        lib2 = lib[:-4] + "-sfx.zip"
+        try:
+            with open(lib2,"wb") as fOut:
+                fOut.write("#!/bin/sh\nexit 0\n")
+                with open(lib,"rb") as fIn:
+                    fOut.write(fIn.read())
+            zf = zipfile.ZipFile(lib2,"a")
+            zf.comment = "a comment containing PK\x05\x06"
+            zf.close()
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib2)
+            self.assertEquals(len(i._files),len(zipfile.ZipFile(lib).infolist()))
+            data = zipfile.ZipFile(lib).read("zipimportx/__init__.pyc")
+            fn = os.path.join("zipimportx","__init__.pyc")
+            self.assertEquals(i.get_data(fn),data)
+        finally:
+            os.unlink(lib2)
+
+    def test_read_directory_zip64(self):
+        lib = "libzip64.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        #  Force zip64 records without needing a 4GB file.
+        limit = zipfile.ZIP64_LIMIT
+        zipfile.ZIP64_LIMIT = 0
+        try:
+            zf = zipfile.ZipFile(lib,"w",zipfile.ZIP_DEFLATED,True)
+            zf.writestr("mod.py","x = 42\n")
+            zf.writestr("data.txt","hello world\n" * 100)
+            zf.close()
+        finally:
+            zipfile.ZIP64_LIMIT = limit
+        try:
+            with open(lib,"rb") as f:
+                self.assertTrue("PK\x06\x06" in f.read())
+            files = zipimportx._read_directory(lib)
+            self.assertEquals(sorted(files),["data.txt","mod.py"])
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            self.assertEquals(i.get_data("data.txt"),"hello world\n" * 100)
+            self.assertEquals(i.get_code("mod").co_consts[0],42)
+        finally:
+            zipimport._zip_directory_cache.clear()
+            os.unlink(lib)
+
+    def test_index_fingerprint(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter(lib).write_index()
+        (files,info) = zipimportx._load_index(lib + ".idx")
+        fingerprint = info["fingerprint"]
+        self.assertEquals(fingerprint[0],os.stat(lib).st_size)
+        self.assertTrue(zipimportx._check_fingerprint(lib,fingerprint))
+        self.assertTrue(zipimportx._check_fingerprint(lib,fingerprint,True))
+        #  Change the zipfile; the stale index is then ignored.
+        zf = zipfile.ZipFile(lib,"a")
+        zf.writestr("newfile.txt","new data")
+        zf.close()
+        self.assertFalse(zipimportx._check_fingerprint(lib,fingerprint))
+        self.assertFalse(zipimportx._check_fingerprint(lib,fingerprint,True))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertEquals(i.get_data("newfile.txt"),"new data")
+        self.assertEquals(len(i._files),len(files) + 1)
+        #  Unless we've asked for it to be trusted blindly.
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter.verify_index = False
+        try:
+            i = zipimportx.zipimporter(lib)
+            self.assertEquals(len(i._files),len(files))
+        finally:
+            zipimportx.zipimporter.verify_index = True
+            zipimport._zip_directory_cache.clear()
+
+    def test_incremental_index(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        kwds = dict(preload=["*"],precompiled=True)
+        zipimportx.zipimporter(lib).write_index(**kwds)
+        zf = zipfile.ZipFile(lib,"a")
+        zf.writestr("newmod.py","x = 42\n")
+        zf.close()
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        #  Count the files that are read or compiled during the rebuild.
+        reads = []
+        compiles = []
+        def _get_data(path,toc=None,raw=False):
+            reads.append(path)
+            return zipimportx.zipimporter._get_data(i,path,toc,raw)
+        def _get_path_code(pathhead):
+            compiles.append(pathhead)
+            return zipimportx.zipimporter._get_path_code(i,pathhead)
+        def _read_members(archive,members):
+            reads.extend(key for (key,toc) in members)
+            return read_members(archive,members)
+        i._get_data = _get_data
+        i._get_path_code = _get_path_code
+        read_members = zipimportx._read_members
+        zipimportx._read_members = _read_members
+        try:
+            i.write_index(incremental=True,**kwds)
+        finally:
+            zipimportx._read_members = read_members
+        self.assertEquals(set(reads),set(["newmod.py"]))
+        self.assertEquals(compiles,["newmod"])
+        (files,info) = zipimportx._load_index(lib + ".idx")
+        self.assertFalse(os.path.exists(lib + ".idx.%d.tmp" % os.getpid()))
+        #  The result is the same as a full rebuild.
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter(lib).write_index(**kwds)
+        (files2,info2) = zipimportx._load_index(lib + ".idx")
+        self.assertEquals(files,files2)
+        self.assertEquals(info,info2)
+        zipimport._zip_directory_cache.clear()
+
+    def test_command_line(self):
+        from zipimportx import __main__ as cli
+        libs = []
+        for lib in ("libsmall.zip","libmedium.zip"):
+            libs.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                     lib)))
+        #  The bytecode files may be .pyc or .pyo depending on the interpreter.
+        zf = zipfile.ZipFile(libs[0])
+        names = dict((nm.rsplit(".",1)[0],nm) for nm in zf.namelist())
+        zf.close()
+        trace = libs[0] + ".trace"
+        f = open(trace,"w")
+        f.write("/elsewhere/libsmall.zip\t%s\n" % (names["distutils/core"],))
+        f.write("/elsewhere/libother.zip\t%s\n" % (names["distutils/util"],))
+        f.write("%s\n" % (names["logging/__init__"],))
+        f.close()
+        stdout = sys.stdout
+        try:
+            sys.stdout = out = StringIO()
+            args = ["build","-j","2","-p","*.txt","-t",trace] + libs
+            self.assertEquals(cli.main(args),0)
+            lines = out.getvalue().splitlines()
+            self.assertEquals(len(lines),2)
+            self.assertTrue(lines[0].startswith(libs[0] + ": wrote index"))
+            (files,info) = zipimportx._load_index(libs[0] + ".idx")
+            preloaded = set(k for (k,v) in files.iteritems() if len(v) > 8)
+            expected = set([names["distutils/core"],names["logging/__init__"]])
+            expected = set(nm.replace("/",os.sep) for nm in expected)
+            self.assertEquals(preloaded,expected)
+            #  A single archive is built here, precompiling in parallel.
+            sys.stdout = out = StringIO()
+            args = ["build","-j","2","--precompiled",libs[0]]
+            self.assertEquals(cli.main(args),0)
+            self.assertTrue(out.getvalue().startswith(libs[0] + ": wrote"))
+            (files,info) = zipimportx._load_index(libs[0] + ".idx")
+            self.assertTrue(info["modules"])
+            args = ["build","-j","2","-p","*.txt","-t",trace,libs[0]]
+            sys.stdout = out = StringIO()
+            self.assertEquals(cli.main(args),0)
+            (files,info) = zipimportx._load_index(libs[0] + ".idx")
+            #  Stats report the contents and size of each index.
+            sys.stdout = out = StringIO()
+            self.assertEquals(cli.main(["stats"] + libs),0)
+            result = cli.stats(libs[0])
+            self.assertEquals(result["entries"],len(files))
+            self.assertEquals(result["preloaded"],2)
+            self.assertEquals(result["index_size"],
+                              os.stat(libs[0] + ".idx").st_size)
+            self.assertFalse(result["stale"])
+            self.assertTrue(cli.format_stats(result) in out.getvalue())
+            #  Verify detects an index that no longer matches its zipfile.
+            sys.stdout = out = StringIO()
+            self.assertEquals(cli.main(["verify"] + libs),0)
+            self.assertEquals(out.getvalue().count(": OK"),2)
+            zf = zipfile.ZipFile(libs[1],"a")
+            zf.writestr("newmod.py","x = 42\n")
+            zf.close()
+            sys.stdout = out = StringIO()
+            self.assertEquals(cli.main(["verify"] + libs),1)
+            self.assertTrue(": FAILED: fingerprint" in out.getvalue())
+            self.assertEquals(cli.verify(libs[0]),[])
+            self.assertTrue("1 files missing from index" in cli.verify(libs[1]))
+            #  Inline code can be written to stdout.
+            sys.stdout = out = StringIO()
+            args = ["inline","--compact","--no-bootstrap","-o","-",libs[0]]
+            self.assertEquals(cli.main(args),0)
+            compile(out.getvalue(),"<inline>","exec")
+            #  Errors are reported per archive.
+            sys.stdout = out = StringIO()
+            self.assertEquals(cli.main(["stats",libs[0] + ".missing"]),1)
+            self.assertTrue(": ERROR:" in out.getvalue())
+        finally:
+            sys.stdout = stdout
+            os.unlink(trace)
+            zipimport._zip_directory_cache.clear()
+
+    def test_parallel_build(self):
+        import fnmatch
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        #  The compiled patterns match exactly as fnmatch does.
+        patterns = ["*.txt","logging*__init__.py?","email/[mp]*"]
+        matches = zipimportx._compile_patterns(patterns)
+        for key in i._files:
+            expected = any(fnmatch.fnmatch(key,p) for p in patterns)
+            self.assertEquals(matches(key),expected)
+        self.assertFalse(zipimportx._compile_patterns([])("x.txt"))
+        #  All preloaded files are read in a single pass, as is the data
+        #  for the inline code.
+        calls = []
+        def _read_members(archive,members):
+            calls.append(len(members))
+            return read_members(archive,members)
+        read_members = zipimportx._read_members
+        zipimportx._read_members = _read_members
+        try:
+            trace = [(lib,nm) for nm in i._files if nm.startswith("email")]
+            (files,info) = i._build_index(preload=patterns,trace=trace)
+            self.assertEquals(len(calls),1)
+            preloaded = [k for (k,v) in files.iteritems() if len(v) > 8]
+            self.assertEquals(calls[0],len(preloaded))
+            for key in preloaded:
+                self.assertEquals(files[key][8],
+                                  i._get_data(key,i._files[key],raw=True))
+            i.get_inline_code(compact=True,bootstrap_zipimportx=False)
+            self.assertEquals(calls[1],len(i._files))
+        finally:
+            zipimportx._read_members = read_members
+        #  Precompiling with a process pool gives the same result, even if
+        #  the worker function can't be pickled and it falls back to
+        #  compiling in this process.
+        (files,info) = i._build_index(precompiled=True)
+        (files2,info2) = i._build_index(precompiled=True,jobs=2)
+        self.assertEquals(info2["modules"],info["modules"])
+        zipimport._zip_directory_cache.clear()
+
+    def test_compact_inline_code(self):
+        #  The compact format is much smaller for many files.
+        lib = "libmany.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zf = zipfile.ZipFile(lib,"w",zipfile.ZIP_DEFLATED)
+        for n in xrange(2000):
+            zf.writestr("pkg%d/mod%d.py" % (n % 50,n,),"x = %d\n" % (n,))
+        zf.close()
+        try:
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            sizes = []
+            for compact in (False,True):
+                code = i.get_inline_code(bootstrap_zipimportx=False,
+                                         compact=compact)
+                compile(code,"<inline>","exec")
+                sizes.append(len(code))
+            self.assertTrue(sizes[1] < sizes[0])
+        finally:
+            zipimport._zip_directory_cache.clear()
+            os.unlink(lib)
+        #  And it still works just like the zipfile.
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        i = zipimportx.zipimporter(lib)
+        code = i.get_inline_code(bootstrap_zipimportx=False,compact=True)
+        meta_path = sys.meta_path[:]
+        distutils = sys.modules.pop("distutils")
+        try:
+            exec code in {}
+            inline = sys.meta_path[-1]
+            name = inline.archive[len(sys.prefix + os.sep):]
+            files = zipimport._zip_directory_cache[name]
+            self.assertTrue(isinstance(files,zipimportx._InlineDirectory))
+            self.assertEquals(len(files),len(i._files))
+            self.assertTrue(inline.find_module("distutils") is inline)
+            mod = inline.load_module("distutils")
+            self.assertTrue("__version__" in mod.__dict__)
+            fn = os.path.join("zipimportx","__init__.pyc")
+            self.assertEquals(inline.get_data(fn),i.get_data(fn))
+            #  Each file is decoded once and kept, and the compressed chunks
+            #  are dropped once all their files have been decoded.
+            self.assertTrue(files[fn] is files[fn])
+            self.assertEquals(files[fn][1],0)
+            self.assertTrue(len(files._chunks) > 1)
+            #  Several threads can safely decode files at once.
+            import threading
+            errors = []
+            def read_all():
+                try:
+                    for key in files.keys():
+                        if inline.get_data(key) != i.get_data(key):
+                            errors.append(key)
+                except Exception, e:
+                    errors.append(e)
+            threads = [threading.Thread(target=read_all) for _ in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals(errors,[])
+            self.assertEquals(files._chunks,[None] * len(files._chunks))
+        finally:
+            sys.meta_path[:] = meta_path
+            sys.modules["distutils"] = distutils
+
+    def test_iter_modules(self):
+        import pkgutil
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        names = zipfile.ZipFile(lib).namelist()
+        i = zipimportx.zipimporter(lib)
+        #  Same modules as found by pkgutil for the builtin zipimporter,
+        #  except that we correctly add the prefix to package names.
+        stock = zipimport.zipimporter(lib)
+        expected = list(pkgutil.iter_importer_modules(stock,""))
+        self.assertEquals(list(i.iter_modules()),expected)
+        self.assertTrue(("distutils",True) in expected)
+        i2 = zipimportx.zipimporter(lib+os.sep+"distutils")
+        modules = dict(i2.iter_modules("distutils."))
+        self.assertEquals(modules["distutils.command"],True)
+        self.assertEquals(modules["distutils.core"],False)
+        self.assertFalse("distutils.__init__" in modules)
+        expected = set()
+        for nm in names:
+            if nm.startswith("distutils/command/"):
+                expected.add(nm.split("/")[2])
+        self.assertEquals(i.listdir(os.path.join("distutils","command")),
+                          sorted(expected))
+        self.assertEquals(i.listdir(lib + os.sep + "distutils" + os.sep),
+                          i2.listdir("distutils"))
+        self.assertTrue("distutils" in i.listdir(""))
+        self.assertRaises(OSError,i.listdir,"nonexistent")
+        #  The tree can also be loaded from the index.
+        i.write_index(lookup=True)
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        self.assertTrue("tree" in zipimportx._zip_directory_info[lib])
+        self.assertTrue(("distutils",True) in list(i.iter_modules()))
+        #  Once installed, pkgutil uses our implementation.  Its registry
+        #  is hidden in the closure of the generic function.
+        path_hooks = sys.path_hooks[:]
+        register = pkgutil.iter_importer_modules.register
+        for cell in register.func_closure:
+            if isinstance(cell.cell_contents,dict):
+                registry = cell.cell_contents
+        saved = registry.copy()
+        try:
+            zipimportx.zipimporter.install()
+            self.assertTrue(zipimportx.zipimporter in registry)
+            modules = list(pkgutil.iter_importer_modules(i,"x."))
+            self.assertTrue(("x.distutils",True) in modules)
+        finally:
+            sys.path_hooks[:] = path_hooks
+            sys.path_importer_cache.clear()
+            registry.clear()
+            registry.update(saved)
+
+    def test_stats(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        distutils = sys.modules.pop("distutils")
+        zipimportx.zipimporter.start_stats()
+        try:
+            i = zipimportx.zipimporter(lib)
+            i.load_module("distutils")
+            i.get_data(os.path.join("zipimportx","__init__.pyc"))
+        finally:
+            stats = zipimportx.zipimporter.stop_stats()
+            sys.modules["distutils"] = distutils
+        self.assertTrue(zipimportx._zip_stats is None)
+        counters = stats["archives"][lib]
+        self.assertEquals(counters["loads"],1)
+        self.assertEquals(counters["reads"],2)
+        self.assertTrue(counters["read_bytes"] > 0)
+        self.assertEquals(counters["inflates"],2)
+        self.assertEquals(counters["unmarshals"],1)
+        self.assertTrue(counters["directory_time"] > 0)
+        self.assertFalse("preload_hits" in counters)
+        module = stats["modules"]["distutils"]
+        self.assertEquals(module["archive"],lib)
+        self.assertEquals(module["reads"],1)
+        self.assertEquals(module["unmarshals"],1)
+        self.assertTrue(module["exec_time"] > 0)
+        self.assertTrue("distutils" in zipimportx._format_stats(stats))
+        #  Preloaded data is counted separately from disk reads.
+        i.write_index(preload=["distutils*"])
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter.start_stats()
+        try:
+            i = zipimportx.zipimporter(lib)
+            i.get_code("distutils")
+        finally:
+            stats = zipimportx.zipimporter.stop_stats()
+        counters = stats["archives"][lib]
+        self.assertEquals(counters["index_loads"],1)
+        self.assertEquals(counters["preload_hits"],1)
+        self.assertFalse("reads" in counters)
+        #  Work done in other threads isn't counted against the module that
+        #  this thread is loading.
+        import threading
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter.start_stats()
+        try:
+            i = zipimportx.zipimporter(lib)
+            zipimportx._zip_stats["modules"]["main"] = {}
+            zipimportx._get_stats_stack().append("main")
+            fn = os.path.join("zipimportx","__init__.pyc")
+            t = threading.Thread(target=i.get_data,args=(fn,))
+            t.start()
+            t.join()
+        finally:
+            stats = zipimportx.zipimporter.stop_stats()
+        self.assertEquals(stats["modules"]["main"],{})
+        self.assertEquals(stats["archives"][lib]["reads"],1)
+
+    def test_stats_dump_at_exit(self):
+        import subprocess
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        dest = lib + ".stats"
+        env = os.environ.copy()
+        env["ZIPIMPORTX_STATS"] = dest
+        code = "import zipimportx; " \
+               "zipimportx.zipimporter(%r).get_code('distutils')" % (lib,)
+        topdir = os.path.abspath(zipimportx.__file__)
+        topdir = os.path.dirname(os.path.dirname(topdir))
+        try:
+            subprocess.check_call([sys.executable,"-c",code],
+                                  env=env,cwd=topdir)
+            with open(dest) as f:
+                text = f.read()
+            self.assertTrue(("archive %s" % (lib,)) in text)
+            self.assertTrue("unmarshals: 1" in text)
+        finally:
+            if os.path.exists(dest):
+                os.unlink(dest)
+
+    def test_profile(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        saved = {}
+        for nm in sys.modules.keys():
+            if nm == "distutils" or nm.startswith("distutils."):
+                saved[nm] = sys.modules.pop(nm)
+        path_hooks = sys.path_hooks[:]
+        sys.path.insert(0,lib)
+        try:
+            zipimportx.zipimporter.install()
+            zipimportx.zipimporter.start_profile()
+            try:
+                __import__("distutils.core")
+            finally:
+                profile = zipimportx.zipimporter.stop_profile()
+        finally:
+            sys.path.remove(lib)
+            sys.path_hooks[:] = path_hooks
+            sys.path_importer_cache.clear()
+            for nm in sys.modules.keys():
+                if nm == "distutils" or nm.startswith("distutils."):
+                    del sys.modules[nm]
+            sys.modules.update(saved)
+        self.assertTrue(zipimportx._zip_stats is None)
+        self.assertEquals([c.name for c in profile.children],["distutils",
+                                                               "distutils.core"])
+        core = profile.children[1]
+        self.assertEquals(core.archive,lib)
+        names = [node.name for (depth,node) in core.walk()]
+        self.assertTrue("distutils.cmd" in names)
+        self.assertTrue(core.total_time >= core.self_time > 0)
+        self.assertTrue(core.overhead > 0)
+        self.assertEquals(core.counters["unmarshals"],1)
+        for (depth,node) in profile.walk():
+            total = sum(c.total_time for c in node.children)
+            self.assertTrue(total <= node.total_time)
+        text = profile.format_tree()
+        self.assertTrue("  distutils.core  (" in text)
+        self.assertTrue("    distutils.cmd  (" in text)
+        self.assertTrue("unmarshal=" in text)
+        collapsed = profile.format_collapsed()
+        self.assertTrue("\ndistutils.core;distutils.cmd " in collapsed)
+        self.assertTrue("distutils.core;[zipimportx] " in collapsed)
+        for line in collapsed.splitlines():
+            (stack,count) = line.rsplit(" ",1)
+            self.assertTrue(int(count) > 0)
+        #  Loads are still profiled if the statistics are stopped early.
+        zipimport._zip_directory_cache.clear()
+        saved = sys.modules.pop("distutils")
+        zipimportx.zipimporter.start_profile()
+        try:
+            zipimportx.zipimporter.stop_stats()
+            zipimportx.zipimporter(lib).load_module("distutils")
+        finally:
+            profile = zipimportx.zipimporter.stop_profile()
+            sys.modules["distutils"] = saved
+        self.assertEquals([c.name for c in profile.children],["distutils"])
+        self.assertTrue(profile.children[0].total_time > 0)
+        #  Work done in other threads isn't counted against the node that
+        #  this thread is loading.
+        import threading
+        zipimport._zip_directory_cache.clear()
+        zipimportx.zipimporter.start_profile()
+        try:
+            i = zipimportx.zipimporter(lib)
+            node = zipimportx.ProfileNode("main",lib)
+            zipimportx._get_profile_stack().append(node)
+            fn = os.path.join("zipimportx","__init__.pyc")
+            t = threading.Thread(target=i.get_data,args=(fn,))
+            t.start()
+            t.join()
+        finally:
+            zipimportx.zipimporter.stop_profile()
+        self.assertEquals(node.counters,{})
+
+    def test_compact_directory(self):
+        from zipimportx import bench
+        for libnm in ("libsmall.zip","libmedium.zip","liblarge.zip"):
+            lib = os.path.join(os.path.dirname(__file__),libnm)
+            lib = os.path.abspath(lib)
+            zipimport._zip_directory_cache.clear()
+            files = zipimportx.zipimporter(lib)._files
+            zipimport._zip_directory_cache.clear()
+            zipimportx.zipimporter.compact_directory = True
+            try:
+                i = zipimportx.zipimporter(lib)
+            finally:
+                zipimportx.zipimporter.compact_directory = False
+            cfiles = zipimport._zip_directory_cache[lib]
+            self.assertTrue(isinstance(cfiles,zipimportx._CompactDirectory))
+            self.assertTrue(i._files is cfiles)
+            self.assertEquals(len(cfiles),len(files))
+            self.assertEquals(sorted(cfiles.keys()),sorted(files.keys()))
+            for (k,v) in files.iteritems():
+                self.assertEquals(cfiles[k][1:],v[1:])
+            self.assertFalse("nonexistent" in cfiles)
+            fn = os.path.join("zipimportx","nonexistent")
+            self.assertFalse(fn in cfiles)
+            #  Data prefetched by the first importer is seen by later ones.
+            self.assertTrue(i.prefetch("zipimportx*") > 0)
+            fn = os.path.join("zipimportx","__init__.pyc")
+            self.assertEquals(len(cfiles[fn]),9)
+            i = zipimportx.zipimporter(lib)
+            self.assertTrue(i.find_module("zipimportx") is i)
+            self.assertEquals(len(i._files[fn]),9)
+            data = zipfile.ZipFile(lib).read("zipimportx/__init__.pyc")
+            self.assertEquals(i.get_data(fn),data)
+            d_size = bench.sizeof_directory(files)
+            c_size = bench.sizeof_directory(cfiles)
+            self.assertTrue(c_size < d_size)
+        #  The benchmark reports the memory per entry for each archive.
+        libs = [os.path.abspath(os.path.join(os.path.dirname(__file__),libnm))
+                for libnm in ("libsmall.zip","libmedium.zip","liblarge.zip")]
+        results = bench.run_archives(libs,min_time=0.001,repeat=1)
+        memory = dict((bench.result_key(r),r["value"])
+                      for r in results["memory"])
+        for lib in libs:
+            key = os.path.basename(lib) + "/%s/directory_bytes_per_entry"
+            self.assertTrue(0 < memory[key % "compact"] < memory[key % "dict"])
+            self.assertFalse(os.path.exists(lib + ".idx"))
+
+    def test_data_cache(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        fn1 = os.path.join("zipimportx","__init__.pyc")
+        fn2 = os.path.join("zipimportx","tests","__init__.pyc")
+        data1 = i.get_data(fn1)
+        data2 = i.get_data(fn2)
+        cache = zipimportx.DataCache(max_bytes=len(data1)+len(data2)-1)
+        zipimportx.zipimporter.data_cache = cache
+        try:
+            self.assertEquals(i.get_data(fn1),data1)
+            self.assertEquals(i.get_data(lib+os.sep+fn1),data1)
+            self.assertEquals((cache.hits,cache.misses),(1,1))
+            self.assertEquals(cache.size,len(data1))
+            self.assertEquals(i.get_data(fn2),data2)
+            self.assertEquals(cache.evictions,1)
+            self.assertEquals(len(cache),1)
+            self.assertTrue((lib,fn2) in cache)
+            self.assertRaises(IOError,i.get_data,"nonexistent")
+            cache.clear()
+            self.assertEquals((len(cache),cache.size,cache.hits),(0,0,0))
+        finally:
+            zipimportx.zipimporter.data_cache = None
+
+    def test_open_resource(self):
+        for libnm in ("libsmall.zip","libmedium.zip"):
+            lib = os.path.join(os.path.dirname(__file__),libnm)
+            lib = os.path.abspath(lib)
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            fn = os.path.join("zipimportx","__init__.pyc")
+            data = i.get_data(fn)
+            for zmap in (True,None):
+                if zmap is None:
+                    zipimportx._zip_archive_maps[lib] = None
+                f = i.open_resource(lib+os.sep+fn)
+                f.chunk_size = 1000
+                self.assertEquals(f.read(10),data[:10])
+                buf = bytearray(100)
+                self.assertEquals(f.readinto(buf),100)
+                self.assertEquals(str(buf),data[10:110])
+                self.assertEquals(f.read(),data[110:])
+                self.assertEquals(f.read(),"")
+                f.seek(-50,2)
+                self.assertEquals(f.tell(),len(data)-50)
+                self.assertEquals(f.read(),data[-50:])
+                f.seek(5)
+                self.assertEquals(f.read(5),data[5:10])
+                f.seek(0)
+                self.assertEquals("".join(f),data)
+                f.close()
+                self.assertRaises(ValueError,f.read)
+            self.assertRaises(IOError,i.open_resource,"nonexistent")
+        #  Compressed data is only inflated as far as each read needs.
+        lib = "libdeflated.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        data = "".join("line %d\n" % (n,) for n in xrange(20000))
+        zf = zipfile.ZipFile(lib,"w",zipfile.ZIP_DEFLATED)
+        zf.writestr("big.txt",data)
+        zf.close()
+        try:
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            f = i.open_resource("big.txt")
+            f.chunk_size = 1000
+            self.assertEquals(f.read(10),data[:10])
+            self.assertEquals(f._buffer,"")
+            self.assertTrue(f._tail)
+            self.assertEquals(f.readline(),data[10:data.index("\n",10)+1])
+            pos = f.tell()
+            self.assertEquals(f.read(),data[pos:])
+            f.seek(0)
+            self.assertEquals(f.readlines(),data.splitlines(True))
+            f.close()
+        finally:
+            zipimport._zip_directory_cache.clear()
+            zipimportx._zip_archive_maps.pop(lib,None)
+            os.unlink(lib)
+
+    def test_get_buffer(self):
+        for libnm in ("libsmall.zip","libmedium.zip"):
+            lib = os.path.join(os.path.dirname(__file__),libnm)
+            lib = os.path.abspath(lib)
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            fn = os.path.join("zipimportx","__init__.pyc")
+            buf = i.get_buffer(fn)
+            self.assertTrue(isinstance(buf,buffer))
+            self.assertEquals(str(buf),i.get_data(fn))
+            code = marshal.loads(buffer(buf,8))
+            fn = i.get_code("zipimportx").co_filename
+            self.assertEquals(code.co_filename,fn)
+            self.assertRaises(IOError,i.get_buffer,"nonexistent")
+        #  Reads from the memory map are timed like any other read.
+        zipimportx.zipimporter.start_stats()
+        try:
+            i.get_buffer(os.path.join("zipimportx","__init__.pyc"))
+        finally:
+            stats = zipimportx.zipimporter.stop_stats()
+        counters = stats["archives"][lib]
+        self.assertEquals(counters["reads"],1)
+        self.assertTrue("read_time" in counters)
+        #  Files served from preloaded data are still traced.
+        i.prefetch(["zipimportx*"])
+        fn = os.path.join("zipimportx","__init__.pyc")
+        zipimportx.zipimporter.start_trace()
+        try:
+            i.get_buffer(fn)
+        finally:
+            trace = zipimportx.zipimporter.stop_trace()
+        self.assertEquals(trace,[(lib,fn)])
+
+    def test_warmup(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        names = []
+        for fn in i._files.keys():
+            if fn.endswith(".pyc") or fn.endswith(".pyo"):
+                nm = fn[:-4].replace(os.sep,".")
+                if nm.endswith(".__init__"):
+                    nm = nm[:-len(".__init__")]
+                names.append(nm)
+        expected = {}
+        for nm in names:
+            code = i._get_path_code(nm.replace(".",os.sep))[0]
+            expected[nm] = marshal.dumps(code)
+        #  Race some imports against the warmup threads.
+        task = i.warmup(names,threads=4)
+        for nm in names[::3]:
+            pathhead = nm.replace(".",os.sep)
+            ready = zipimportx._get_ready_code((lib,pathhead))
+            if ready is not None:
+                self.assertEquals(marshal.dumps(ready[0]),expected[nm])
+        task.wait()
+        self.assertFalse(zipimportx._zip_warmup)
+        for nm in names:
+            pathhead = nm.replace(".",os.sep)
+            if nm in names[::3]:
+                self.assertFalse((lib,pathhead) in zipimportx._zip_code_cache)
+            else:
+                self.assertTrue((lib,pathhead) in zipimportx._zip_code_cache)
+        saved = sys.modules.pop("distutils")
+        try:
+            i.load_module("distutils")
+        finally:
+            sys.modules["distutils"] = saved
+        self.assertFalse((lib,"distutils") in zipimportx._zip_code_cache)
+        zipimportx._zip_code_cache.clear()
+        #  Modules are keyed by their full path for a package's importer.
+        sub = zipimportx.zipimporter(lib + os.sep + "distutils")
+        sub.warmup(["distutils.core"]).wait()
+        key = (lib,os.path.join("distutils","core"))
+        self.assertTrue(key in zipimportx._zip_code_cache)
+        saved = sys.modules.pop("distutils.core",None)
+        try:
+            sub.load_module("distutils.core")
+        finally:
+            if saved is not None:
+                sys.modules["distutils.core"] = saved
+            else:
+                sys.modules.pop("distutils.core",None)
+        self.assertFalse(key in zipimportx._zip_code_cache)
+        zipimportx._zip_code_cache.clear()
+
+    def test_warmup_import(self):
+        dirnm = os.path.abspath(os.path.dirname(__file__))
+        lib = os.path.join(dirnm,"libwarmup.zip")
+        cachedir = os.path.join(dirnm,"codecache")
+        zf = zipfile.ZipFile(lib,"w",compression=zipfile.ZIP_DEFLATED)
+        names = ["warmapp"]
+        init = []
+        for n in xrange(200):
+            names.append("warmapp.mod%d" % (n,))
+            init.append("from warmapp import mod%d\n" % (n,))
+            zf.writestr("warmapp/mod%d.py" % (n,),"value = %d\n" % (n,))
+        zf.writestr("warmapp/__init__.py","".join(init))
+        zf.close()
+        if not os.path.isdir(cachedir):
+            os.mkdir(cachedir)
+        #  Make the warmup threads find these modules not yet imported,
+        #  as they would be at startup.
+        saved_mmap = zipimportx.mmap
+        saved_os = zipimportx.os
+        zipimportx.mmap = None
+        zipimportx.os = None
+        path_hooks = sys.path_hooks[:]
+        sys.path.insert(0,lib)
+        zipimportx.zipimporter.code_cache_dir = cachedir
+        try:
+            zipimportx.zipimporter.install()
+            #  The imports hold the import lock, which the warmup threads
+            #  mustn't need, or this would deadlock.
+            task = zipimportx.zipimporter(lib).warmup(names,threads=4)
+            import warmapp
+            task.wait()
+            self.assertEquals(warmapp.mod199.value,199)
+            self.assertFalse(zipimportx._zip_warmup)
+        finally:
+            zipimportx.zipimporter.code_cache_dir = None
+            zipimportx.mmap = saved_mmap
+            zipimportx.os = saved_os
+            sys.path.remove(lib)
+            sys.path_hooks[:] = path_hooks
+            sys.path_importer_cache.clear()
+            for nm in names:
+                sys.modules.pop(nm,None)
+            zipimportx._zip_code_cache.clear()
+            zipimportx._zip_archive_maps.pop(lib,None)
+            for fn in os.listdir(cachedir):
+                os.unlink(os.path.join(cachedir,fn))
+            os.rmdir(cachedir)
+            os.unlink(lib)
+
+    def test_warmup_wait(self):
+        import threading
+        dirnm = os.path.abspath(os.path.dirname(__file__))
+        lib = os.path.join(dirnm,"libwarmwait.zip")
+        zf = zipfile.ZipFile(lib,"w")
+        zf.writestr("warmwait.py","value = 42\n")
+        zf.close()
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        #  Hold the warmup thread in the middle of compiling the module.
+        compiled = []
+        started = threading.Event()
+        proceed = threading.Event()
+        compile_source = i._compile_source
+        def _compile_source(*args):
+            compiled.append(args[0])
+            started.set()
+            proceed.wait()
+            return compile_source(*args)
+        i._compile_source = _compile_source
+        try:
+            task = i.warmup(["warmwait"])
+            started.wait()
+            #  The import waits for the warmup thread, even though it holds
+            #  the import lock, rather than compiling the code again.
+            threading.Timer(0.1,proceed.set).start()
+            imp.acquire_lock()
+            try:
+                mod = i.load_module("warmwait")
+            finally:
+                imp.release_lock()
+            task.wait()
+            self.assertEquals(mod.value,42)
+            self.assertEquals(compiled,["warmwait.py"])
+            self.assertFalse(zipimportx._zip_warmup)
+            self.assertFalse(zipimportx._zip_code_cache)
+        finally:
+            proceed.set()
+            sys.modules.pop("warmwait",None)
+            zipimportx._zip_archive_maps.pop(lib,None)
+            os.unlink(lib)
+
+    def test_warm(self):
+        lib = "libsmall.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zipimport._zip_directory_cache.clear()
+        i = zipimportx.zipimporter(lib)
+        (nmodules,nbytes) = i.warm(["distutils*"])
+        expected = [k for k in i._files.keys() if k.startswith("distutils")]
+        self.assertEquals(nmodules,len(expected))
+        self.assertEquals(nbytes,sum(i._files[k][3] for k in expected))
+        self.assertEquals(i.warm(["distutils*"]),(0,0))
+        self.assertTrue((lib,"distutils") in zipimportx._zip_code_cache)
+        fn = os.path.join("distutils","command")
+        self.assertTrue((lib,fn) in zipimportx._zip_code_cache)
+        i2 = zipimportx.zipimporter(lib+os.sep+"distutils")
+        (code,filepath,ispkg) = i2._get_module_code("distutils.command")
+        self.assertTrue(ispkg)
+        self.assertFalse((lib,fn) in zipimportx._zip_code_cache)
+        zipimportx._zip_code_cache.clear()
+        #  A corrupt member is skipped rather than stopping the whole pass.
+        lib = "libcorrupt.zip"
+        lib = os.path.abspath(os.path.join(os.path.dirname(__file__),lib))
+        zf = zipfile.ZipFile(lib,"w",zipfile.ZIP_DEFLATED)
+        zf.writestr("good.py","x = 1\n")
+        zf.writestr("bad.py","x = 2\n")
+        zf.close()
+        try:
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            i._files["bad.py"] = i._files["bad.py"][:8] + ("\xff" * 8,)
+            self.assertEquals(i.warm(["*.py"])[0],1)
+            self.assertTrue((lib,"good") in zipimportx._zip_code_cache)
+            modules = i._precompile_modules(["bad","good"])
+            self.assertEquals(sorted(modules),["good"])
+        finally:
+            zipimportx._zip_code_cache.clear()
+            zipimport._zip_directory_cache.clear()
+            zipimportx._zip_archive_maps.pop(lib,None)
+            os.unlink(lib)
+
+    def test_code_cache_dir(self):
+        dirnm = os.path.abspath(os.path.dirname(__file__))
+        lib = os.path.join(dirnm,"libsource.zip")
+        cachedir = os.path.join(dirnm,"codecache")
+        zf = zipfile.ZipFile(lib,"w")
+        zf.writestr("srcmod.py","value = 42\n")
+        zf.close()
+        if not os.path.isdir(cachedir):
+            os.mkdir(cachedir)
+        for fn in os.listdir(cachedir):
+            os.unlink(os.path.join(cachedir,fn))
+        zipimportx.zipimporter.code_cache_dir = cachedir
+        try:
+            zipimport._zip_directory_cache.clear()
+            i = zipimportx.zipimporter(lib)
+            (code,filepath,ispkg) = i._get_module_code("srcmod")
+            ns = {}
+            exec code in ns
+            self.assertEquals(ns["value"],42)
+            cached = os.listdir(cachedir)
+            self.assertEquals(len(cached),1)
+            #  Code compiled with and without -O is cached separately.
+            self.assertTrue(cached[0].endswith(__debug__ and ".pyc" or ".pyo"))
+            #  Later loads use the cached code rather than compiling.
+            with open(os.path.join(cachedir,cached[0]),"wb") as f:
+                marshal.dump(compile("value = 7\n",filepath,"exec"),f)
+            (code,filepath,ispkg) = i._get_module_code("srcmod")
+            exec code in ns
+            self.assertEquals(ns["value"],7)
+        finally:
+            zipimportx.zipimporter.code_cache_dir = None
+            for fn in os.listdir(cachedir):
+                os.unlink(os.path.join(cachedir,fn))
+            os.rmdir(cachedir)
+            os.unlink(lib)
 
     def test_README(self):
         """Ensure that the README is in sync with the docstring.